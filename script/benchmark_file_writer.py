@@ -0,0 +1,48 @@
+import os
+import time
+import shutil
+import argparse
+import tempfile
+from struc_utility import save_file, save_files
+
+
+def make_files(directory, count, size):
+    content = ("100.0000 1000\n" * (size // 14 + 1))[:size]
+    return [(os.path.join(directory, f"id{i}_spectrum.txt"), content) for i in range(count)]
+
+
+def time_writer(base_dir, label, count, size, write):
+    directory = tempfile.mkdtemp(prefix="msemblator_bench_", dir=base_dir)
+    try:
+        files = make_files(directory, count, size)
+        start = time.perf_counter()
+        write(files)
+        elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    print(f"{label:<10} {base_dir:<30} {count / elapsed:>12,.0f} files/s ({elapsed:.2f} s)")
+
+
+def main():
+    default_dirs = [tempfile.gettempdir()]
+    if os.path.isdir("/dev/shm"):
+        default_dirs.append("/dev/shm")
+
+    parser = argparse.ArgumentParser(
+        description="Compare writing per-spectrum files one by one (save_file) with the bulk writer (save_files)."
+    )
+    parser.add_argument("--dirs", nargs="+", default=default_dirs,
+                        help="Folders to benchmark, e.g. a disk folder and a tmpfs/RAM disk (default: %(default)s)")
+    parser.add_argument("--files", type=int, default=30000, help="Number of files (default: %(default)s)")
+    parser.add_argument("--size", type=int, default=2000, help="Bytes per file (default: %(default)s)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+                        help="Writer threads of the bulk writer, e.g. a candidate file_writer: workers value (default: %(default)s)")
+    args = parser.parse_args()
+
+    for base_dir in args.dirs:
+        time_writer(base_dir, "loop", args.files, args.size, lambda files: [save_file(path, content) for path, content in files])
+        time_writer(base_dir, "bulk", args.files, args.size, lambda files: save_files(files, workers=args.workers))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,22 @@
 import os
+import time
+import numpy as np
 import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
 from msbuddy import Msbuddy, MsbuddyConfig, Adduct
+from msbuddy.base import MetaFeature, Spectrum
+from scheduler import CostModel, SpectrumCost, longest_first
 
+# Engine owned by each pool worker, created once by _init_worker
+_worker_engine = None
 
-def run_msbuddy(input_dir, output_dir, confing, batch_size=1000):
-    """
-    Run MSBuddy to annotate molecular formulas from MGF files and save the results in chunks of specified size.
-    """
+
+def _build_config(confing):
     ms1 = confing['formula_prediction']['msbuddy']['MS1_ppm']
     ms2 = confing['formula_prediction']['msbuddy']['MS2_ppm']
     atoms = confing['formula_prediction']['msbuddy']['halogen']
     # Create an MsbuddyConfig object with specific configuration parameters
-    msb_config = MsbuddyConfig(
+    return MsbuddyConfig(
         ms_instr=None,
         ppm=True,
         ms1_tol=ms1,
@@ -20,83 +25,173 @@ def run_msbuddy(input_dir, output_dir, confing, batch_size=1000):
         halogen=atoms
     )
 
-    # Initialize the Msbuddy engine with the specified configuration
-    msb_engine = Msbuddy(msb_config)
-    print("Updated MS1 tolerance:", msb_engine.config.ms1_tol)
-    print("Updated MS2 tolerance:", msb_engine.config.ms2_tol)
 
-    # Retrieve all .mgf files from the input directory
-    mgf_files = [f for f in os.listdir(input_dir) if f.endswith('.mgf')]
+def _init_worker(confing):
+    global _worker_engine
+    _worker_engine = Msbuddy(_build_config(confing))
+
+
+# Columns of detailed_summary_<adduct>.csv
+DETAILED_COLUMNS = ["Scan_ID", "m/z", "RT", "Rank", "Formula", "Estimated_FDR"]
+
+
+def _annotate_chunk(msb_engine, chunk):
+    """
+    Annotate one chunk of MetaFeatures and collect its candidates column by column.
+
+    Candidates are keyed by the feature identifier (the spectrum TITLE), so no
+    get_summary() table or m/z lookup is needed.
+
+    Returns:
+        dict: DETAILED_COLUMNS -> np.ndarray, one entry per candidate.
+    """
+    # Assign chunk to engine and process
+    msb_engine.data = chunk
+    msb_engine.annotate_formula()
+
+    candidate_lists = []
+    for meta_feature in msb_engine.data:
+        # Ensure candidate_formula_list is a list
+        candidate_list = getattr(meta_feature, "candidate_formula_list", None) or []
+        if not isinstance(candidate_list, list):
+            print(f"Warning: candidate_formula_list is not a list for {meta_feature.identifier}. Skipping this feature.")
+            candidate_list = []
+        candidate_lists.append(candidate_list)
+
+    n_candidates = sum(len(candidate_list) for candidate_list in candidate_lists)
+    columns = {
+        "Scan_ID": np.empty(n_candidates, dtype=object),
+        "m/z": np.empty(n_candidates, dtype=np.float64),
+        "RT": np.empty(n_candidates, dtype=object),
+        "Rank": np.empty(n_candidates, dtype=np.int64),
+        "Formula": np.empty(n_candidates, dtype=object),
+        "Estimated_FDR": np.empty(n_candidates, dtype=object),
+    }
+    position = 0
+    for meta_feature, candidate_list in zip(msb_engine.data, candidate_lists):
+        end = position + len(candidate_list)
+        columns["Scan_ID"][position:end] = meta_feature.identifier
+        columns["m/z"][position:end] = meta_feature.mz
+        columns["RT"][position:end] = getattr(meta_feature, "rt", None)
+        columns["Rank"][position:end] = np.arange(1, len(candidate_list) + 1)
+        columns["Formula"][position:end] = [candidate.formula for candidate in candidate_list]
+        columns["Estimated_FDR"][position:end] = [getattr(candidate, "estimated_fdr", None) for candidate in candidate_list]
+        position = end
+    return columns
+
+
+def _timed_annotate_chunk(msb_engine, chunk):
+    start = time.time()
+    columns = _annotate_chunk(msb_engine, chunk)
+    return columns, time.time() - start
+
+
+def _annotate_chunk_in_worker(chunk):
+    return _timed_annotate_chunk(_worker_engine, chunk)
+
+
+def build_meta_features(spectra):
+    """
+    Group parsed MSP spectra by adduct and build msbuddy MetaFeatures with the adduct set.
+
+    Args:
+        spectra (list): Spectra from msp_to_mgf.parse_msp_spectra.
+
+    Returns:
+        tuple: (adduct name -> list of MetaFeature, adduct name -> list of
+        scheduler.SpectrumCost). Adduct names have '/' replaced by '_' as in the
+        former per-adduct MGF file names.
+    """
+    features = {}
+    costs = {}
+    for spectrum in spectra:
+        if not spectrum['adduct']:
+            print(f"Skipped spectrum: {spectrum['title'] or 'Unknown Title'} (No ADDUCT found)")
+            continue
+        if spectrum['precursor_mz'] is None:
+            print(f"Skipped spectrum: {spectrum['title'] or 'Unknown Title'} (No PRECURSORMZ found)")
+            continue
+        adduct_name = spectrum['adduct'].replace("/", "_")
 
-    for mgf_file in mgf_files:
-        # Extract the adduct name from the file name (e.g., [M-H]-)
-        adduct_name = os.path.splitext(mgf_file)[0]  
-        
         # Determine the ion mode: '+' indicates positive mode, '-' indicates negative mode
         if adduct_name.endswith('+'):
             pos_ion_mode = True
         elif adduct_name.endswith('-'):
             pos_ion_mode = False
         else:
-            print(f"Invalid adduct sign in file: {mgf_file}")
+            print(f"Invalid adduct sign: {adduct_name}")
             continue
-        
-        # Load the MGF file into the Msbuddy engine
-        mgf_file_path = os.path.join(input_dir, mgf_file)
-        msb_engine.load_mgf(mgf_file_path)
-
-        # Assign the adduct type to each feature in the data
-        for feature in msb_engine.data:
-            feature.adduct = Adduct(adduct_name, pos_mode=pos_ion_mode)
-
-        # Split data into chunks of batch_size
-        data_chunks = [msb_engine.data[i:i + batch_size] for i in range(0, len(msb_engine.data), batch_size)]
-        
-        for idx, chunk in enumerate(data_chunks, start=1):
-            # Assign chunk to engine and process
-            msb_engine.data = chunk
-            msb_engine.annotate_formula()
-
-            # Retrieve summary results for the chunk
-            summary_df = pd.DataFrame(msb_engine.get_summary())
-
-            # Identify correct m/z column
-            mz_column = next((col for col in ["m/z", "mz", "precursor_mz"] if col in summary_df.columns), None)
-            if mz_column is None:
-                raise KeyError("Could not find a valid m/z column in summary_df.")
-            if "identifier" not in summary_df.columns:
-                raise KeyError("The column 'identifier' is missing from summary_df.")
-            
-            # Create identifier mapping
-            identifier_map = dict(zip(summary_df[mz_column], summary_df["identifier"]))
-
-            # Retrieve detailed candidate results
-            detailed_result_list = []
-            for meta_feature in chunk:
-                scan_id = identifier_map.get(meta_feature.mz, None)
-                rt_value = getattr(meta_feature, "rt", None)
-
-                # Ensure candidate_formula_list is not None
-                candidate_list = getattr(meta_feature, "candidate_formula_list", [])
-                if not isinstance(candidate_list, list):
-                    print(f"Warning: candidate_formula_list is not a list for m/z {meta_feature.mz}. Skipping this feature.")
-                    continue
-
-                for i, candidate in enumerate(candidate_list):
-                    detailed_result_list.append({
-                        "Scan_ID": scan_id,
-                        "m/z": meta_feature.mz,
-                        "RT": rt_value,
-                        "Rank": i+1,
-                        "Formula": candidate.formula,
-                        "Estimated_FDR": getattr(candidate, "estimated_fdr", None)
-                    })
-
-            # Save the chunk's summary and detailed results
-            summary_csv = os.path.join(output_dir, f'summary_{adduct_name}_batch{idx}.csv')
-            detailed_csv = os.path.join(output_dir, f'detailed_summary_{adduct_name}_batch{idx}.csv')
-            
-            summary_df.to_csv(summary_csv, index=False)
-            pd.DataFrame(detailed_result_list).to_csv(detailed_csv, index=False)
-
-            print(f"Processed and saved batch {idx} for {mgf_file_path} as {summary_csv} and {detailed_csv}")
\ No newline at end of file
+
+        meta_feature = MetaFeature(
+            identifier=spectrum['title'],
+            mz=spectrum['precursor_mz'],
+            charge=1 if pos_ion_mode else -1,
+            ms2=Spectrum(spectrum['mz'], spectrum['intensity']),
+        )
+        meta_feature.adduct = Adduct(adduct_name, pos_mode=pos_ion_mode)
+        features.setdefault(adduct_name, []).append(meta_feature)
+        costs.setdefault(adduct_name, []).append(SpectrumCost(spectrum['precursor_mz'], len(spectrum['mz']), spectrum['adduct']))
+    return features, costs
+
+
+def run_msbuddy(spectra, output_dir, confing, batch_size=None, workers=None):
+    """
+    Run MSBuddy to annotate molecular formulas of parsed MSP spectra, processing them in chunks.
+
+    Chunks are annotated in a process pool when more than one worker is configured;
+    each worker builds its own Msbuddy engine once. The candidate columns of every
+    adduct are concatenated and written once as detailed_summary_<adduct>.csv.
+
+    Chunks are started in order of decreasing runtime expected by the msbuddy
+    scheduler.CostModel, and the measured chunk runtimes are recorded into it.
+
+    The chunk size and worker count default to `chunk_size` and `workers` in the
+    msbuddy section of the parameter file (workers: 0 uses every CPU core).
+    """
+    buddy_params = confing['formula_prediction']['msbuddy']
+    batch_size = batch_size or buddy_params.get('chunk_size', 1000)
+    workers = buddy_params.get('workers', 1) if workers is None else workers
+    workers = workers or os.cpu_count() or 1
+
+    # Split the spectra of every adduct into chunks of batch_size
+    jobs = []
+    job_costs = []
+    features, costs = build_meta_features(spectra)
+    for adduct_name, meta_features in features.items():
+        for i in range(0, len(meta_features), batch_size):
+            jobs.append((adduct_name, meta_features[i:i + batch_size]))
+            job_costs.append(costs[adduct_name][i:i + batch_size])
+
+    if not jobs:
+        return
+
+    cost_model = CostModel("msbuddy")
+    order = longest_first([cost_model.predict(chunk_costs).sum() for chunk_costs in job_costs])
+    chunks = [jobs[i][1] for i in order]
+    if workers > 1 and len(jobs) > 1:
+        print(f"Annotating {len(jobs)} chunks with {min(workers, len(jobs))} msbuddy workers")
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs)), initializer=_init_worker, initargs=(confing,)) as executor:
+            timed_results = list(executor.map(_annotate_chunk_in_worker, chunks))
+    else:
+        # Initialize the Msbuddy engine with the specified configuration
+        msb_engine = Msbuddy(_build_config(confing))
+        print("Updated MS1 tolerance:", msb_engine.config.ms1_tol)
+        print("Updated MS2 tolerance:", msb_engine.config.ms2_tol)
+        timed_results = [_timed_annotate_chunk(msb_engine, chunk) for chunk in chunks]
+
+    # Put the results back in job order and record the chunk runtimes
+    results = [None] * len(jobs)
+    for index, (columns, seconds) in zip(order, timed_results):
+        results[index] = columns
+        cost_model.record(job_costs[index], seconds)
+    cost_model.save()
+
+    # Merge the chunk results of each adduct and save them once
+    for adduct_name in dict.fromkeys(adduct for adduct, _ in jobs):
+        adduct_results = [result for (adduct, _), result in zip(jobs, results) if adduct == adduct_name]
+        detailed_csv = os.path.join(output_dir, f'detailed_summary_{adduct_name}.csv')
+        detailed_df = pd.DataFrame({
+            column: np.concatenate([result[column] for result in adduct_results]) for column in DETAILED_COLUMNS
+        })
+        detailed_df.to_csv(detailed_csv, index=False)
+        print(f"Processed {len(adduct_results)} chunks for {adduct_name} and saved {detailed_csv}")
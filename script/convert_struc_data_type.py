@@ -3,6 +3,7 @@ from rdkit import Chem
 from rdkit.Chem import inchi
 from sklearn.preprocessing import MinMaxScaler
 import numpy as np
+from parameter_renderer import render_parameter_file
 
 # Function to read MSP file
 def read_msp_file(file_path):
@@ -55,7 +56,15 @@ def smiles_to_inchikeys(smiles_series, msfinder_library):
     # Return as DataFrame with both keys
     return pd.DataFrame({'shortInChiKey': short_inchikey_series, 'InChIKey': full_inchikey_series})
 
-def modify_msfinder_config_in_place(method_path, librarypath, config):
+def render_msfinder_parameters(method_path, librarypath, config):
+    """
+    Render the MS-FINDER method file with the msfinder settings of the parameter file.
+
+    The template at method_path is left unchanged; see parameter_renderer.render_parameter_file.
+
+    Returns:
+        str: Path of the rendered method file.
+    """
     ms1_ppm = config['formula_prediction']['msfinder']['MS1_ppm']
     ms2_ppm = config['formula_prediction']['msfinder']['MS2_ppm']
     elements = config['formula_prediction']['msfinder']['halogen']
@@ -68,18 +77,7 @@ def modify_msfinder_config_in_place(method_path, librarypath, config):
         "Icheck=": f"Icheck={str(elements)}\n",
         "UserDefinedDbFilePath=": f"UserDefinedDbFilePath={librarypath}\n"
     }
-    with open(method_path, 'r') as file:
-        lines = file.readlines()
-    with open(method_path, 'w') as file:
-        for line in lines:
-            replaced = False
-            for key, value in replace_map.items():
-                if line.startswith(key):
-                    file.write(value)
-                    replaced = True
-                    break
-            if not replaced:
-                file.write(line)
+    return render_parameter_file(method_path, replace_map)
 
 
 def convert_to_canonical_smiles(df, column_name, new_column_name="Canonical_SMILES"):
@@ -5,6 +5,7 @@ from sklearn.preprocessing import StandardScaler, MinMaxScaler
 from sklearn.base import TransformerMixin, BaseEstimator
 import numpy as np
 import os
+from parameter_renderer import render_parameter_file
 
 class ClippingTransformer(BaseEstimator, TransformerMixin):
     def __init__(self, q_low=None, q_high=None):
@@ -72,7 +73,15 @@ def extract_used_tooks(row):
         tools.append(f"SIRIUS(rank={int(row['rank'])})")
     return ", ".join(tools)
 
-def modify_msfinder_config_in_place(method_path, config):
+def render_msfinder_parameters(method_path, config):
+    """
+    Render the MS-FINDER method file with the msfinder settings of the parameter file.
+
+    The template at method_path is left unchanged; see parameter_renderer.render_parameter_file.
+
+    Returns:
+        str: Path of the rendered method file.
+    """
     # extract config values
     ms1_ppm = config['formula_prediction']['msfinder']['MS1_ppm']
     ms2_ppm = config['formula_prediction']['msfinder']['MS2_ppm']
@@ -85,15 +94,4 @@ def modify_msfinder_config_in_place(method_path, config):
         "BrCheck=": f"BrCheck={str(elements)}\n",
         "Icheck=": f"Icheck={str(elements)}\n"
     }
-    with open(method_path, 'r') as file:
-        lines = file.readlines()
-    with open(method_path, 'w') as file:
-        for line in lines:
-            replaced = False
-            for key, value in replace_map.items():
-                if line.startswith(key):
-                    file.write(value)
-                    replaced = True
-                    break
-            if not replaced:
-                file.write(line)
\ No newline at end of file
+    return render_parameter_file(method_path, replace_map)
\ No newline at end of file
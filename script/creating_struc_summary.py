@@ -1,34 +1,35 @@
 import os
 import glob
 import re
-import joblib
 import pandas as pd
-from convert_struc_data_type import read_msp_file,extract_compound_and_ionization,convert_to_canonical_smiles
+from convert_struc_data_type import read_msp_file,extract_compound_and_ionization,convert_to_canonical_smiles,convert_to_shortinchikey
 from tqdm import tqdm
-from functools import reduce
-from struc_score_normalization import ClippingTransformer 
 from msfinder_struc_summary import process_msfinder_output
 from sirius_struc_summary import process_sirius_output
-from struc_score_calc import predict_and_append, aggregate_probability_with_rank, machine_input_generation
+from struc_score_calc import predict_and_append, aggregate_probability_with_rank, machine_input_generation, representative_smiles, STRUCTURE_TOOLS
 from metfrag_summary import process_metfrag_output
-from functools import reduce
+from summary_utility import merge_wide_tables, build_name_adduct_df, spectrum_batches, SPECTRUM_ID_DTYPE
+from scoring_server import feature_scorer
+from result_writer import write_result_batches
 
-def struc_summary(input_msp, msfinder_folder, machine_dir, sirius_folder, metfrag_folder,top_n = 100, summary_n = 5):
+def collect_structure_candidates(input_msp, msfinder_folder, machine_dir, sirius_folder, metfrag_folder, top_n=100):
+    """
+    Parse and normalize the candidates of every structure tool.
+
+    Returns:
+        dict: The long score table ('smiles_score_df'), the base summary table
+        and the per-tool wide SMILES tables, i.e. everything
+        score_structure_candidates needs.
+    """
     msp_data = read_msp_file(input_msp)
     compound_ionization_data = extract_compound_and_ionization(msp_data)
-    summary_inchikey_df = pd.DataFrame(columns=['filename', 'adduct'])
-    summary_smiles_df = pd.DataFrame(columns=['filename', 'adduct'])
-    class_summary_df = pd.DataFrame(columns=['filename','tool_name','InChIKey','SMILES'])
-    smiles_score_df=pd.DataFrame(columns=['filename',"tool_name",'adduct',"rank","SMILES","normalization_Zscore","normalization_z_score_diff","normalized_rank"])
-    name_adduct_df = pd.DataFrame(columns=['filename', 'adduct'])
-    # Assign the compound names to the 'filename' column and ionization information to the 'adduct' column
-    for idx, (compound, ionization) in enumerate(compound_ionization_data):
-        summary_inchikey_df.at[idx, 'filename'] = compound
-        summary_inchikey_df.at[idx, 'adduct'] = ionization
-        summary_smiles_df.at[idx, 'filename'] = compound
-        summary_smiles_df.at[idx, 'adduct'] = ionization
-        name_adduct_df.at[idx, 'filename'] = compound
-        name_adduct_df.at[idx, 'adduct'] = ionization
+    # Map the integer spectrum IDs to their ionization information
+    name_adduct_df = build_name_adduct_df(compound_ionization_data)
+    summary_inchikey_df = name_adduct_df.copy()
+    summary_smiles_df = name_adduct_df.copy()
+    class_summary_df = pd.DataFrame(columns=['spectrum_id','tool_name','InChIKey','SMILES'])
+    smiles_score_df=pd.DataFrame(columns=['spectrum_id',"tool_name",'adduct',"rank","SMILES","normalization_Zscore","normalization_z_score_diff","normalized_rank"])
+    smiles_score_df = smiles_score_df.astype({'spectrum_id': SPECTRUM_ID_DTYPE})
     # msfinder summary
     msfinder_inchikey_df, msfinder_smiles_df, class_summary_df, smiles_score_df = process_msfinder_output(msfinder_folder, machine_dir, name_adduct_df, summary_inchikey_df, summary_smiles_df, class_summary_df, smiles_score_df,top_n)
     
@@ -44,18 +45,91 @@ def struc_summary(input_msp, msfinder_folder, machine_dir, sirius_folder, metfra
     metfrag_score = smiles_score_df
     metfrag_score = metfrag_score.dropna(subset=["adduct"])
 
+    return {
+        "smiles_score_df": smiles_score_df,
+        "summary_smiles_df": summary_smiles_df,
+        "msfinder_smiles_df": msfinder_smiles_df,
+        "sirius_smiles_df": sirius_smiles_df,
+        "metfrag_smiles_df": metfrag_smiles_df,
+    }
+
+
+def iter_structure_scores(candidates, machine_dir, summary_n=5, scoring_server=None, batch_spectra=0):
+    """
+    Score collected structure candidates batch_spectra spectra at a time.
+
+    The Short InChIKeys and the representative SMILES of every key are
+    computed once over all candidates, so the batches give the same rows as
+    scoring all candidates at once. The scoring models are loaded once for
+    all batches.
+
+    Yields:
+        tuple: (result_score_df, summary_output_score) of one batch of spectra.
+    """
     print("Generating structural scoring input...")
+    smiles_score_df = candidates["smiles_score_df"].copy()
+    convert_to_shortinchikey(smiles_score_df, "SMILES", new_column_name="Short_InChIKey")
+    smiles_map = representative_smiles(smiles_score_df)
+
+    score = feature_scorer(machine_dir, scoring_server)
+    tables = [smiles_score_df] + [
+        candidates[key] for key in ["summary_smiles_df", "msfinder_smiles_df", "sirius_smiles_df", "metfrag_smiles_df"]
+    ]
+    for batch in spectrum_batches(tables, batch_spectra):
+        yield _score_structure_batch(*batch, smiles_map, score, summary_n)
+
+
+def score_structure_candidates(candidates, machine_dir, summary_n=5, scoring_server=None):
+    """
+    Score collected structure candidates with the ensemble models and build the summaries.
 
-    score_df = machine_input_generation(smiles_score_df)
-    calced_score_df = predict_and_append(score_df, machine_dir, adduct_column="adduct")
+    Returns:
+        tuple: (result_score_df, summary_output_score)
+    """
+    return next(iter_structure_scores(candidates, machine_dir, summary_n, scoring_server))
+
+
+def _score_structure_batch(smiles_score_df, summary_smiles_df, msfinder_smiles_df, sirius_smiles_df, metfrag_smiles_df,
+                           smiles_map, score, summary_n):
+    score_df, features = machine_input_generation(smiles_score_df.copy(), smiles_map)
+    calced_score_df = predict_and_append(score_df, features, score)
     convert_to_canonical_smiles(calced_score_df, 'SMILES')
     result_score_df = aggregate_probability_with_rank(calced_score_df, summary_n)
-    result_score_df = result_score_df.sort_values(['filename', 'rank'], ascending=[True, True])
+    result_score_df = result_score_df.sort_values(['spectrum_id', 'rank'], ascending=[True, True])
 
     # smiles output summary
-    dfs = [msfinder_smiles_df, sirius_smiles_df, metfrag_smiles_df]
-    summary_smiles_df = reduce(lambda left, right: pd.merge(left, right, on=["filename", "adduct"], how='outer'), dfs)
     result_score_top_df = result_score_df[result_score_df["rank"]==1]
-    summary_output_score = pd.merge(summary_smiles_df, result_score_top_df, on=['filename', 'adduct'], how='inner')
+    scored_rows = summary_smiles_df[summary_smiles_df["spectrum_id"].isin(result_score_top_df["spectrum_id"])]
+    summary_output_score = merge_wide_tables(
+        scored_rows,
+        [msfinder_smiles_df, sirius_smiles_df, metfrag_smiles_df, result_score_top_df]
+    )
     
-    return result_score_df, summary_output_score
\ No newline at end of file
+    return result_score_df, summary_output_score
+
+
+def write_structure_results(candidates, name_df, output_dir, machine_dir, config):
+    """
+    Score structure candidates batch by batch and append every batch to the output files.
+
+    The 'output' parameter section sets the file format and the number of
+    spectra per batch ('batch_spectra').
+
+    Returns:
+        list: Paths of structure_score and structure_summary.
+    """
+    output_config = config.get('output', {})
+    batches = iter_structure_scores(
+        candidates, machine_dir, summary_n=config['structure_prediction']['msemblator_output_records'],
+        scoring_server=config.get('scoring_server'), batch_spectra=output_config.get('batch_spectra', 2000)
+    )
+    return write_result_batches(
+        batches, name_df, output_dir,
+        [("structure_score", None), ("structure_summary", {"Canonical_SMILES": "Top_score_Canonical_SMILES"})],
+        output_config.get('format', 'csv'), tool_names=STRUCTURE_TOOLS
+    )
+
+
+def struc_summary(input_msp, msfinder_folder, machine_dir, sirius_folder, metfrag_folder,top_n = 100, summary_n = 5, scoring_server=None):
+    candidates = collect_structure_candidates(input_msp, msfinder_folder, machine_dir, sirius_folder, metfrag_folder, top_n)
+    return score_structure_candidates(candidates, machine_dir, summary_n, scoring_server)
\ No newline at end of file
@@ -1,25 +1,30 @@
 import pandas as pd
 import glob
 import os
-import joblib
-from converting_data_type import normalize_rank, ClippingTransformer, read_msp_file, extract_compound_and_ionization
+from converting_data_type import normalize_rank, read_msp_file, extract_compound_and_ionization
 from msfinder_summary import process_msfinder_summary
 from sirius_summary import process_sirius_summary
 from msbuddy_summary import process_buddy_summary
-from calculating_score import predict_and_append, aggregate_probability_with_rank, formula_machine_input
+from calculating_score import predict_and_append, aggregate_probability_with_rank, formula_machine_input, FORMULA_TOOLS
+from summary_utility import merge_wide_tables, build_name_adduct_df, spectrum_batches, SPECTRUM_ID_DTYPE
+from scoring_server import feature_scorer
+from result_writer import write_result_batches
 
-def creating_output_summary(input_msp, sirius_folder, msfinder_file_path, buddy_folder, machine_dir, top_n, summary_n):
+def collect_formula_candidates(input_msp, sirius_folder, msfinder_file_path, buddy_folder, machine_dir, top_n):
+    """
+    Parse and normalize the candidates of every formula tool.
+
+    Returns:
+        dict: The long score table ('score_df') and the per-tool wide formula
+        tables, i.e. everything score_formula_candidates needs.
+    """
     msp_data = read_msp_file(input_msp)
     compound_ionization_data = extract_compound_and_ionization(msp_data)
-    summary_df = pd.DataFrame(columns=['filename', 'adduct'])
-    name_adduct_df = pd.DataFrame(columns=['filename', 'adduct'])
-    score_df=pd.DataFrame(columns=['filename',"tool_name",'adduct',"rank","formula","Score_NZ","Score_NZ_diff","normalized_rank"])
-    # Assign the compound names to the 'filename' column and ionization information to the 'adduct' column
-    for idx, (compound, ionization) in enumerate(compound_ionization_data):
-        summary_df.at[idx, 'filename'] = compound
-        summary_df.at[idx, 'adduct'] = ionization
-        name_adduct_df.at[idx, 'filename'] = compound
-        name_adduct_df.at[idx, 'adduct'] = ionization
+    # Map the integer spectrum IDs to their ionization information
+    name_adduct_df = build_name_adduct_df(compound_ionization_data)
+    summary_df = name_adduct_df.copy()
+    score_df=pd.DataFrame(columns=['spectrum_id',"tool_name",'adduct',"rank","formula","Score_NZ","Score_NZ_diff","normalized_rank"])
+    score_df = score_df.astype({'spectrum_id': SPECTRUM_ID_DTYPE})
 
     # MS-FINDER summary
     msfinder_formula_df, score_df = process_msfinder_summary(msfinder_file_path, machine_dir, name_adduct_df, summary_df, score_df, top_n)
@@ -30,30 +35,92 @@ def creating_output_summary(input_msp, sirius_folder, msfinder_file_path, buddy_
     # msbuddy summuary
     buddy_formula_df, score_df = process_buddy_summary(buddy_folder, machine_dir, name_adduct_df, summary_df, score_df, top_n)
 
-    wide_df = formula_machine_input(score_df)
-    calc_score_df = predict_and_append(wide_df, machine_dir, adduct_column="adduct")
-    # Fix confidence_score data type
-    def fix_conf(x):
-        if hasattr(x, "__array__"):
-            return float(x[0])
+    return {
+        "score_df": score_df,
+        "msfinder_formula_df": msfinder_formula_df,
+        "sirius_formula_df": sirius_formula_df,
+        "buddy_formula_df": buddy_formula_df,
+    }
+
+
+def iter_formula_scores(candidates, machine_dir, top_n, summary_n, scoring_server=None, batch_spectra=0):
+    """
+    Score collected formula candidates batch_spectra spectra at a time.
+
+    Every spectrum is scored and summarized on its own, so the batches give
+    the same rows as scoring all candidates at once. The scoring models are
+    loaded once for all batches.
 
-        if isinstance(x, (list, tuple)):
-            return float(x[0])
+    Yields:
+        tuple: (summary_score_df, summary_output) of one batch of spectra.
+    """
+    score = feature_scorer(machine_dir, scoring_server)
+    tables = [candidates[key] for key in ["score_df", "msfinder_formula_df", "sirius_formula_df", "buddy_formula_df"]]
+    for score_df, msfinder_formula_df, sirius_formula_df, buddy_formula_df in spectrum_batches(tables, batch_spectra):
+        yield _score_formula_batch(
+            score_df, msfinder_formula_df, sirius_formula_df, buddy_formula_df, score, top_n, summary_n
+        )
 
-        try:
-            return float(x)
-        except:
-            return 0.0
 
-    calc_score_df['confidence_score'] = calc_score_df['confidence_score'].apply(fix_conf)
+def score_formula_candidates(candidates, machine_dir, top_n, summary_n, scoring_server=None):
+    """
+    Score collected formula candidates with the ensemble models and build the summaries.
+
+    Returns:
+        tuple: (summary_score_df, summary_output)
+    """
+    return next(iter_formula_scores(candidates, machine_dir, top_n, summary_n, scoring_server))
+
+
+def _score_formula_batch(score_df, msfinder_formula_df, sirius_formula_df, buddy_formula_df, score, top_n, summary_n):
+    wide_df, features = formula_machine_input(score_df.copy())
+    calc_score_df = predict_and_append(wide_df, features, score)
 
     summary_score_df = aggregate_probability_with_rank(calc_score_df, top_n)
     summary_score_df = summary_score_df[summary_score_df["rank"] <= summary_n]
-    summary_score_df = summary_score_df.sort_values(['filename', 'rank'], ascending=[True, True])
+    summary_score_df = summary_score_df.sort_values(['spectrum_id', 'rank'], ascending=[True, True])
 
     summary_score_top_df = summary_score_df[summary_score_df["rank"]==1]
-    summary_output = pd.merge(msfinder_formula_df, sirius_formula_df, on=['filename', 'adduct'], how='inner')
-    summary_output = pd.merge(summary_output, buddy_formula_df, on=['filename', 'adduct'], how='inner')
-    summary_output = pd.merge(summary_output, summary_score_top_df, on=['filename', 'adduct'], how='inner')
+    # Align the tool tables and the top-scored formula on spectrum_id in one pass
+    scored_rows = msfinder_formula_df[msfinder_formula_df['spectrum_id'].isin(summary_score_top_df['spectrum_id'])]
+    summary_output = merge_wide_tables(
+        scored_rows, [sirius_formula_df, buddy_formula_df, summary_score_top_df]
+    )
     
-    return summary_score_df, summary_output
\ No newline at end of file
+    return summary_score_df, summary_output
+
+
+def write_formula_results(candidates, name_df, output_dir, machine_dir, config, top_n):
+    """
+    Score formula candidates batch by batch and append every batch to the output files.
+
+    The 'output' parameter section sets the file format and the number of
+    spectra per batch ('batch_spectra').
+
+    Returns:
+        tuple: (paths of formula_summary and formula_score, spectrum_id / formula
+        table of the top-scored formulas, used to fix the formulas for structure
+        elucidation)
+    """
+    output_config = config.get('output', {})
+    top_formulas = []
+
+    def batches():
+        for summary_score_df, summary_output in iter_formula_scores(
+            candidates, machine_dir, top_n, summary_n=config['formula_prediction']['msemblator_output_records'],
+            scoring_server=config.get('scoring_server'), batch_spectra=output_config.get('batch_spectra', 2000)
+        ):
+            top_formulas.append(summary_output[["spectrum_id", "formula"]])
+            yield summary_output, summary_score_df
+
+    paths = write_result_batches(
+        batches(), name_df, output_dir,
+        [("formula_summary", {"formula": "Top_score_formula"}), ("formula_score", None)],
+        output_config.get('format', 'csv'), tool_names=FORMULA_TOOLS
+    )
+    return paths, pd.concat(top_formulas, ignore_index=True)
+
+
+def creating_output_summary(input_msp, sirius_folder, msfinder_file_path, buddy_folder, machine_dir, top_n, summary_n, scoring_server=None):
+    candidates = collect_formula_candidates(input_msp, sirius_folder, msfinder_file_path, buddy_folder, machine_dir, top_n)
+    return score_formula_candidates(candidates, machine_dir, top_n, summary_n, scoring_server)
\ No newline at end of file
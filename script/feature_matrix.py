@@ -0,0 +1,138 @@
+import os
+from collections import namedtuple
+import numpy as np
+import pandas as pd
+from forest_engine import load_forest_model
+from score_aggregation import best_tool_ranks, tool_mask
+
+# Adducts that get a one-hot column in the ensemble model input, in training order
+ADDUCT_ONEHOT = ['[M+H]+', '[M+Na]+', '[M+NH4]+', '[M-H]-', '[M+Cl]-', '[M+FA-H]-']
+
+# Model input of one pipeline: float32 features plus the adduct of every row
+# stored as codes into adduct_labels.
+FeatureMatrix = namedtuple("FeatureMatrix", ["values", "adduct_codes", "adduct_labels"])
+
+
+def _normalize_adduct(adduct):
+    return adduct.replace("+", "plus").replace("-", "minus").replace("[", "").replace("]", "")
+
+
+def adduct_model_key(adduct):
+    """Name under which the model of an adduct is stored, e.g. '[MplusH]plus'."""
+    return str(adduct).replace("+", "plus").replace("-", "minus")
+
+
+def build_feature_matrix(df, key_columns, tool_names, score_columns, onehot_adducts=ADDUCT_ONEHOT,
+                         encode_adducts=True, rank_column="rank"):
+    """
+    Collapse the long per-tool score table into one model input row per candidate.
+
+    Rows sharing key_columns are merged; each (score column, tool) pair becomes
+    one feature holding the maximum value reported, in the order
+    score_columns x tool_names (tools sorted as in the training data). This is
+    the layout pivot_table(aggfunc='max') produced, built with a single
+    scatter instead of a reshape of the DataFrame. The tools reporting each
+    candidate are kept as a tool_mask bitmask and rank_<tool> columns.
+
+    Args:
+        df (pd.DataFrame): Long score table with key_columns, 'tool_name',
+            'adduct' and score_columns.
+        key_columns (list): Columns identifying a candidate; must include 'adduct'.
+        tool_names (list): Tool names in feature order.
+        score_columns (list): Score columns in feature order.
+        onehot_adducts (list, optional): Adducts appended as one-hot features.
+        encode_adducts (bool): If False the one-hot features are left at 0.
+        rank_column (str): Tool-specific rank column of df.
+
+    Returns:
+        tuple: (keys_df, FeatureMatrix) where keys_df holds one row per
+        candidate and the matrix rows are aligned with it.
+    """
+    grouped = df.groupby(key_columns, sort=True)
+    group_ids = grouped.ngroup().fillna(-1).to_numpy(dtype=np.int64)
+    keys_df = grouped.size().index.to_frame(index=False)
+
+    n_tools = len(tool_names)
+    tool_codes = pd.Categorical(df["tool_name"], categories=tool_names).codes
+    valid = (group_ids >= 0) & (tool_codes >= 0)
+
+    scores = np.full((len(keys_df), len(score_columns) * n_tools), np.nan, dtype=np.float32)
+    rows = group_ids[valid]
+    for i, column in enumerate(score_columns):
+        values = pd.to_numeric(df[column], errors="coerce").to_numpy(dtype=np.float32)[valid]
+        np.fmax.at(scores, (rows, i * n_tools + tool_codes[valid]), values)
+
+    tool_ranks = best_tool_ranks(group_ids, len(keys_df), tool_codes, df[rank_column], tool_names)
+    keys_df = pd.concat([keys_df, tool_ranks], axis=1)
+    keys_df["tool_mask"] = tool_mask(keys_df, tool_names)
+
+    # Candidates without any score are left out, as pivot_table did
+    has_score = ~np.isnan(scores).all(axis=1)
+    keys_df = keys_df[has_score].reset_index(drop=True)
+    scores = np.nan_to_num(scores[has_score], nan=0.0)
+
+    adduct_codes, adduct_labels = pd.factorize(keys_df["adduct"])
+    onehot = np.zeros((len(keys_df), len(onehot_adducts)), dtype=np.float32)
+    if encode_adducts:
+        normalized_labels = np.array([_normalize_adduct(str(label)) for label in adduct_labels])
+        for j, adduct in enumerate(onehot_adducts):
+            matches = np.append(normalized_labels == _normalize_adduct(adduct), False)
+            onehot[:, j] = matches[adduct_codes]
+
+    values = np.hstack([scores, onehot])
+    return keys_df, FeatureMatrix(values, adduct_codes, np.asarray(adduct_labels))
+
+
+def load_adduct_models(machine_dir, use_engine=False):
+    """
+    Load the default 'all' model and every adduct-specific random forest once.
+
+    With use_engine, forests are returned as ForestEngine instances evaluated
+    from their cached node arrays (see load_forest_model).
+
+    Returns:
+        tuple: (model_all, {adduct model key: model})
+    """
+    model_all = load_forest_model(os.path.join(machine_dir, "random_forest_final_all.pkl"), use_engine)
+    model_dict = {}
+    for filename in os.listdir(machine_dir):
+        if "random_forest_" in filename and filename.endswith(".pkl") and filename != "random_forest_final_all.pkl":
+            adduct_name = filename.split("_")[-2].replace(".pkl", "")
+            model_dict[adduct_name] = load_forest_model(os.path.join(machine_dir, filename), use_engine)
+    return model_all, model_dict
+
+
+def predict_confidence(features, model_all, model_dict):
+    """
+    Predict the probability of TF=1 for every row, one predict_proba call per model.
+
+    Rows whose adduct has no dedicated model are scored together by model_all.
+    """
+    confidence = np.zeros(len(features.values), dtype=np.float64)
+    if not len(confidence):
+        return confidence
+
+    # Map each adduct code to a model, then batch all rows sharing that model
+    label_models = [model_dict.get(adduct_model_key(label), model_all) for label in features.adduct_labels]
+    models = []
+    model_index = np.full(len(label_models) + 1, -1)
+    for code, model in enumerate(label_models):
+        for i, known in enumerate(models):
+            if known is model:
+                model_index[code] = i
+                break
+        else:
+            models.append(model)
+            model_index[code] = len(models) - 1
+    row_models = model_index[features.adduct_codes]
+
+    for i, model in enumerate(models):
+        rows = np.flatnonzero(row_models == i)
+        if not len(rows):
+            continue
+        confidence[rows] = model.predict_proba(features.values[rows])[:, 1]
+    # Rows with a missing adduct fall back to the 'all' model
+    rows = np.flatnonzero(row_models == -1)
+    if len(rows):
+        confidence[rows] = model_all.predict_proba(features.values[rows])[:, 1]
+    return confidence
@@ -0,0 +1,243 @@
+import os
+import glob
+import hashlib
+import logging
+import argparse
+import joblib
+import numpy as np
+
+# Node arrays stored for every exported forest
+_ARRAY_NAMES = ["feature", "threshold", "left", "right", "value", "roots", "classes", "n_features"]
+
+
+class ForestEngine:
+    """
+    Random forest evaluated from flat node arrays.
+
+    All trees are stored back to back: node i of the forest tests
+    X[:, feature[i]] <= threshold[i] and continues at left[i] or right[i];
+    leaves have left[i] == -1 and carry the class-1 probability in value[i].
+    predict_proba walks every tree for a batch of rows at once and averages
+    the leaf values, matching sklearn's RandomForestClassifier.predict_proba.
+    The arrays only hold the fitted forest, so a saved engine can be loaded
+    without sklearn.
+    """
+
+    def __init__(self, feature, threshold, left, right, value, roots, classes, n_features):
+        self.feature = np.asarray(feature, dtype=np.int32)
+        self.threshold = np.asarray(threshold, dtype=np.float64)
+        self.left = np.asarray(left, dtype=np.int32)
+        self.right = np.asarray(right, dtype=np.int32)
+        self.value = np.asarray(value, dtype=np.float64)
+        self.roots = np.asarray(roots, dtype=np.int32)
+        self.classes = np.asarray(classes)
+        self.n_features = int(n_features)
+
+    @classmethod
+    def from_sklearn(cls, model):
+        """Flatten a fitted binary RandomForestClassifier (or ExtraTreesClassifier)."""
+        if len(model.classes_) != 2:
+            raise ValueError("Only binary classifiers can be exported.")
+        feature, threshold, left, right, value, roots = [], [], [], [], [], []
+        offset = 0
+        for estimator in model.estimators_:
+            tree = estimator.tree_
+            is_leaf = tree.children_left == -1
+            counts = tree.value[:, 0, :]
+            roots.append(offset)
+            feature.append(np.where(is_leaf, 0, tree.feature))
+            threshold.append(np.where(is_leaf, 0.0, tree.threshold))
+            left.append(np.where(is_leaf, -1, tree.children_left + offset))
+            right.append(np.where(is_leaf, -1, tree.children_right + offset))
+            value.append(counts[:, 1] / counts.sum(axis=1))
+            offset += tree.node_count
+        return cls(
+            np.concatenate(feature), np.concatenate(threshold), np.concatenate(left),
+            np.concatenate(right), np.concatenate(value), roots, model.classes_, model.n_features_in_
+        )
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            return cls(*(data[name] for name in _ARRAY_NAMES))
+
+    def save(self, path, source_sha256=""):
+        """Save the node arrays, with the SHA-256 of the pickle they were exported from."""
+        np.savez_compressed(
+            path, source_sha256=np.asarray(source_sha256), **{name: getattr(self, name) for name in _ARRAY_NAMES}
+        )
+
+    def _prepare(self):
+        # Leaves point to themselves so finished walks can keep stepping in place,
+        # children are interleaved so one gather picks the next node, and the
+        # float64 thresholds are rounded down to float32 so that
+        # x32 <= t32 gives the same answer as sklearn's x32 <= t64.
+        is_leaf = self.left == -1
+        nodes = np.arange(len(self.left), dtype=np.intp)
+        left = np.where(is_leaf, nodes, self.left)
+        right = np.where(is_leaf, nodes, self.right)
+        self._children = np.column_stack([right, left]).ravel().astype(np.intp)
+        self._feature = self.feature.astype(np.intp)
+        threshold = np.where(is_leaf, np.inf, self.threshold)
+        threshold32 = threshold.astype(np.float32)
+        rounded_up = threshold32.astype(np.float64) > threshold
+        threshold32[rounded_up] = np.nextafter(threshold32[rounded_up], np.float32(-np.inf))
+        self._threshold = threshold32
+        self._is_leaf = is_leaf
+
+    def predict_proba(self, X, batch_rows=1024, compact_every=4):
+        """
+        Walk all trees for batch_rows rows at a time.
+
+        The (row, tree) pairs still inside a tree are kept in flat arrays and
+        pairs that reached a leaf are dropped every compact_every steps.
+        """
+        if not hasattr(self, "_children"):
+            self._prepare()
+        X = np.asarray(X, dtype=np.float32)
+        n_trees = len(self.roots)
+        roots = self.roots.astype(np.intp)
+        positive = np.empty(len(X), dtype=np.float64)
+        for start in range(0, len(X), batch_rows):
+            flat = np.ascontiguousarray(X[start:start + batch_rows]).ravel()
+            n_rows = len(flat) // self.n_features
+            leaves = np.empty(n_rows * n_trees, dtype=np.intp)
+            node = np.tile(roots, n_rows)
+            offset = np.repeat(np.arange(n_rows, dtype=np.intp) * self.n_features, n_trees)
+            pair = np.arange(n_rows * n_trees, dtype=np.intp)
+            step = 0
+            while len(node):
+                go_left = flat[offset + self._feature[node]] <= self._threshold[node]
+                node = self._children[2 * node + go_left]
+                step += 1
+                if step % compact_every == 0:
+                    done = self._is_leaf[node]
+                    leaves[pair[done]] = node[done]
+                    keep = ~done
+                    node, offset, pair = node[keep], offset[keep], pair[keep]
+            positive[start:start + n_rows] = self.value[leaves].reshape(n_rows, n_trees).mean(axis=1)
+        return np.column_stack([1.0 - positive, positive])
+
+
+def export_forest(model, n_features=None, n_probe=2000, random_state=0):
+    """
+    Flatten a fitted forest and verify it against sklearn on random probe rows.
+
+    Probe rows are drawn from the split thresholds of the forest, so every
+    branch direction is exercised.
+
+    Returns:
+        ForestEngine or None: None if the model is not a binary tree ensemble
+        or the exported forest does not reproduce predict_proba.
+    """
+    if not hasattr(model, "estimators_") or not all(hasattr(est, "tree_") for est in model.estimators_):
+        return None
+    try:
+        engine = ForestEngine.from_sklearn(model)
+    except (ValueError, AttributeError) as e:
+        logging.warning(f"Could not export forest: {e}")
+        return None
+
+    n_features = n_features or engine.n_features
+    rng = np.random.default_rng(random_state)
+    probe = rng.normal(size=(n_probe, n_features)).astype(np.float32)
+    split_nodes = engine.left != -1
+    for column in range(n_features):
+        thresholds = engine.threshold[split_nodes & (engine.feature == column)]
+        if len(thresholds):
+            jitter = rng.normal(scale=1e-3, size=n_probe)
+            probe[:, column] = rng.choice(thresholds, size=n_probe) + jitter
+
+    expected = model.predict_proba(probe)[:, 1]
+    if not np.allclose(engine.predict_proba(probe)[:, 1], expected, rtol=1e-9, atol=1e-12):
+        logging.warning("Exported forest does not match sklearn predict_proba")
+        return None
+    return engine
+
+
+def file_sha256(path):
+    """Hex SHA-256 of a file's contents."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _cached_engine(npz_path, source_sha256):
+    """ForestEngine cached in npz_path, None if it is missing, unreadable or exported from another pickle."""
+    if not os.path.exists(npz_path):
+        return None
+    try:
+        with np.load(npz_path, allow_pickle=False) as data:
+            if source_sha256 is not None and str(data["source_sha256"]) != source_sha256:
+                return None
+        return ForestEngine.load(npz_path)
+    except (OSError, KeyError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable forest cache {npz_path}: {e}")
+        return None
+
+
+def export_forest_file(pkl_path):
+    """
+    Export a pickled forest to '<name>.npz' next to it.
+
+    Returns:
+        ForestEngine or the loaded model: the model as loaded if it cannot be exported.
+    """
+    source_sha256 = file_sha256(pkl_path)
+    model = joblib.load(pkl_path)
+    engine = export_forest(model)
+    if engine is None:
+        return model
+    npz_path = os.path.splitext(pkl_path)[0] + ".npz"
+    try:
+        engine.save(npz_path, source_sha256)
+    except OSError as e:
+        logging.warning(f"Could not cache exported forest to {npz_path}: {e}")
+    return engine
+
+
+def load_forest_model(pkl_path, use_engine=False):
+    """
+    Load a pickled random forest, as a ForestEngine if use_engine is set.
+
+    sklearn's predict_proba is faster than ForestEngine, so the engine is only
+    meant for installations whose sklearn version cannot load the pickles.
+    The node arrays are cached next to the pickle as '<name>.npz' together
+    with the SHA-256 of the pickle. A cache exported from the same pickle
+    contents (or any cache, if the pickle is missing) is used without
+    loading the pickle, so scoring does not depend on the installed sklearn
+    version. Otherwise the pickle is loaded, exported, verified and cached;
+    models that cannot be exported are returned as loaded. Run
+    'python forest_engine.py <model folder>' with the training sklearn
+    version to create the caches in advance.
+    """
+    if not use_engine:
+        return joblib.load(pkl_path)
+
+    npz_path = os.path.splitext(pkl_path)[0] + ".npz"
+    engine = _cached_engine(npz_path, file_sha256(pkl_path) if os.path.exists(pkl_path) else None)
+    if engine is not None:
+        return engine
+    return export_forest_file(pkl_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Export the random forests of model folders to .npz node arrays for forest_engine: True."
+    )
+    parser.add_argument("model_dirs", nargs="+", help="Model folders, e.g. formula_scoring_model structure_scoring_model")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    for model_dir in args.model_dirs:
+        for pkl_path in sorted(glob.glob(os.path.join(model_dir, "random_forest_*.pkl"))):
+            if isinstance(export_forest_file(pkl_path), ForestEngine):
+                print(f"Exported {pkl_path}")
+            else:
+                print(f"Skipped {pkl_path} (not an exportable binary forest)")
+
+
+if __name__ == "__main__":
+    main()
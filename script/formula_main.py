@@ -6,13 +6,17 @@ import time
 import glob
 import yaml
 from splitting_msp import read_msp
-from msp_to_mgf import convert_msp_to_mgf, split_mgf_by_adduct_in_memory
+from msp_to_mgf import parse_msp_spectra
 from msp_to_ms import convert_msp_file_to_ms
 from msfinder_cmd import run_msfinder
+from msfinder_parallel import write_msp_parts, run_msfinder_parts
 from sirius_cmd import sirius_login, run_sirius
+from sirius_sharding import run_sharded_sirius, shard_settings
+from scheduler import CostModel
 from buddy_cmd import run_msbuddy
-from creating_summary import creating_output_summary
-from converting_data_type import generate_unique_filename, ClippingTransformer, modify_msfinder_config_in_place
+from creating_summary import collect_formula_candidates, write_formula_results
+from summary_utility import save_candidate_cache
+from converting_data_type import render_msfinder_parameters
 
 def formula_elucidation(input_msp_path, summary_output_dir, name_df):
     print("Running formula elucidation")
@@ -27,7 +31,6 @@ def formula_elucidation(input_msp_path, summary_output_dir, name_df):
     # Define necessary directories.
     msp_folder = os.path.join(current_dir, "save_folder", "msfinder_msp")
     ms_folder = os.path.join(current_dir, "save_folder", "sirius_ms")
-    mgf_folder = os.path.join(current_dir, "save_folder", "buddy_mgf")
     msfinder_folder = os.path.join(current_dir, "msfinder", "output")
     buddy_folder = os.path.join(current_dir, "buddy")
     sirius_folder = os.path.join(current_dir, "sirius", "output")
@@ -54,85 +57,72 @@ def formula_elucidation(input_msp_path, summary_output_dir, name_df):
         os.makedirs(folder)
 
     # Clear contents of required folders.
-    for folder in [msp_folder, ms_folder, mgf_folder, msfinder_folder, buddy_folder, sirius_folder]:
+    for folder in [msp_folder, ms_folder, msfinder_folder, buddy_folder, sirius_folder]:
         clear_folder(folder)
 
     # Ensure necessary folders exist.
-    for folder in [msp_folder, ms_folder, mgf_folder, msfinder_folder, buddy_folder, sirius_folder]:
+    for folder in [msp_folder, ms_folder, msfinder_folder, buddy_folder, sirius_folder]:
         if not os.path.exists(folder):
             os.makedirs(folder)
 
-    # Function to save file content.
-    def save_file(file_path, content):
-        with open(file_path, 'w', encoding='utf-8') as file:
-            file.write(content)
-
     # 1. Split MSP file into individual files and save them.
     split_data = read_msp(input_msp_path)
-    for filename, content in split_data.items():
-        msp_output = os.path.join(msp_folder, f"{filename}.msp")
-        save_file(msp_output, content)
+    msfinder_cost_model = CostModel("msfinder_formula")
+    msp_parts = write_msp_parts(
+        split_data, msp_folder, config['formula_prediction']['msfinder'].get('processes', 1), msfinder_cost_model,
+        config.get('file_writer', {}).get('workers', 1)
+    )
     print("Saved split msp")
 
-    # 2. Convert MSP file to MS format and save it.
+    # 2. Convert MSP file to MS format (written per SIRIUS shard in step 4).
     ms_data = convert_msp_file_to_ms(input_msp_path)
-    ms_output = os.path.join(ms_folder, 'converted_ms.ms')
-    save_file(ms_output, ms_data)
-    print(f"Saved MS data to {ms_output}")
-
-    # 3. Convert MSP to MGF format, split by adduct, and save each file.
-    if not os.path.exists(mgf_folder):
-        os.makedirs(mgf_folder)
-    mgf_content = convert_msp_to_mgf(input_msp_path)
-    adduct_data = split_mgf_by_adduct_in_memory(mgf_content)
-    for adduct, spectra_list in adduct_data.items():
-        output_file_path = os.path.join(mgf_folder, f'{adduct.replace("/", "_")}.mgf')
-        content = "\n\n".join(spectra_list)
-        save_file(output_file_path, content)
-    print(f"Saved MGF files for adducts: {list(adduct_data.keys())}")
+
+    # 3. Parse the MSP spectra once for msbuddy (no intermediate MGF files).
+    buddy_spectra = parse_msp_spectra(input_msp_path)
+    print(f"Parsed {len(buddy_spectra)} spectra for msbuddy")
 
     # 4. Run SIRIUS processing.
     print("SIRIUS processing start")
-    run_sirius(sirius_folder, ms_output, sirius_path, config)
+    shards, cores = shard_settings(config['formula_prediction']['sirius'])
+    run_sharded_sirius(
+        lambda output_dir, input_path, shard_cores, total: run_sirius(
+            output_dir, input_path, sirius_path, config, cores=shard_cores, total=total
+        ),
+        ms_data, ms_folder, sirius_folder, shards=shards, cores=cores,
+        cost_model=CostModel("sirius_formula")
+    )
     print("SIRIUS processing complete")
 
     # 5. Run MS-FINDER processing.
     print("MS-FINDER processing start")
-    modify_msfinder_config_in_place(msfinder_method_path, config)
-    run_msfinder(msfinder_directory, msp_folder, msfinder_folder, msfinder_method_path)
+    msfinder_method_file = render_msfinder_parameters(msfinder_method_path, config)
+    run_msfinder_parts(
+        lambda input_folder, output_folder, total: run_msfinder(
+            msfinder_directory, input_folder, output_folder, msfinder_method_file, config.get('supervisor'), total
+        ),
+        msp_parts, msfinder_folder, msfinder_cost_model
+    )
     print("MS-FINDER processing complete")
 
     # 6. Run Msbuddy processing.
     print("msbuddy processing start")
-    run_msbuddy(mgf_folder, buddy_folder, config)
+    run_msbuddy(buddy_spectra, buddy_folder, config)
     print("msbuddy processing complete")
 
     # 7. Generate summary output.
-    summary_score_df, summary_output = creating_output_summary(
-        input_msp_path, sirius_folder, msfinder_file_path, buddy_folder, model_dir, top_n = 100, summary_n=config['formula_prediction']['msemblator_output_records']
+    # Keep the tool candidates so the run can be re-scored with rescore.py.
+    candidates = collect_formula_candidates(input_msp_path, sirius_folder, msfinder_file_path, buddy_folder, model_dir, top_n = 100)
+    save_candidate_cache(summary_output_dir, "formula", candidates, name_df, top_n = 100)
+    # Score and write the output files batch by batch, restoring the original spectrum names.
+    (summary_path, score_path), formula_fix = write_formula_results(
+        candidates, name_df, summary_output_dir, model_dir, config, top_n = 100
     )
-
-    summary_score_df = pd.merge(name_df, summary_score_df, left_on = "Updated_NAME", right_on = "filename")
-    summary_score_df.drop(columns=["Updated_NAME", "filename"], inplace=True)
-    summary_score_df.rename(columns={"Original_NAME":"filename"},inplace=True)
-    
-    formula_fix = summary_output
-    summary_output = pd.merge(name_df, summary_output, left_on = "Updated_NAME", right_on = "filename")
-    summary_output.drop(columns=["Updated_NAME", "filename"], inplace=True)
-    summary_output.rename(columns={"Original_NAME": "filename", "formula": "Top_score_formula"}, inplace=True)
-
-    # Save summary output files.
-    summary_file = "formula_summary.csv"
-    score_file = "formula_score.csv"
-    unique_summary_file = generate_unique_filename(summary_output_dir, summary_file)
-    unique_score_file = generate_unique_filename(summary_output_dir, score_file)
-    summary_output.to_csv(os.path.join(summary_output_dir, unique_summary_file), index=False)
-    summary_score_df.to_csv(os.path.join(summary_output_dir, unique_score_file), index=False)
+    print(f"Saved {summary_path} and {score_path}")
 
     # Display processing time.
     end = time.time()
     time_diff = end - start
     print(f"Processing completed in {time_diff} seconds.")
 
-    # Return the summary_score_df DataFrame.
+    # Return the top-scored formula of every spectrum.
     return formula_fix
\ No newline at end of file
@@ -3,7 +3,6 @@ import pandas as pd
 from formula_main import formula_elucidation
 from struc_main import structure_elucidation
 from msp_format_change import msp_formula_changer, convert_name_to_peakid, save_updated_msp, modify_msp_data_type
-from struc_score_normalization import ClippingTransformer
 
 def main():
     # Prompt for basic inputs.
@@ -1,14 +1,18 @@
 import os
+import io
 import csv
 import logging
 from tqdm import tqdm
 from functools import lru_cache
-from concurrent.futures import ProcessPoolExecutor
 from collections import defaultdict
 from chem_data import formula_to_dict, calc_exact_mass
+from struc_utility import save_files
 
 logging.basicConfig(level=logging.ERROR)
 
+# Rendered files are written every _SPECTRA_PER_WRITE spectra to bound memory use
+_SPECTRA_PER_WRITE = 2000
+
 # Cache formula mass calculations to avoid redundant work
 @lru_cache(maxsize=None)
 def safe_calc_exact_mass(formula):
@@ -38,70 +42,81 @@ def load_library(library_path):
     return headers, index
 
 
-def process_spectrum(spectrum, parameter_file, output_dir, library):
-    """Process one spectrum: write peak list, filtered library, and parameter file."""
+# Parameter lines replaced per spectrum: (line prefix, case-insensitive, spectrum value)
+_PARAMETER_FIELDS = [
+    ("neutralprecursormolecularformula", True, lambda s: f"NeutralPrecursorMolecularFormula = {s.get('FORMULA', '')}\n"),
+    ("neutralprecursormass", True, lambda s: f"NeutralPrecursorMass = {s.get('NeutralPrecursorMass', '')}\n"),
+    ("precursorionmode", True, lambda s: f"PrecursorIonMode = {s['PrecursorIonMode']}\n"),
+    ("ispositiveionmode", True, lambda s: f"IsPositiveIonMode = {s['IsPositiveIonMode']}\n"),
+    ("peaklistpath", True, lambda s: f"PeakListPath = {s['PeakListPath']}_peaklist.txt\n"),
+    ("SampleName", False, lambda s: f"SampleName = {s['PeakListPath']}\n"),
+    ("LocalDatabasePath", False, lambda s: f"LocalDatabasePath = {s['PeakListPath']}_library.txt\n"),
+]
+
+
+def compile_parameter_template(parameter_file):
+    """
+    Read the MetFrag parameter template once and return a function rendering it for a spectrum.
+
+    Every template line is either copied as is or replaced by the spectrum
+    value of the first matching entry of _PARAMETER_FIELDS.
+    """
+    with open(parameter_file, "r") as f:
+        params = f.readlines()
+
+    parts = []
+    for line in params:
+        lower = line.lower()
+        field = next(
+            (render for prefix, ignore_case, render in _PARAMETER_FIELDS
+             if (lower if ignore_case else line).startswith(prefix)),
+            None
+        )
+        parts.append(field if field is not None else line)
+
+    def render(spectrum):
+        return "".join(part(spectrum) if callable(part) else part for part in parts)
+
+    return render
+
+
+def process_spectrum(spectrum, render_parameters, output_dir, library):
+    """Render the peak list, filtered library, and parameter file of one spectrum as (path, content) pairs."""
+    files = []
     try:
-        # Write peak list file
+        # Peak list file
         if "PeakListPath" in spectrum and "m/z" in spectrum:
             peak_list_file = os.path.join(output_dir, f"{spectrum['PeakListPath']}_peaklist.txt")
-            with open(peak_list_file, "w") as f:
-                f.write("\n".join(spectrum["m/z"]))
+            files.append((peak_list_file, "\n".join(spectrum["m/z"])))
 
-        # Write filtered library
+        # Filtered library
         if "FORMULA" in spectrum:
             filtered = filtering_library_by_formula_index(library, spectrum.get("FORMULA"))
             library_file = os.path.join(output_dir, f"{spectrum['PeakListPath']}_library.txt")
-            with open(library_file, "w") as f:
-                writer = csv.writer(f, delimiter="|")
-                writer.writerows(filtered)
-
-        # Write parameter file
-        with open(parameter_file, "r") as f:
-            params = f.readlines()
+            buffer = io.StringIO()
+            csv.writer(buffer, delimiter="|").writerows(filtered)
+            files.append((library_file, buffer.getvalue()))
 
+        # Parameter file
         param_output_file = os.path.join(output_dir, f"parameter_{spectrum['PeakListPath']}.txt")
-        with open(param_output_file, "w") as f:
-            for line in params:
-                lower = line.lower()
-                if lower.startswith("neutralprecursormolecularformula"):
-                    line = f"NeutralPrecursorMolecularFormula = {spectrum.get('FORMULA', '')}\n"
-                elif lower.startswith("neutralprecursormass"):
-                    line = f"NeutralPrecursorMass = {spectrum.get('NeutralPrecursorMass', '')}\n"
-                elif lower.startswith("precursorionmode"):
-                    line = f"PrecursorIonMode = {spectrum['PrecursorIonMode']}\n"
-                elif lower.startswith("ispositiveionmode"):
-                    line = f"IsPositiveIonMode = {spectrum['IsPositiveIonMode']}\n"
-                elif lower.startswith("peaklistpath"):
-                    line = f"PeakListPath = {spectrum['PeakListPath']}_peaklist.txt\n"
-                elif line.startswith("SampleName"):
-                    line = f"SampleName = {spectrum['PeakListPath']}\n"
-                elif line.startswith("LocalDatabasePath"):
-                    line = f"LocalDatabasePath = {spectrum['PeakListPath']}_library.txt\n"
-                f.write(line)
+        files.append((param_output_file, render_parameters(spectrum)))
 
     except Exception as e:
         logging.error(f"Error processing spectrum {spectrum.get('PeakListPath', 'Unknown')}: {e}")
+    return files
 
 
-# Wrapper for multiprocessing (must be top-level, not lambda)
-def process_wrapper(args):
-    spectrum, parameter_file, output_dir, library = args
-    return process_spectrum(spectrum, parameter_file, output_dir, library)
-
-
-def creat_metfrag_file(msp_file, parameter_file, output_dir, library_path):
-    """Main function: parse MSP, load library once, and process spectra in parallel."""
-    spectra = []
+def read_metfrag_spectra(msp_file):
+    """Parse the MSP file line by line, yielding the MetFrag fields of one spectrum at a time."""
     spectrum = {}
     is_in_peaks = False
 
-    # Parse MSP file line by line 
     with open(msp_file, "r") as f:
-        for line in tqdm(f, desc="Reading MSP file lines", unit="line"):
+        for line in f:
             stripped_line = line.strip().lower()
             if not stripped_line:
                 if spectrum:
-                    spectra.append(spectrum)
+                    yield spectrum
                     spectrum = {}
                     is_in_peaks = False
             elif "name:" in stripped_line:
@@ -122,20 +137,22 @@ def creat_metfrag_file(msp_file, parameter_file, output_dir, library_path):
             elif is_in_peaks:
                 spectrum.setdefault("m/z", []).append(line.strip())
         if spectrum:
-            spectra.append(spectrum)
+            yield spectrum
 
-    # Load library once
-    library = load_library(library_path)
-
-    # Prepare arguments for parallel processing
-    tasks = [(s, parameter_file, output_dir, library) for s in spectra]
-
-    # Process spectra in parallel
-    with ProcessPoolExecutor() as executor:
-        list(tqdm(
-            executor.map(process_wrapper, tasks),
-            total=len(spectra),
-            desc="Processing spectra",
-            unit="spectrum"
-        ))
 
+def creat_metfrag_file(msp_file, parameter_file, output_dir, library_path, writer_workers=1):
+    """
+    Main function: load library and parameter template once, then stream the MSP spectra
+    and write their MetFrag input files every _SPECTRA_PER_WRITE spectra
+    (with writer_workers threads, see struc_utility.save_files).
+    """
+    library = load_library(library_path)
+    render_parameters = compile_parameter_template(parameter_file)
+
+    files = []
+    for count, spectrum in enumerate(tqdm(read_metfrag_spectra(msp_file), desc="Processing spectra", unit="spectrum"), 1):
+        files.extend(process_spectrum(spectrum, render_parameters, output_dir, library))
+        if count % _SPECTRA_PER_WRITE == 0:
+            save_files(files, workers=writer_workers)
+            files = []
+    save_files(files, workers=writer_workers)
@@ -1,8 +1,8 @@
-import subprocess
 import os
 import glob
 import csv
 from tqdm import tqdm
+from tool_supervisor import run_supervised
 
 def clean_psv_file(psv_file):
     """
@@ -34,12 +34,16 @@ def clean_psv_file(psv_file):
 
     print(f"Cleaned PSV file: {psv_file}")
 
-def run_metfrag_command(metfrag_dir):
+def run_metfrag_command(metfrag_dir, supervisor=None):
     """
     Runs MetFrag for each parameter file in the specified directory.
 
+    The MetFrag output goes to the metfrag tool log only; a hung MetFrag process
+    is killed and retried according to the supervisor settings.
+
     Args:
         metfrag_dir (str): Directory containing the MetFrag JAR file and parameter files.
+        supervisor (dict, optional): 'supervisor' section of the parameter file.
 
     Returns:
         None
@@ -55,23 +59,21 @@ def run_metfrag_command(metfrag_dir):
     for psv_file in psv_files:
         clean_psv_file(psv_file)
 
+    # MetFrag output is not echoed to the console; it is kept in the tool log
+    supervisor = dict(supervisor or {}, echo=False)
+
     # Run MetFrag for each parameter file
     with tqdm(total=len(parameter_files), desc="MetFrag Processing", unit="file") as pbar:
         for parameter_file in parameter_files:
             cmd = ["java", "-jar", metfrag_jar, parameter_file]
 
             try:
-                with subprocess.Popen(
-                    cmd,
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True,
-                    cwd=metfrag_dir
-                ) as proc:
-                    stdout, stderr = proc.communicate()
-                    # Handle errors and warnings
-                    if proc.returncode != 0:
-                        print(f"Error processing {parameter_file}:\n{stderr}")
+                returncode = run_supervised(cmd, "metfrag", supervisor, total=1, cwd=metfrag_dir)
+                # Handle errors and timeouts
+                if returncode is None:
+                    print(f"MetFrag timed out for {parameter_file}")
+                elif returncode != 0:
+                    print(f"Error processing {parameter_file} (exit code {returncode}), see the metfrag log")
 
             except Exception as e:
                 print(f"Exception occurred while running MetFrag for {parameter_file}: {e}")
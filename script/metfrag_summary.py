@@ -1,10 +1,10 @@
 import os
 import glob
 import pandas as pd
-import joblib
 from functools import reduce
 from convert_struc_data_type import normalize_rank_score
-from struc_score_normalization import ClippingTransformer
+from struc_score_normalization import load_score_normalizer
+from summary_utility import read_top_n_rows, pivot_top_candidates, assign_spectrum_id
 
 def process_metfrag_output(metfrag_folder, machine_dir, name_adduct_df, 
                           summary_inchikey_df, summary_smiles_df, 
@@ -16,7 +16,7 @@ def process_metfrag_output(metfrag_folder, machine_dir, name_adduct_df,
     Parameters:
         metfrag_folder (str): Directory containing MetFrag output files.
         machine_dir (str): Directory containing score normalization pipelines.
-        name_adduct_df (pd.DataFrame): DataFrame mapping filenames to adducts.
+        name_adduct_df (pd.DataFrame): DataFrame mapping spectrum IDs to adducts.
         summary_inchikey_df (pd.DataFrame): Existing InChIKey summary DataFrame.
         summary_smiles_df (pd.DataFrame): Existing SMILES summary DataFrame.
         class_summary_df (pd.DataFrame): Existing classification summary DataFrame.
@@ -35,8 +35,8 @@ def process_metfrag_output(metfrag_folder, machine_dir, name_adduct_df,
     data_frames = []
     for file in file_paths:
         try:
-            df = pd.read_excel(file, engine='xlrd')
-            df["filename"] = os.path.basename(file).split(".")[0]  # Extract filename without extension
+            df = read_top_n_rows(file, top_n, reader=pd.read_excel, engine='xlrd')
+            df = assign_spectrum_id(df, [os.path.basename(file)] * len(df))
             data_frames.append(df)
         except Exception as e:
             print(f"Error reading {file}: {e}")
@@ -49,7 +49,7 @@ def process_metfrag_output(metfrag_folder, machine_dir, name_adduct_df,
     combined_data = pd.concat(data_frames, ignore_index=True)
 
     # Assign rank
-    combined_data["rank"] = combined_data.groupby("filename").cumcount() + 1
+    combined_data["rank"] = combined_data.groupby("spectrum_id").cumcount() + 1
 
     # Determine score column
     score_column = "Score" if "Score" in combined_data.columns else "Total score"
@@ -63,56 +63,47 @@ def process_metfrag_output(metfrag_folder, machine_dir, name_adduct_df,
     combined_data["Score_Difference"] = combined_data["Score_Difference"].fillna(0)
 
     # Select top 3 ranked candidates
-    filtered_df = combined_data.groupby('filename').head(top_n).copy()
+    filtered_df = combined_data.groupby('spectrum_id').head(top_n).copy()
     filtered_df = filtered_df.fillna('')
 
     # Load score normalization pipelines
     metfrag_score_pipeline_path = os.path.join(machine_dir, "pipeline_metfrag_score.pkl")
     metfrag_SD_pipeline_path = os.path.join(machine_dir, "pipeline_metfrag_score_diff.pkl")
 
-    score_pipeline = joblib.load(metfrag_score_pipeline_path)
-    SD_pipeline = joblib.load(metfrag_SD_pipeline_path)
+    score_normalizer = load_score_normalizer(metfrag_score_pipeline_path)
+    SD_normalizer = load_score_normalizer(metfrag_SD_pipeline_path)
 
     # Normalize scores
-    filtered_df["normalization_Zscore"] = score_pipeline.transform(filtered_df[[score_column]])
-    filtered_df["normalization_z_score_diff"] = SD_pipeline.transform(filtered_df[["Score_Difference"]])
+    filtered_df["normalization_Zscore"] = score_normalizer(filtered_df[score_column])
+    filtered_df["normalization_z_score_diff"] = SD_normalizer(filtered_df["Score_Difference"])
 
     # Prepare score calculation DataFrame
-    metfrag_score_calc_df = filtered_df[["filename", "rank", "SMILES", "normalization_Zscore", "normalization_z_score_diff"]].copy()
+    metfrag_score_calc_df = filtered_df[["spectrum_id", "rank", "SMILES", "normalization_Zscore", "normalization_z_score_diff"]].copy()
     metfrag_score_calc_df["tool_name"] = "metfrag"
-    metfrag_score_calc_df["Used_tools"] = metfrag_score_calc_df["rank"].apply(lambda r: f"MetFrag_Rank:{r}")
 
     # Apply rank normalization function
     normalize_rank_score(metfrag_score_calc_df)
 
     # Merge with adduct information
-    metfrag_score_calc_df = metfrag_score_calc_df.merge(name_adduct_df, on="filename", how="outer")
+    metfrag_score_calc_df = metfrag_score_calc_df.merge(name_adduct_df, on="spectrum_id", how="outer")
 
-    # Convert filenames
-    filtered_df["filename"] = filtered_df["filename"].apply(lambda x: x.split('.')[0] if isinstance(x, str) else None)
     filtered_df['rank'] = filtered_df['rank'].astype(int)
-    top5_smiles_df = filtered_df[filtered_df['rank'] <= 5]
-    filtered_df = filtered_df.astype(str).fillna('')
 
-    # Pivot InChIKey and SMILES data
-    inchikey_pivot = filtered_df.pivot(index=["filename"], columns=["rank"], values=["InChIKey"])
-    smiles_pivot = top5_smiles_df.pivot(index=["filename"], columns=["rank"], values=["SMILES"])
-
-    inchikey_pivot.columns = [f'metfrag_structure_{col[1]}' for col in inchikey_pivot.columns.values]
-    smiles_pivot.columns = [f'metfrag_structure_{col[1]}' for col in smiles_pivot.columns.values]
+    # Pivot InChIKey and SMILES data in a single reshape
+    wide_tables = pivot_top_candidates(filtered_df, ["InChIKey", "SMILES"], "metfrag_structure")
 
     # Merge InChIKey data
-    metfrag_inchikey_df = summary_inchikey_df.merge(inchikey_pivot.reset_index(), on=["filename"], how="outer")
+    metfrag_inchikey_df = summary_inchikey_df.join(wide_tables["InChIKey"], on="spectrum_id")
 
     # Merge SMILES data
-    metfrag_smiles_df = summary_smiles_df.merge(smiles_pivot.reset_index(), on=["filename"], how="outer")
+    metfrag_smiles_df = summary_smiles_df.join(wide_tables["SMILES"], on="spectrum_id")
 
     # Extract classification data (only rank 1)
-    metfrag_class_data = filtered_df[filtered_df['rank'] == '1'][['filename', 'InChIKey', 'SMILES']]
+    metfrag_class_data = filtered_df.loc[filtered_df['rank'] == 1, ['spectrum_id', 'InChIKey', 'SMILES']].astype({'InChIKey': str, 'SMILES': str})
     metfrag_class_data = metfrag_class_data[(metfrag_class_data['InChIKey'].str.strip() != '') & 
                                             (metfrag_class_data['SMILES'].str.strip() != '')]
     metfrag_class_data['tool_name'] = "MetFrag"
-    metfrag_class_data.columns = ['filename', 'InChIKey', 'SMILES', 'tool_name']
+    metfrag_class_data.columns = ['spectrum_id', 'InChIKey', 'SMILES', 'tool_name']
 
     # Append new classification data
     class_summary_df = pd.concat([class_summary_df, metfrag_class_data], ignore_index=True)
@@ -1,9 +1,9 @@
 import os
 import glob
 import pandas as pd
-import joblib
-from converting_data_type import ClippingTransformer
+from struc_score_normalization import load_score_normalizer
 from convert_struc_data_type import normalize_rank_score
+from summary_utility import read_grouped_top_n, pivot_top_candidates, assign_spectrum_id
 
 def process_buddy_summary(buddy_folder, machine_dir, name_adduct_df, summary_df, score_df, top_n = 5):
     folder = os.path.join(buddy_folder,"detailed_summary_*.csv")
@@ -12,9 +12,12 @@ def process_buddy_summary(buddy_folder, machine_dir, name_adduct_df, summary_df,
         print(f"No Buddy files found in {buddy_folder}")
         return summary_df, score_df
     
-    buddy_result = pd.concat([pd.read_csv(file) for file in buddy_files], ignore_index=True)
-    buddy_result['Scan_ID'] = buddy_result['Scan_ID'].astype(str)
-    buddy_result.rename(columns={"Formula": "formula", "Scan_ID": "filename"}, inplace=True)
+    buddy_result = pd.concat(
+        [read_grouped_top_n(file, "Scan_ID", top_n, rank_column="Rank", reader=pd.read_csv) for file in buddy_files],
+        ignore_index=True
+    )
+    buddy_result = assign_spectrum_id(buddy_result, buddy_result['Scan_ID'])
+    buddy_result.rename(columns={"Formula": "formula"}, inplace=True)
     buddy_result["Estimated_FDR_2"] = 1 - buddy_result["Estimated_FDR"]
     buddy_result["score_diff"] = 0  
     
@@ -23,43 +26,32 @@ def process_buddy_summary(buddy_folder, machine_dir, name_adduct_df, summary_df,
         buddy_result["Estimated_FDR_2"] - buddy_result["Estimated_FDR_2"].shift(-1)
     )
     
-    filtered_df = buddy_result[["filename", "Rank", "formula", "Estimated_FDR_2", "score_diff"]]
+    filtered_df = buddy_result[["spectrum_id", "Rank", "formula", "Estimated_FDR_2", "score_diff"]]
     filtered_df = filtered_df[filtered_df["Rank"] <= top_n]
     
     buddy_score_pipeline_path = os.path.join(machine_dir, "pipline_buddy_score.pkl")
     buddy_SD_pipeline_path = os.path.join(machine_dir, "pipline_buddy_score_diff.pkl")
     
-    score_pipeline = joblib.load(buddy_score_pipeline_path)
-    SD_pipeline = joblib.load(buddy_SD_pipeline_path)
+    score_normalizer = load_score_normalizer(buddy_score_pipeline_path)
+    SD_normalizer = load_score_normalizer(buddy_SD_pipeline_path)
     
-    filtered_df["Score_NZ"] = score_pipeline.transform(filtered_df[["Estimated_FDR_2"]])
-    filtered_df["Score_NZ_diff"] = SD_pipeline.transform(filtered_df[["score_diff"]])
+    filtered_df["Score_NZ"] = score_normalizer(filtered_df["Estimated_FDR_2"])
+    filtered_df["Score_NZ_diff"] = SD_normalizer(filtered_df["score_diff"])
     filtered_df.rename(columns={"Rank": "rank"}, inplace=True)
     
     filtered_df["adduct"] = ""
-    filtered_df['adduct'] = filtered_df['filename'].map(name_adduct_df.set_index('filename')['adduct'])
+    filtered_df['adduct'] = filtered_df['spectrum_id'].map(name_adduct_df.set_index('spectrum_id')['adduct'])
     
-    buddy_score_calc_df = filtered_df[["filename", "adduct", "rank", "formula", "Score_NZ", "Score_NZ_diff"]]
+    buddy_score_calc_df = filtered_df[["spectrum_id", "adduct", "rank", "formula", "Score_NZ", "Score_NZ_diff"]]
     buddy_score_calc_df["tool_name"] = "buddy"
-    buddy_score_calc_df['Used_tools'] = buddy_score_calc_df["rank"].apply(lambda r: f"msbuddy_Rank:{r}")
     
-    buddy_score_calc_df['adduct'] = buddy_score_calc_df['filename'].map(name_adduct_df.set_index('filename')['adduct'])
+    buddy_score_calc_df['adduct'] = buddy_score_calc_df['spectrum_id'].map(name_adduct_df.set_index('spectrum_id')['adduct'])
     normalize_rank_score(buddy_score_calc_df)
     
-    filtered_df = filtered_df.astype(str).fillna('')
-    filtered_df = filtered_df.drop_duplicates(subset=["filename", "rank"])
+    # Spread the top 5 formulas into buddy_formula_1..5 columns
     filtered_df["rank"] = filtered_df["rank"].astype(int)
-    top5_formula_df = filtered_df[filtered_df['rank'] <= 5]
-    
-    formula_pivot = top5_formula_df[["filename", "adduct", "rank", "formula"]].pivot(
-        index=["filename"], 
-        columns=["rank"], 
-        values=["formula"]
-    )
-    
-    formula_pivot.columns = [f'buddy_formula_{col[1]}' for col in formula_pivot.columns.values]
-    pivot = formula_pivot.reset_index()
-    buddy_formula_df = summary_df.merge(pivot, on=["filename"], how="outer")
+    formula_pivot = pivot_top_candidates(filtered_df, ["formula"], "buddy_formula")["formula"]
+    buddy_formula_df = summary_df.join(formula_pivot, on="spectrum_id")
     
     score_df = pd.concat([score_df, buddy_score_calc_df], ignore_index=True)
     
@@ -1,10 +1,12 @@
 import os
 import argparse
+import yaml
 import pandas as pd
 from formula_main import formula_elucidation
 from struc_main import structure_elucidation
 from msp_format_change import msp_formula_changer, convert_name_to_peakid, save_updated_msp, modify_msp_data_type
-from struc_score_normalization import ClippingTransformer
+from peak_preprocessing import preprocess_msp, preprocessing_settings
+from spectrum_dedup import deduplicate_spectra, dedup_settings, write_duplicate_table
 import sys
 
 
@@ -34,6 +36,15 @@ def main():
             os.makedirs(folder)
     original_data = modify_msp_data_type(input_msp_path)
     updated_data, name_df = convert_name_to_peakid(original_data)
+    with open(os.path.join(current_dir, "msemblator_parameter_file.yaml"), 'r') as file:
+        config = yaml.safe_load(file)
+    # Clean the peak lists once, before every tool input is written from id_change.msp
+    if preprocessing_settings(config.get('peak_preprocessing'))['enabled']:
+        updated_data = preprocess_msp(updated_data, config.get('peak_preprocessing'))
+    # Annotate one representative of repeated spectra; results are written for every duplicate
+    if dedup_settings(config.get('deduplication'))['enabled']:
+        updated_data, name_df = deduplicate_spectra(updated_data, name_df, config.get('deduplication'))
+        print(f"Saved {write_duplicate_table(name_df, output_dir)}")
     save_updated_msp(converted_msp_path, updated_data)
 
     if args.mode == 1:
@@ -1,8 +1,9 @@
-import subprocess
 import os 
 import sys
+from tool_supervisor import run_supervised
+from msfinder_parallel import part_log_name, stuck_spectrum_retry
 
-def run_msfinder(msfinder_directory, input_path, output_path, method_path):
+def run_msfinder(msfinder_directory, input_path, output_path, method_path, supervisor=None, total=None):
     msfinder_exe = os.path.join(msfinder_directory, "MsfinderConsoleApp.exe")
     if not os.path.exists(msfinder_exe):
         print(f"Error: Executable not found at {msfinder_exe}")
@@ -18,13 +19,14 @@ def run_msfinder(msfinder_directory, input_path, output_path, method_path):
     ]
 
     try:
-        with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1) as proc:
-            for line in proc.stdout:
-                print(line, end="")
-            proc.wait()
+        return run_supervised(
+            command, part_log_name("msfinder_formula", output_path), supervisor, total=total,
+            retry_command=stuck_spectrum_retry(command, input_path)
+        )
 
     except Exception as e:
         print(f"An error occurred during SIRIUS execution: {e}")
+        return None
 
 
 
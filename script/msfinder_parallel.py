@@ -0,0 +1,194 @@
+import os
+import time
+import shutil
+import logging
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from scheduler import SpectrumCost, default_cost, lpt_bins
+from struc_utility import save_files
+
+# Input and output subfolders of parallel MS-FINDER processes are named part_00, part_01, ...
+PART_PREFIX = "part_"
+
+# Input folder of one MS-FINDER process with the file names (without .msp) and costs of its spectra
+MspPart = namedtuple("MspPart", ["folder", "names", "costs"])
+
+
+def msp_entry_cost(content):
+    """
+    Cost description (precursor m/z, peak count, adduct) of one per-spectrum MSP file.
+    """
+    precursor_mz = 0.0
+    adduct = ""
+    peaks = 0
+    in_peaks = False
+    for line in content.splitlines():
+        key, _, value = line.partition(":")
+        key = key.strip().casefold()
+        if in_peaks:
+            if line.strip():
+                peaks += 1
+        elif key == "precursormz":
+            try:
+                precursor_mz = float(value)
+            except ValueError:
+                precursor_mz = 0.0
+        elif key == "precursortype":
+            adduct = value.strip()
+        elif key == "num peaks":
+            in_peaks = True
+    return SpectrumCost(precursor_mz, peaks, adduct)
+
+
+def write_msp_parts(split_data, msp_folder, processes=1, cost_model=None, writer_workers=1):
+    """
+    Write the per-spectrum MSP files of read_msp, split over one input folder per MS-FINDER process.
+
+    With one process the files are written to msp_folder as before. Otherwise
+    they are distributed over msp_folder/part_<i> with balanced expected
+    runtime (scheduler.lpt_bins).
+
+    Args:
+        split_data (dict): File name -> MSP content, from splitting_msp.read_msp.
+        msp_folder (str): MS-FINDER input folder.
+        processes (int): Number of MS-FINDER processes.
+        cost_model (scheduler.CostModel, optional): Runtime model of the MS-FINDER step.
+        writer_workers (int): Threads writing the files (see struc_utility.save_files).
+
+    Returns:
+        list: MspPart of every part.
+    """
+    names = list(split_data)
+    costs = [msp_entry_cost(split_data[name]) for name in names]
+    if processes <= 1 or len(names) <= 1:
+        parts = [(msp_folder, list(range(len(names))))]
+    else:
+        expected = cost_model.predict(costs) if cost_model is not None else default_cost(costs)
+        parts = [
+            (os.path.join(msp_folder, f"{PART_PREFIX}{part:02d}"), indices)
+            for part, indices in enumerate(lpt_bins(expected, processes))
+        ]
+
+    msp_parts = []
+    files = []
+    for folder, indices in parts:
+        os.makedirs(folder, exist_ok=True)
+        files.extend((os.path.join(folder, f"{names[i]}.msp"), split_data[names[i]]) for i in indices)
+        msp_parts.append(MspPart(folder, [names[i] for i in indices], [costs[i] for i in indices]))
+    save_files(files, workers=writer_workers)
+    return msp_parts
+
+
+def filter_msp_parts(msp_parts, removed_names):
+    """Drop the spectra in removed_names from the parts, and parts left without spectra."""
+    filtered = []
+    for part in msp_parts:
+        keep = [i for i, name in enumerate(part.names) if name not in removed_names]
+        if keep:
+            filtered.append(MspPart(part.folder, [part.names[i] for i in keep], [part.costs[i] for i in keep]))
+    return filtered
+
+
+def part_log_name(tool, output_folder):
+    """Log name of an MS-FINDER run, e.g. 'msfinder_formula' or 'msfinder_formula_part_01' for a part."""
+    folder = os.path.basename(os.path.normpath(output_folder))
+    return f"{tool}_{folder}" if folder.startswith(PART_PREFIX) else tool
+
+
+def stuck_spectrum_retry(command, input_folder):
+    """
+    retry_command for tool_supervisor.run_supervised of an MS-FINDER run.
+
+    MS-FINDER writes its result table only when the run ends, so a killed
+    run is started again on its input folder. Before that, the first
+    spectrum (in file name order) without a file next to its .msp written
+    since the killed attempt started (e.g. its .fgt) is taken as the one
+    MS-FINDER got stuck on and moved to input_folder/timed_out.
+
+    Args:
+        command (list): MS-FINDER command line.
+        input_folder (str): MS-FINDER input folder of the run.
+
+    Returns:
+        callable: retry_command(started) returning the command of the next
+            attempt, None if no spectrum is left.
+    """
+    skipped_folder = os.path.join(input_folder, "timed_out")
+
+    def retry_command(started):
+        names = sorted(name[:-len(".msp")] for name in os.listdir(input_folder) if name.endswith(".msp"))
+        written = {
+            os.path.splitext(entry.name)[0] for entry in os.scandir(input_folder)
+            if not entry.name.endswith(".msp") and entry.stat().st_mtime >= started
+        }
+        unfinished = [name for name in names if name not in written]
+        if not unfinished:
+            return None
+        logging.warning(
+            f"MS-FINDER timed out on {input_folder}: {len(names) - len(unfinished)} of {len(names)} spectra done, "
+            f"skipping spectrum {unfinished[0]}"
+        )
+        os.makedirs(skipped_folder, exist_ok=True)
+        for suffix in (".msp", ".fgt"):
+            source = os.path.join(input_folder, unfinished[0] + suffix)
+            if os.path.exists(source):
+                shutil.move(source, os.path.join(skipped_folder, unfinished[0] + suffix))
+        return command if len(names) > 1 else None
+
+    return retry_command
+
+
+def merge_part_outputs(output_folder, part_output_dirs):
+    """
+    Move the result files of every part output folder into output_folder.
+
+    A '_part_<i>' suffix is added to each file name, so 'Formula*.txt' and
+    'Structure result*.txt' still match and the files of different parts do
+    not overwrite each other. The emptied part folders are removed.
+    """
+    for part, part_dir in enumerate(part_output_dirs):
+        for name in os.listdir(part_dir):
+            stem, ext = os.path.splitext(name)
+            shutil.move(os.path.join(part_dir, name), os.path.join(output_folder, f"{stem}_{PART_PREFIX}{part:02d}{ext}"))
+        shutil.rmtree(part_dir, ignore_errors=True)
+
+
+def run_msfinder_parts(run_part, msp_parts, output_folder, cost_model=None):
+    """
+    Run one MS-FINDER process per input part concurrently and merge their outputs.
+
+    Args:
+        run_part (callable): run_part(input_folder, output_folder, total) runs one
+            MS-FINDER process on total spectra and returns its exit code (None if it
+            was killed), e.g. a lambda calling run_msfinder.
+        msp_parts (list): MspPart list from write_msp_parts or filter_msp_parts.
+        output_folder (str): MS-FINDER output folder read by the summaries.
+        cost_model (scheduler.CostModel, optional): Records the runtime of every part
+            that exits with code 0.
+    """
+    def timed_run(input_folder, part_output_dir, costs):
+        start = time.time()
+        returncode = run_part(input_folder, part_output_dir, len(costs))
+        # Killed or failed runs would teach the model timeouts instead of runtimes
+        if cost_model is not None and returncode == 0:
+            cost_model.record(costs, time.time() - start)
+
+    if not msp_parts:
+        return
+    if len(msp_parts) == 1:
+        timed_run(msp_parts[0].folder, output_folder, msp_parts[0].costs)
+    else:
+        jobs = []
+        for part, (input_folder, _, costs) in enumerate(msp_parts):
+            part_output_dir = os.path.join(output_folder, f"{PART_PREFIX}{part:02d}")
+            os.makedirs(part_output_dir, exist_ok=True)
+            jobs.append((input_folder, part_output_dir, costs))
+            logging.info(f"MS-FINDER part {part}: {len(costs)} spectra")
+        with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            futures = [executor.submit(timed_run, *job) for job in jobs]
+            for future in futures:
+                future.result()
+        merge_part_outputs(output_folder, [part_output_dir for _, part_output_dir, _ in jobs])
+
+    if cost_model is not None:
+        cost_model.save()
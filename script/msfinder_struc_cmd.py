@@ -1,14 +1,18 @@
-import subprocess
 import os
 import sys
-from convert_struc_data_type import modify_msfinder_config_in_place
+import shutil
+from convert_struc_data_type import render_msfinder_parameters
+from tool_supervisor import run_supervised
+from msfinder_parallel import part_log_name, stuck_spectrum_retry
 from pathlib import Path
 import re
+from concurrent.futures import ProcessPoolExecutor
 
-def run_msfinder(msfinder_directory, input_path, output_path, method_path, library_path, config):
+def run_msfinder(msfinder_directory, input_path, output_path, method_path, library_path, config,
+                 log_name="msfinder_structure", total=None):
 
-    # Modify config before running
-    modify_msfinder_config_in_place(method_path, library_path, config)
+    # Render the method file for this config (reused if it is already rendered)
+    method_path = render_msfinder_parameters(method_path, library_path, config)
 
     # Full path to MSFinder executable
     msfinder_exe = os.path.join(msfinder_directory, "MsfinderConsoleApp.exe")
@@ -27,65 +31,141 @@ def run_msfinder(msfinder_directory, input_path, output_path, method_path, libra
     ]
 
     try:
-        with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1) as proc:
-            for line in proc.stdout:
-                print(line, end="")
-            proc.wait()
+        return run_supervised(
+            command, part_log_name(log_name, output_path), config.get('supervisor'), total=total,
+            retry_command=stuck_spectrum_retry(command, input_path)
+        )
 
     except Exception as e:
         print(f"An error occurred during MS-FINDER execution: {e}")
+        return None
+
+# Patterns of the MSP/FGT scans, compiled once
+_ENTRY_SEPARATOR = re.compile(r"\r?\n\r?\n+")
+_FORMULA_LINE = re.compile(r"(?m)^FORMULA:\s*(.+?)\s*$")
+_NAME_LINE = re.compile(r"(?m)^NAME:")
 
 def extract_formulas_from_msp(msp_path):
     msp_path = Path(msp_path)
     txt = msp_path.read_text(encoding="utf-8", errors="ignore").strip()
-    entries = re.split(r"\r?\n\r?\n+", txt) if txt else []
+    entries = _ENTRY_SEPARATOR.split(txt) if txt else []
     formulas = set()
 
     for ent in entries:
-        m = re.search(r"(?m)^FORMULA:\s*(.+?)\s*$", ent)
+        m = _FORMULA_LINE.search(ent)
         if m:
             formulas.add(m.group(1).strip())
 
     return formulas
 
-def parse_fgt_records(fgt_path):
-    fgt_path = Path(fgt_path)
-    txt = fgt_path.read_text(encoding="utf-8", errors="ignore")
-    m = re.search(r"(?m)^NAME:", txt)
-    if not m:
-        return "", []  
+def _split_fgt_records(txt):
+    # One scan for the NAME: lines; everything before the first one is the header
+    starts = [m.start() for m in _NAME_LINE.finditer(txt)]
+    if not starts:
+        return "", []
 
-    header = txt[:m.start()].strip("\r\n")
-    body = txt[m.start():]
-
-    starts = [m.start() for m in re.finditer(r"(?m)^NAME:", body)]
+    header = txt[:starts[0]].strip("\r\n")
     records = []
     for i, s in enumerate(starts):
-        e = starts[i + 1] if i + 1 < len(starts) else len(body)
-        rec = body[s:e].strip("\r\n")
+        e = starts[i + 1] if i + 1 < len(starts) else len(txt)
+        rec = txt[s:e].strip("\r\n")
         name_val = rec.splitlines()[0].split("NAME:", 1)[1].strip()
         records.append((name_val, rec))
 
     return header, records
 
-def process_folder(folder):
+def parse_fgt_records(fgt_path):
+    fgt_path = Path(fgt_path)
+    return _split_fgt_records(fgt_path.read_text(encoding="utf-8", errors="ignore"))
+
+def filter_fgt_file(msp_path):
+    """
+    Keep only the FGT records whose NAME is a formula of the MSP file next to it.
+
+    The FGT file is rewritten only if its filtered content differs from what is on disk.
+
+    Returns:
+        tuple: ('missing', 'unchanged' or 'written', number of matching records).
+    """
+    msp_path = Path(msp_path)
+    fgt_path = msp_path.with_suffix(".fgt")
+    if not fgt_path.exists():
+        return "missing", 0
+
+    formulas = extract_formulas_from_msp(msp_path)
+    raw = fgt_path.read_bytes()
+    # Same newline handling as reading the file in text mode
+    txt = raw.decode("utf-8", errors="ignore").replace("\r\n", "\n").replace("\r", "\n")
+    header, records = _split_fgt_records(txt)
+
+    matched_blocks = [rec for name, rec in records if name in formulas]
+    parts = []
+    if header:
+        parts.append(header + "\n")
+    if matched_blocks:
+        parts.append("\n\n".join(matched_blocks) + "\n")
+    else:
+        parts.append(f"\n# No matching NAME blocks found for formulas: {', '.join(sorted(formulas))}\n")
+    content = "".join(parts).encode("utf-8")
+
+    if content == raw:
+        return "unchanged", len(matched_blocks)
+    fgt_path.write_bytes(content)
+    return "written", len(matched_blocks)
+
+def process_folder(folder, workers=None):
+    """
+    Filter the FGT file of every MSP file in folder (see filter_fgt_file) on a process pool.
+
+    Args:
+        folder (str): MS-FINDER input folder with the .msp and .fgt files.
+        workers (int, optional): Worker processes (all CPU cores if None; 1 runs serially).
+
+    Returns:
+        dict: MSP file name (without .msp) -> number of FGT records kept, None if the FGT file is missing.
+    """
     folder = Path(folder)
-    for msp_path in folder.glob("*.msp"):
-        fgt_path = msp_path.with_suffix(".fgt")
-        if not fgt_path.exists():
-            print(f"[SKIP] FGT not found: {fgt_path.name}")
-            continue
-
-        formulas = extract_formulas_from_msp(msp_path)
-        header, records = parse_fgt_records(fgt_path)
-
-        matched_blocks = [rec for name, rec in records if name in formulas]
-
-        out_path = fgt_path
-        with out_path.open("w", encoding="utf-8", newline="\n") as f:
-            if header:
-                f.write(header + "\n")
-            if matched_blocks:
-                f.write("\n\n".join(matched_blocks) + "\n")
-            else:
-                f.write(f"\n# No matching NAME blocks found for formulas: {', '.join(sorted(formulas))}\n")
\ No newline at end of file
+    msp_paths = sorted(folder.glob("*.msp"))
+    workers = workers or os.cpu_count() or 1
+    if workers > 1 and len(msp_paths) > 256:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(filter_fgt_file, msp_paths, chunksize=64))
+    else:
+        results = [filter_fgt_file(msp_path) for msp_path in msp_paths]
+
+    matches = {}
+    for msp_path, (status, n_matched) in zip(msp_paths, results):
+        if status == "missing":
+            print(f"[SKIP] FGT not found: {msp_path.with_suffix('.fgt').name}")
+        matches[msp_path.stem] = None if status == "missing" else n_matched
+    statuses = [status for status, _ in results]
+    print(f"Filtered FGT files in {folder}: {statuses.count('written')} rewritten, {statuses.count('unchanged')} unchanged")
+    return matches
+
+def prune_unmatched_spectra(folder, matches, pruned_folder):
+    """
+    Move the spectra whose FGT file kept no formula out of the MS-FINDER input folder.
+
+    MS-FINDER finds no structure for them in the structure pass, so they are
+    moved with their .fgt file to pruned_folder instead of being processed.
+    Spectra without an FGT file are left in place.
+
+    Args:
+        folder (str): MS-FINDER input folder.
+        matches (dict): Result of process_folder for this folder.
+        pruned_folder (str): Folder receiving the pruned .msp/.fgt files.
+
+    Returns:
+        set: Names (without .msp) of the pruned spectra.
+    """
+    pruned = {name for name, n_matched in matches.items() if n_matched == 0}
+    if not pruned:
+        return pruned
+    os.makedirs(pruned_folder, exist_ok=True)
+    for name in pruned:
+        for suffix in (".msp", ".fgt"):
+            source = os.path.join(folder, name + suffix)
+            if os.path.exists(source):
+                shutil.move(source, os.path.join(pruned_folder, name + suffix))
+    print(f"Pruned {len(pruned)} spectra without matching formulas from {folder}")
+    return pruned
@@ -2,13 +2,13 @@ import pandas as pd
 import re
 import logging
 def msp_formula_changer(input_msp_path, formula_summary, msp_output_path):
-    formula_summary = formula_summary[["filename","formula"]]
+    formula_summary = formula_summary[["spectrum_id","formula"]]
 
     name_list_df = formula_summary.astype(str)
 
     # Remove NaN values from 'match_formula' and create a dictionary
     name_list_df = name_list_df.dropna(subset=["formula"])  # Remove rows where 'match_formula' is NaN
-    rename = name_list_df.set_index("filename")["formula"].to_dict()
+    rename = name_list_df.set_index("spectrum_id")["formula"].to_dict()
 
     # Debug: Print the keys in the rename dictionary
     print("Loaded compounds:", rename.keys())
@@ -66,6 +66,7 @@ def convert_name_to_peakid(msp_data):
     """
     Replace the NAME field with sequential numbers in each spectrum block.
     Optionally adds |ORIGNAME=...| to COMMENT line.
+    Returns the updated MSP text and a table mapping the int32 spectrum_id to the original name.
     """
     blocks = re.split(r'\n\s*\n', msp_data.strip())
     updated_blocks = []
@@ -103,14 +104,49 @@ def convert_name_to_peakid(msp_data):
         updated_blocks.append("\n".join(new_lines))
         records.append({
             "Original_NAME": original_name,
-            "Updated_NAME": str(i)
+            "spectrum_id": i
         })
 
     updated_msp_data = "\n\n".join(updated_blocks)
-    df = pd.DataFrame(records)
+    df = pd.DataFrame(records, columns=["Original_NAME", "spectrum_id"]).astype({"spectrum_id": "int32"})
     return updated_msp_data, df
 
 
+def parse_msp_blocks(msp_data):
+    """
+    Split MSP text into spectrum blocks with their header fields and peaks.
+
+    Returns a list with one dict per block: 'text' (the block as given),
+    the header fields keyed by lower-case name (e.g. 'name', 'precursormz',
+    'retentiontime') and 'peaks', a list of (m/z, intensity) floats.
+    """
+    blocks = []
+    for text in re.split(r'\n\s*\n', msp_data.strip()):
+        if not text.strip():
+            continue
+        block = {"text": text, "peaks": []}
+        in_peaks = False
+        for line in text.splitlines():
+            line = line.strip()
+            if in_peaks:
+                values = line.split()
+                if len(values) >= 2:
+                    try:
+                        block["peaks"].append((float(values[0]), float(values[1])))
+                    except ValueError:
+                        pass
+                continue
+            key, sep, value = line.partition(":")
+            if not sep:
+                continue
+            key = key.strip().casefold()
+            block[key] = value.strip()
+            if key == "num peaks":
+                in_peaks = True
+        blocks.append(block)
+    return blocks
+
+
 def read_msp_file(file_path):
     with open(file_path, 'r', encoding='utf-8') as file:
         return file.read()
@@ -1,5 +1,6 @@
 import logging
 import os
+import numpy as np
 
 # Configure logging for error messages
 logging.basicConfig(level=logging.ERROR, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -142,3 +143,65 @@ def split_mgf_by_adduct_in_memory(mgf_content):
     except Exception as e:
         logging.error(f"An unexpected error occurred while splitting MGF by adduct: {e}")
         raise
+
+
+def parse_msp_spectra(file_path):
+    """
+    Parse an MSP file into spectra with numeric peak arrays.
+
+    Reads the same fields convert_msp_to_mgf writes to MGF (NAME, PRECURSORMZ,
+    PRECURSORTYPE and the peak list), so the spectra can be handed to msbuddy
+    without writing and re-reading MGF files.
+
+    Args:
+        file_path (str): Path to the input MSP file.
+
+    Returns:
+        list: One dict per spectrum with 'title', 'precursor_mz' (float or None),
+        'adduct' (str or None), 'positive' (bool), and 'mz' / 'intensity' arrays.
+    """
+    if not os.path.exists(file_path):
+        raise FileNotFoundError(f"Input MSP file not found: {file_path}")
+
+    spectra = []
+    spectrum = None
+    peaks = []
+
+    def finish():
+        if spectrum is not None:
+            peak_array = np.array(peaks, dtype=np.float64).reshape(-1, 2)
+            spectrum['mz'] = peak_array[:, 0]
+            spectrum['intensity'] = peak_array[:, 1]
+            spectra.append(spectrum)
+
+    is_in_peaks = False
+    with open(file_path, 'r') as file:
+        for line in file:
+            line = line.strip()
+            if line == '':
+                finish()
+                spectrum, peaks, is_in_peaks = None, [], False
+                continue
+            if spectrum is None:
+                spectrum = {'title': None, 'precursor_mz': None, 'adduct': None, 'positive': False}
+            upper = line.upper()
+            try:
+                if 'NAME:' in upper:
+                    spectrum['title'] = line.split(':', 1)[1].strip()
+                elif 'PRECURSORMZ:' in upper:
+                    spectrum['precursor_mz'] = float(line.split(':', 1)[1].strip())
+                elif 'PRECURSORTYPE:' in upper:
+                    value = line.split(':', 1)[1].strip()
+                    spectrum['adduct'] = value
+                    # The trailing sign gives the ion mode; [M+Cl]- contains a '+' but is negative
+                    spectrum['positive'] = value.endswith('+')
+                elif 'NUM PEAKS:' in upper:
+                    is_in_peaks = True
+                elif is_in_peaks:
+                    values = line.split()
+                    peaks.append((float(values[0]), float(values[1])))
+            except (ValueError, IndexError) as e:
+                logging.error(f"Error processing spectrum line: {line} - {e}")
+                continue
+    finish()
+    return spectra
@@ -0,0 +1,51 @@
+import os
+import json
+import hashlib
+import tempfile
+
+# Rendered tool parameter files, shared by all runs of this installation
+RENDERED_PARAMETER_DIR = os.path.join(os.path.abspath(os.path.dirname(__file__)), "save_folder", "parameters")
+
+
+def render_parameter_file(template_path, replacements, output_dir=RENDERED_PARAMETER_DIR):
+    """
+    Render a tool parameter file from a template without modifying the template.
+
+    Every template line starting with a key of replacements is replaced by its
+    value (the first matching key wins); other lines are copied. The result is
+    written to '<template name>-<hash><ext>' in output_dir, where the hash covers
+    the template content and the replacements. An existing file with that name
+    already has the right content and is reused, so unchanged settings are not
+    rewritten and runs with different settings never write the same file.
+
+    Args:
+        template_path (str): Parameter file shipped with the tool.
+        replacements (dict): Line prefix -> replacement line (including the newline).
+        output_dir (str): Folder for rendered parameter files.
+
+    Returns:
+        str: Path of the rendered parameter file.
+    """
+    with open(template_path, 'r') as file:
+        template = file.read()
+
+    digest = hashlib.sha256(
+        (template + json.dumps(replacements, sort_keys=True)).encode("utf-8")
+    ).hexdigest()[:16]
+    stem, ext = os.path.splitext(os.path.basename(template_path))
+    rendered_path = os.path.join(output_dir, f"{stem}-{digest}{ext}")
+    if os.path.exists(rendered_path):
+        return rendered_path
+
+    lines = []
+    for line in template.splitlines(keepends=True):
+        key = next((key for key in replacements if line.startswith(key)), None)
+        lines.append(replacements[key] if key is not None else line)
+
+    # Write to a temporary file first so concurrent runs never see a partial file
+    os.makedirs(output_dir, exist_ok=True)
+    fd, temp_path = tempfile.mkstemp(dir=output_dir, suffix=ext)
+    with os.fdopen(fd, 'w') as file:
+        file.writelines(lines)
+    os.replace(temp_path, rendered_path)
+    return rendered_path
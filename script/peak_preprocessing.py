@@ -0,0 +1,138 @@
+import logging
+import numpy as np
+from msp_format_change import parse_msp_blocks
+
+# Defaults of the 'peak_preprocessing' section of the parameter file
+DEFAULT_SETTINGS = {
+    "enabled": False,
+    "merge_ppm": 5,
+    "precursor_window": 0.5,
+    "keep_precursor": True,
+    "min_relative_intensity": 0.01,
+    "top_k": 100,
+}
+
+
+def preprocessing_settings(section=None):
+    """Merge the 'peak_preprocessing' section of the parameter file over DEFAULT_SETTINGS."""
+    settings = dict(DEFAULT_SETTINGS)
+    settings.update({key: value for key, value in (section or {}).items() if value is not None})
+    return settings
+
+
+def _group_starts(spectrum):
+    """Boolean mask of the first peak of every spectrum in a spectrum-sorted peak array."""
+    starts = np.ones(len(spectrum), dtype=bool)
+    starts[1:] = spectrum[1:] != spectrum[:-1]
+    return starts
+
+
+def preprocess_peaks(spectrum, mz, intensity, precursor_mz, settings):
+    """
+    Clean the peak lists of all spectra at once.
+
+    The steps are, in this order: peaks closer than merge_ppm to the
+    previous peak are merged into one centroid (intensity-weighted m/z,
+    summed intensity); peaks above precursor m/z + precursor_window are
+    removed, and with keep_precursor False also the peaks within the window
+    around the precursor; peaks below min_relative_intensity of the base peak
+    are removed; only the top_k most intense peaks are kept. A value of 0
+    disables a step.
+
+    Args:
+        spectrum (np.ndarray): Spectrum index of every peak.
+        mz (np.ndarray): m/z of every peak.
+        intensity (np.ndarray): Intensity of every peak.
+        precursor_mz (np.ndarray): Precursor m/z of every spectrum (NaN if unknown).
+        settings (dict): 'peak_preprocessing' section of the parameter file.
+
+    Returns:
+        tuple: spectrum, mz, intensity of the kept peaks, sorted by spectrum and m/z.
+    """
+    order = np.lexsort((mz, spectrum))
+    spectrum, mz, intensity = spectrum[order], mz[order], np.clip(intensity[order], 0, None)
+
+    if settings["merge_ppm"] and len(mz):
+        new_peak = _group_starts(spectrum)
+        new_peak[1:] |= np.diff(mz) > mz[:-1] * settings["merge_ppm"] * 1e-6
+        group = np.cumsum(new_peak) - 1
+        summed = np.bincount(group, weights=intensity)
+        weighted_mz = np.bincount(group, weights=mz * intensity)
+        first_mz = mz[new_peak]
+        mz = np.where(summed > 0, weighted_mz / np.where(summed > 0, summed, 1.0), first_mz)
+        spectrum, intensity = spectrum[new_peak], summed
+
+    if settings["precursor_window"] and len(mz):
+        peak_precursor = precursor_mz[spectrum]
+        with np.errstate(invalid="ignore"):
+            keep = ~(mz > peak_precursor + settings["precursor_window"])
+            if not settings["keep_precursor"]:
+                keep &= ~(np.abs(mz - peak_precursor) <= settings["precursor_window"])
+        spectrum, mz, intensity = spectrum[keep], mz[keep], intensity[keep]
+
+    if settings["min_relative_intensity"] and len(mz):
+        starts = np.flatnonzero(_group_starts(spectrum))
+        base_peak = np.maximum.reduceat(intensity, starts)
+        keep = intensity >= np.repeat(base_peak, np.diff(np.append(starts, len(mz)))) * settings["min_relative_intensity"]
+        spectrum, mz, intensity = spectrum[keep], mz[keep], intensity[keep]
+
+    if settings["top_k"] and len(mz):
+        by_intensity = np.lexsort((-intensity, spectrum))
+        starts = np.flatnonzero(_group_starts(spectrum[by_intensity]))
+        rank = np.arange(len(mz)) - np.repeat(starts, np.diff(np.append(starts, len(mz))))
+        keep = np.zeros(len(mz), dtype=bool)
+        keep[by_intensity[rank < settings["top_k"]]] = True
+        spectrum, mz, intensity = spectrum[keep], mz[keep], intensity[keep]
+
+    return spectrum, mz, intensity
+
+
+def _format_value(value):
+    return np.format_float_positional(round(float(value), 6), trim='-')
+
+
+def preprocess_msp(msp_data, settings=None):
+    """
+    Apply preprocess_peaks to every spectrum of MSP text from convert_name_to_peakid.
+
+    Header lines are kept; the 'Num Peaks' line and the peak list are rewritten.
+
+    Args:
+        msp_data (str): MSP text.
+        settings (dict, optional): 'peak_preprocessing' section of the parameter file.
+
+    Returns:
+        str: MSP text with the cleaned peak lists.
+    """
+    settings = preprocessing_settings(settings)
+    blocks = parse_msp_blocks(msp_data)
+    counts = np.array([len(block["peaks"]) for block in blocks], dtype=np.int64)
+    peaks = np.array([peak for block in blocks for peak in block["peaks"]], dtype=np.float64).reshape(-1, 2)
+    precursor_mz = np.full(len(blocks), np.nan)
+    for i, block in enumerate(blocks):
+        try:
+            precursor_mz[i] = float(block.get("precursormz", ""))
+        except ValueError:
+            pass
+
+    spectrum, mz, intensity = preprocess_peaks(
+        np.repeat(np.arange(len(blocks)), counts), peaks[:, 0], peaks[:, 1], precursor_mz, settings
+    )
+    bounds = np.searchsorted(spectrum, np.arange(len(blocks) + 1))
+
+    processed = []
+    for i, block in enumerate(blocks):
+        header = []
+        for line in block["text"].splitlines():
+            if line.strip().casefold().startswith("num peaks:"):
+                break
+            header.append(line)
+        header.append(f"Num Peaks: {bounds[i + 1] - bounds[i]}")
+        peak_lines = [
+            f"{_format_value(mz[j])}\t{_format_value(intensity[j])}" for j in range(bounds[i], bounds[i + 1])
+        ]
+        processed.append("\n".join(header + peak_lines))
+
+    logging.info(f"Peak preprocessing kept {len(mz)} of {len(peaks)} peaks")
+    print(f"Peak preprocessing: {len(peaks)} peaks, {len(mz)} kept")
+    return "\n\n".join(processed)
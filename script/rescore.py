@@ -0,0 +1,58 @@
+import os
+import time
+import argparse
+import yaml
+from creating_summary import write_formula_results
+from creating_struc_summary import write_structure_results
+from summary_utility import load_candidate_cache, CANDIDATE_CACHE_DIR
+
+
+def rescore_formula(output_dir, cache, model_dir, config):
+    (summary_path, score_path), _ = write_formula_results(
+        cache["candidates"], cache["name_df"], output_dir, model_dir, config, top_n=cache["top_n"]
+    )
+    print(f"Saved {summary_path} and {score_path}")
+
+
+def rescore_structure(output_dir, cache, machine_dir, config):
+    result_score_file, summary_smiles_file = write_structure_results(cache["candidates"], cache["name_df"], output_dir, machine_dir, config)
+    print(f"Saved {result_score_file} and {summary_smiles_file}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Re-score the tool candidates of a previous Msemblator run with the current scoring models "
+                    "and parameter file, without running the annotation tools again."
+    )
+    parser.add_argument("--output", required=True, help="Summary output folder of the previous run")
+    parser.add_argument("--mode", type=int, choices=[1, 2, 3], default=2,
+                        help="1: Formula only, 2: Both formula and structure (default), 3: Structure only")
+    args = parser.parse_args()
+
+    current_dir = os.path.abspath(os.path.dirname(__file__))
+    with open(os.path.join(current_dir, 'msemblator_parameter_file.yaml'), 'r') as file:
+        config = yaml.safe_load(file)
+
+    start = time.time()
+    pipelines = {1: ["formula"], 2: ["formula", "structure"], 3: ["structure"]}[args.mode]
+    rescored = 0
+    for pipeline in pipelines:
+        cache = load_candidate_cache(args.output, pipeline)
+        if cache is None:
+            print(f"No cached {pipeline} candidates in {os.path.join(args.output, CANDIDATE_CACHE_DIR)}, skipping")
+            continue
+        print(f"Re-scoring {pipeline} candidates...")
+        if pipeline == "formula":
+            rescore_formula(args.output, cache, os.path.join(current_dir, "formula_scoring_model"), config)
+        else:
+            rescore_structure(args.output, cache, os.path.join(current_dir, "structure_scoring_model"), config)
+        rescored += 1
+
+    if rescored:
+        print(f"Re-scoring completed in {time.time() - start:.2f} seconds.")
+    else:
+        print("Nothing to re-score. Run msemblator.py first.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,188 @@
+import os
+import io
+import gzip
+import pandas as pd
+from summary_utility import apply_original_names
+from score_aggregation import render_used_tools
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# File suffix written for each supported output format
+OUTPUT_SUFFIXES = {
+    "csv": ".csv",
+    "gzip": ".csv.gz",
+    "zstd": ".csv.zst",
+    "parquet": ".parquet",
+}
+
+
+def reserve_output_path(directory, stem, suffix):
+    """
+    Return a path `<stem><suffix>` (or `<stem>_<n><suffix>`) that does not exist yet.
+
+    Unlike generate_unique_filename, multi-part suffixes such as '.csv.gz'
+    are kept intact.
+    """
+    counter = 1
+    filename = f"{stem}{suffix}"
+    while os.path.exists(os.path.join(directory, filename)):
+        filename = f"{stem}_{counter}{suffix}"
+        counter += 1
+    return os.path.join(directory, filename)
+
+
+def parquet_schema(df):
+    """
+    Arrow schema of a result table, from the pandas dtype of every column.
+
+    The types are chosen so that every later batch fits: integer columns are
+    stored as nullable int64 (a batch where missing values turned them into
+    floats still fits), and object, string and categorical columns as strings
+    (a first batch holding only None does not fix them to the null type).
+    """
+    import pyarrow as pa
+
+    fields = []
+    for column, dtype in df.dtypes.items():
+        if pd.api.types.is_bool_dtype(dtype):
+            arrow_type = pa.bool_()
+        elif pd.api.types.is_integer_dtype(dtype):
+            arrow_type = pa.int64()
+        elif pd.api.types.is_float_dtype(dtype):
+            arrow_type = pa.float64()
+        else:
+            arrow_type = pa.string()
+        fields.append(pa.field(str(column), arrow_type))
+    return pa.schema(fields)
+
+
+def conform_to_schema(df, schema):
+    """Cast the columns of a batch to the nullable pandas types matching schema."""
+    import pyarrow as pa
+
+    columns = {}
+    for field in schema:
+        values = df[field.name]
+        if pa.types.is_boolean(field.type):
+            columns[field.name] = values.astype("boolean")
+        elif pa.types.is_integer(field.type):
+            columns[field.name] = pd.to_numeric(values).astype("Int64")
+        elif pa.types.is_floating(field.type):
+            columns[field.name] = pd.to_numeric(values).astype("Float64")
+        else:
+            columns[field.name] = values.astype("string")
+    return pd.DataFrame(columns, index=df.index)
+
+
+class ResultWriter:
+    """
+    Append result tables to one output file batch by batch.
+
+    CSV output (plain, gzip or zstd) writes the header with the first batch
+    and flushes after every batch so downstream consumers can start reading
+    before the run finishes. Parquet output writes one row group per batch,
+    with the schema taken from the column types of the first batch
+    (parquet_schema) and every batch cast to it.
+    """
+
+    def __init__(self, directory, stem, output_format="csv"):
+        if output_format not in OUTPUT_SUFFIXES:
+            raise ValueError(f"Unsupported output format: {output_format}. Choose from {list(OUTPUT_SUFFIXES)}")
+        if output_format == "zstd" and zstandard is None:
+            raise ImportError("Output format 'zstd' requires the 'zstandard' package.")
+
+        self.output_format = output_format
+        self.path = reserve_output_path(directory, stem, OUTPUT_SUFFIXES[output_format])
+        self.rows_written = 0
+        self._handle = None
+        self._parquet_writer = None
+
+    def _open_text_handle(self):
+        if self.output_format == "gzip":
+            return gzip.open(self.path, "wt", encoding="utf-8", newline="")
+        if self.output_format == "zstd":
+            binary = zstandard.ZstdCompressor().stream_writer(open(self.path, "wb"))
+            return io.TextIOWrapper(binary, encoding="utf-8", newline="")
+        return open(self.path, "w", encoding="utf-8", newline="")
+
+    def write(self, df):
+        """Append one batch of rows."""
+        if self.output_format == "parquet":
+            self._write_parquet(df)
+        else:
+            if self._handle is None:
+                self._handle = self._open_text_handle()
+                df.to_csv(self._handle, index=False)
+            else:
+                df.to_csv(self._handle, index=False, header=False)
+            self._handle.flush()
+        self.rows_written += len(df)
+
+    def _write_parquet(self, df):
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        if self._parquet_writer is None:
+            self._parquet_writer = pq.ParquetWriter(self.path, parquet_schema(df))
+        schema = self._parquet_writer.schema
+        table = pa.Table.from_pandas(conform_to_schema(df, schema), schema=schema, preserve_index=False)
+        self._parquet_writer.write_table(table)
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def _named_batch(df, name_df, rename=None, tool_names=None):
+    batch = apply_original_names(df, name_df)
+    if tool_names:
+        batch = render_used_tools(batch, tool_names)
+    if rename:
+        batch = batch.rename(columns=rename)
+    return batch
+
+
+def write_result_batches(batches, name_df, directory, outputs, output_format="csv", tool_names=None):
+    """
+    Write result tables to disk batch by batch as they are produced.
+
+    Each item of batches holds one table per output, e.g. the score and the
+    summary table of one batch of spectra from iter_formula_scores. Every
+    table gets its original spectrum names and is appended to its file before
+    the next batch is requested, so only one batch of results is in memory.
+
+    Args:
+        batches (iterable): Tuples of result tables with a spectrum_id column.
+        name_df (pd.DataFrame): spectrum_id to Original_NAME mapping.
+        directory (str): Output directory.
+        outputs (list): (stem, rename) of every table position, e.g.
+            [('formula_score', None), ('formula_summary', {'formula': 'Top_score_formula'})].
+        output_format (str): One of 'csv', 'gzip', 'zstd', 'parquet'.
+        tool_names (list, optional): Tools of the tool_mask / rank_<tool> columns,
+            rendered to the Used_Tool string per batch.
+
+    Returns:
+        list: Path of the written file of every output.
+    """
+    writers = [ResultWriter(directory, stem, output_format) for stem, _ in outputs]
+    try:
+        for tables in batches:
+            for writer, (_, rename), df in zip(writers, outputs, tables):
+                writer.write(_named_batch(df, name_df, rename, tool_names))
+    finally:
+        for writer in writers:
+            writer.close()
+    return [writer.path for writer in writers]
@@ -0,0 +1,169 @@
+import os
+import json
+import heapq
+import logging
+import tempfile
+import threading
+from collections import namedtuple
+import numpy as np
+
+# Timings of past runs, shared by all tools, next to this script
+RUNTIME_HISTORY_PATH = os.path.join(os.path.abspath(os.path.dirname(__file__)), "runtime_history.json")
+
+# Bump when the cost features change; older timing records are then ignored
+FEATURE_VERSION = 1
+
+# Adducts with their own cost term; all others share the last term
+COST_ADDUCTS = ["[M+H]+", "[M-H]-", "[M+Na]+", "[M+NH4]+", "[M-H2O+H]+"]
+
+# Timing records kept per tool, and the number needed before the learned model is used
+MAX_RECORDS = 500
+MIN_RECORDS = 20
+
+SpectrumCost = namedtuple("SpectrumCost", ["precursor_mz", "peaks", "adduct"])
+
+
+def cost_features(spectra):
+    """
+    Cost features of every spectrum.
+
+    The mass terms follow the SIRIUS search space, which grows with the
+    precursor mass and changes behaviour at the 300 and 650 m/z heuristic
+    thresholds; the peak terms follow the size of the fragmentation problem.
+
+    Args:
+        spectra (list): SpectrumCost tuples.
+
+    Returns:
+        np.ndarray: One row of features per spectrum.
+    """
+    mz = np.array([s.precursor_mz or 0.0 for s in spectra], dtype=np.float64) / 100.0
+    peaks = np.array([s.peaks for s in spectra], dtype=np.float64) / 10.0
+    adducts = [s.adduct for s in spectra]
+    adduct_terms = np.zeros((len(spectra), len(COST_ADDUCTS) + 1))
+    for row, adduct in enumerate(adducts):
+        column = COST_ADDUCTS.index(adduct) if adduct in COST_ADDUCTS else len(COST_ADDUCTS)
+        adduct_terms[row, column] = 1.0
+    return np.column_stack([
+        mz, mz ** 2, peaks, mz ** 2 * peaks, mz > 3.0, mz > 6.5, adduct_terms
+    ])
+
+
+def default_cost(spectra):
+    """Cost used before enough timings are recorded: (m/z / 100)^2 * (1 + peaks)."""
+    return np.array([((s.precursor_mz or 0.0) / 100.0) ** 2 * (1 + s.peaks) for s in spectra], dtype=np.float64)
+
+
+class CostModel:
+    """
+    Expected runtime per spectrum of one tool, learned from past run timings.
+
+    Every timed batch (a SIRIUS shard, an msbuddy chunk, ...) is stored with
+    the summed cost features of its spectra. Since the batch time is the sum
+    of the spectrum times, a ridge regression on those sums gives per-spectrum
+    weights. Until MIN_RECORDS batches are recorded, default_cost is used.
+    """
+
+    def __init__(self, tool, history_path=RUNTIME_HISTORY_PATH, ridge=1e-3):
+        self.tool = tool
+        self.history_path = history_path
+        self.ridge = ridge
+        self.records = self._load_records()
+        self.weights = self._fit()
+        self._lock = threading.Lock()
+
+    def _load_records(self):
+        try:
+            with open(self.history_path, 'r', encoding='utf-8') as file:
+                history = json.load(file)
+        except FileNotFoundError:
+            return []
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring unreadable runtime history {self.history_path}: {e}")
+            return []
+        if history.get("feature_version") != FEATURE_VERSION:
+            return []
+        return history.get("tools", {}).get(self.tool, [])
+
+    def _fit(self):
+        if len(self.records) < MIN_RECORDS:
+            return None
+        X = np.array([record["features"] for record in self.records], dtype=np.float64)
+        y = np.array([record["seconds"] for record in self.records], dtype=np.float64)
+        if X.ndim != 2 or X.shape[1] != cost_features([SpectrumCost(0.0, 0, "")]).shape[1]:
+            return None
+        gram = X.T @ X
+        gram += self.ridge * np.trace(gram) / len(gram) * np.eye(len(gram))
+        return np.linalg.solve(gram, X.T @ y)
+
+    def predict(self, spectra):
+        """Expected seconds (or relative cost before training) of every spectrum."""
+        if not spectra:
+            return np.empty(0)
+        if self.weights is None:
+            return default_cost(spectra)
+        return np.maximum(cost_features(spectra) @ self.weights, 1e-3)
+
+    def record(self, spectra, seconds):
+        """Add the measured runtime of a batch of spectra; call save() to keep it."""
+        if not spectra or seconds <= 0:
+            return
+        features = cost_features(spectra).sum(axis=0)
+        with self._lock:
+            self.records.append({"features": features.tolist(), "seconds": float(seconds)})
+            del self.records[:-MAX_RECORDS]
+
+    def save(self):
+        """
+        Write the timing records of this tool back to the history file.
+
+        The file is written to a temporary file in the same folder and then
+        moved over the history file, so concurrent runs and readers never see
+        a partly written history.
+        """
+        try:
+            with open(self.history_path, 'r', encoding='utf-8') as file:
+                history = json.load(file)
+            if history.get("feature_version") != FEATURE_VERSION:
+                history = {}
+        except (OSError, ValueError):
+            history = {}
+        history["feature_version"] = FEATURE_VERSION
+        history.setdefault("tools", {})[self.tool] = self.records
+        temp_path = None
+        try:
+            fd, temp_path = tempfile.mkstemp(
+                dir=os.path.dirname(os.path.abspath(self.history_path)), prefix=".runtime_history_", suffix=".tmp"
+            )
+            with os.fdopen(fd, 'w', encoding='utf-8') as file:
+                json.dump(history, file)
+            os.replace(temp_path, self.history_path)
+        except OSError as e:
+            logging.warning(f"Could not save runtime history to {self.history_path}: {e}")
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+
+def longest_first(costs):
+    """Indices of the work items ordered by decreasing expected cost."""
+    return sorted(range(len(costs)), key=lambda i: costs[i], reverse=True)
+
+
+def lpt_bins(costs, n_bins):
+    """
+    Assign work items to n_bins workers, longest processing time first.
+
+    Each item, from the most to the least expensive, goes to the bin with the
+    lowest total so far. Within a bin the items keep their input order.
+
+    Returns:
+        list: Item indices of every non-empty bin.
+    """
+    n_bins = max(1, min(n_bins, len(costs)))
+    heap = [(0.0, b) for b in range(n_bins)]
+    bins = [[] for _ in range(n_bins)]
+    for index in longest_first(costs):
+        total, b = heapq.heappop(heap)
+        bins[b].append(index)
+        heapq.heappush(heap, (total + costs[index], b))
+    return [sorted(items) for items in bins if items]
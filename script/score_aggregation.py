@@ -0,0 +1,143 @@
+import numpy as np
+import pandas as pd
+
+# Names shown in the Used_Tool column for each tool_name
+TOOL_LABELS = {
+    "msfinder": "MS-FINDER",
+    "sirius": "SIRIUS",
+    "buddy": "msbuddy",
+    "metfrag": "MetFrag",
+}
+
+RANK_DTYPE = "Int16"
+
+
+def rank_columns(tool_names):
+    """Per-tool rank column names, e.g. ['rank_buddy', 'rank_msfinder', 'rank_sirius']."""
+    return [f"rank_{tool}" for tool in tool_names]
+
+
+def best_tool_ranks(group_ids, n_groups, tool_codes, ranks, tool_names):
+    """
+    Best (lowest) rank each tool gave to each candidate group.
+
+    Args:
+        group_ids (np.ndarray): Group index of every row, -1 for rows to ignore.
+        n_groups (int): Number of groups.
+        tool_codes (np.ndarray): Index into tool_names of every row, -1 for unknown tools.
+        ranks (array-like): Tool-specific rank of every row.
+        tool_names (list): Tool names in bit order.
+
+    Returns:
+        pd.DataFrame: One nullable rank column per tool, <NA> where the tool did
+        not report the candidate.
+    """
+    ranks = pd.to_numeric(pd.Series(ranks), errors="coerce").to_numpy(dtype=np.float64)
+    valid = (group_ids >= 0) & (tool_codes >= 0) & ~np.isnan(ranks)
+    best = np.full((n_groups, len(tool_names)), np.inf)
+    np.minimum.at(best, (group_ids[valid], tool_codes[valid]), ranks[valid])
+    best[np.isinf(best)] = np.nan
+    return pd.DataFrame(best, columns=rank_columns(tool_names)).astype(RANK_DTYPE)
+
+
+def tool_mask(df, tool_names):
+    """
+    Bitmask of the tools that reported each row: bit i is set if tool_names[i] has a rank.
+    """
+    mask = np.zeros(len(df), dtype=np.uint8)
+    for bit, column in enumerate(rank_columns(tool_names)):
+        mask |= df[column].notna().to_numpy().astype(np.uint8) << bit
+    return mask
+
+
+def tool_rank_aggregations(tool_names):
+    """Named aggregations keeping the best rank of every tool within a group."""
+    return {column: (column, "min") for column in rank_columns(tool_names)}
+
+
+def render_used_tools(df, tool_names, column="Used_Tool"):
+    """
+    Replace the tool_mask and per-tool rank columns by the readable Used_Tool string.
+
+    Tools are listed in the sorted order of their labels, e.g.
+    'MS-FINDER_Rank:2,SIRIUS_Rank:1'. The string is built one tool at a time
+    over the whole column, so no Python code runs per row.
+    """
+    rank_cols = rank_columns(tool_names)
+    used = pd.Series("", index=df.index, dtype=object)
+    for tool in sorted(tool_names, key=lambda t: TOOL_LABELS.get(t, t)):
+        ranks = df[f"rank_{tool}"]
+        present = ranks.notna()
+        if not present.any():
+            continue
+        entry = TOOL_LABELS.get(tool, tool) + "_Rank:" + ranks[present].astype("int64").astype(str).astype(object)
+        separator = np.where(used[present] == "", "", ",")
+        used[present] = used[present] + separator + entry
+
+    dropped = [col for col in ["tool_mask", *rank_cols] if col in df.columns]
+    anchor = "tool_mask" if "tool_mask" in df.columns else dropped[0]
+    position = sum(col not in dropped for col in df.columns[:df.columns.get_loc(anchor)])
+    rendered = df.drop(columns=dropped)
+    rendered.insert(position, column, used)
+    return rendered
+
+
+def grouped_top_k(keys, values, k):
+    """
+    Select the k highest values of every key, like
+    groupby(key).rank(method='first', ascending=False) <= k without ranking every row.
+
+    Rows are segmented by key (a stable argsort is only done if keys are not
+    already sorted). Within a segment larger than k, np.partition finds the
+    k-th largest value; rows above it are kept, and ties at that value are
+    kept in their original order until k rows are reached. Only the kept
+    rows are then sorted to assign ranks.
+
+    Args:
+        keys (array-like): Group key of every row (e.g. spectrum_id).
+        values (array-like): Score of every row; NaN counts as the lowest score.
+        k (int): Number of rows to keep per key.
+
+    Returns:
+        tuple: (row positions of the kept rows ordered by key and rank,
+        1-based rank of each of them)
+    """
+    keys = np.asarray(keys)
+    values = np.asarray(values, dtype=np.float64)
+    values = np.where(np.isnan(values), -np.inf, values)
+    n = len(keys)
+    if n == 0 or k <= 0:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.int64)
+
+    order = np.arange(n) if np.all(keys[1:] >= keys[:-1]) else np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    sorted_values = values[order]
+    starts = np.flatnonzero(np.r_[True, sorted_keys[1:] != sorted_keys[:-1]])
+    sizes = np.diff(np.r_[starts, n])
+    group = np.repeat(np.arange(len(starts)), sizes)
+
+    keep = np.ones(n, dtype=bool)
+    large = np.flatnonzero(sizes > k)
+    if len(large):
+        # k-th largest value of every group with more than k rows
+        threshold = np.full(len(starts), -np.inf)
+        for g in large:
+            segment = sorted_values[starts[g]:starts[g] + sizes[g]]
+            threshold[g] = np.partition(segment, sizes[g] - k)[sizes[g] - k]
+        row_threshold = threshold[group]
+        above = sorted_values > row_threshold
+        tied = sorted_values == row_threshold
+        # Ties fill the remaining slots in their original order
+        slots = k - np.bincount(group, weights=above, minlength=len(starts)).astype(np.int64)
+        tied_before = np.cumsum(tied) - tied
+        tied_before -= np.repeat(tied_before[starts], sizes)
+        keep = above | (tied & (tied_before < slots[group]))
+        keep[np.isin(group, large, invert=True)] = True
+
+    kept = np.flatnonzero(keep)
+    # Rank the kept rows: key, then score descending, then original order
+    ranked = kept[np.lexsort((order[kept], -sorted_values[kept], group[kept]))]
+    kept_groups = group[ranked]
+    group_starts = np.flatnonzero(np.r_[True, kept_groups[1:] != kept_groups[:-1]])
+    ranks = np.arange(len(ranked)) - np.repeat(group_starts, np.diff(np.r_[group_starts, len(ranked)])) + 1
+    return order[ranked], ranks
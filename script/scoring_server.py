@@ -0,0 +1,211 @@
+import os
+import io
+import json
+import logging
+import threading
+import argparse
+import urllib.request
+import urllib.error
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+from feature_matrix import FeatureMatrix, load_adduct_models, predict_confidence
+
+# Model folders loaded at server start, relative to this script
+DEFAULT_REGISTRIES = ["formula_scoring_model", "structure_scoring_model"]
+
+
+def _pack_features(features):
+    buffer = io.BytesIO()
+    np.savez(
+        buffer,
+        values=features.values,
+        adduct_codes=features.adduct_codes,
+        adduct_labels=np.asarray(features.adduct_labels, dtype=str),
+    )
+    return buffer.getvalue()
+
+
+def _unpack_features(body):
+    with np.load(io.BytesIO(body), allow_pickle=False) as data:
+        return FeatureMatrix(data["values"], data["adduct_codes"], data["adduct_labels"])
+
+
+def _model_signature(machine_dir):
+    """Name and modification time of every model file (.pkl, .npz) in a model folder."""
+    return tuple(sorted(
+        (name, os.path.getmtime(os.path.join(machine_dir, name)))
+        for name in os.listdir(machine_dir) if name.endswith((".pkl", ".npz"))
+    ))
+
+
+class ModelPool:
+    """
+    Scoring models of the served model folders, keyed by their resolved path.
+
+    Only the registries (relative to base_dir) and the extra folders given
+    at server start are served, so the server never unpickles a path that
+    only a client named. A folder is loaded again when one of its model
+    files is added, removed or modified, so an updated model is used
+    without restarting the server.
+    """
+
+    def __init__(self, base_dir, registries=DEFAULT_REGISTRIES, extra_dirs=(), use_engine=False):
+        self.use_engine = use_engine
+        self.models = {}
+        self._lock = threading.Lock()
+        self.served = {os.path.realpath(os.path.join(base_dir, name)) for name in registries}
+        self.served.update(os.path.realpath(machine_dir) for machine_dir in extra_dirs)
+        for machine_dir in sorted(self.served):
+            if not os.path.isdir(machine_dir):
+                logging.warning(f"Scoring model folder not found: {machine_dir}")
+                continue
+            self.get(machine_dir)
+
+    def get(self, machine_dir):
+        """(model_all, model_dict) of a served model folder, reloaded if its model files changed."""
+        machine_dir = os.path.realpath(machine_dir)
+        if machine_dir not in self.served:
+            raise FileNotFoundError(f"Model folder not served: {machine_dir}")
+        if not os.path.isfile(os.path.join(machine_dir, "random_forest_final_all.pkl")):
+            raise FileNotFoundError(f"No scoring models in {machine_dir}")
+        with self._lock:
+            signature, models = self.models.get(machine_dir, (None, None))
+            if signature != _model_signature(machine_dir):
+                models = load_adduct_models(machine_dir, self.use_engine)
+                # Exporting forests writes .npz files, so take the signature after loading
+                self.models[machine_dir] = (_model_signature(machine_dir), models)
+                logging.info(f"Loaded scoring models from {machine_dir}")
+        return models
+
+    def score(self, machine_dir, features):
+        model_all, model_dict = self.get(machine_dir)
+        return predict_confidence(features, model_all, model_dict)
+
+
+class ScoringRequestHandler(BaseHTTPRequestHandler):
+    """
+    GET  /health  -> JSON list of loaded model folders
+    POST /score   -> header X-Model-Dir: absolute model folder of the client,
+                     body: npz feature matrix, response: npy confidence scores
+                     (404 if the folder is not served; the client then scores in process)
+    """
+
+    def _reply(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/health":
+            body = json.dumps({"registries": sorted(self.server.pool.models)}).encode()
+            self._reply(200, body, "application/json")
+        else:
+            self._reply(404, b"not found", "text/plain")
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        machine_dir = self.headers.get("X-Model-Dir")
+        if self.path != "/score" or not machine_dir:
+            self._reply(404, b"not found", "text/plain")
+            return
+        try:
+            confidence = self.server.pool.score(machine_dir, _unpack_features(body))
+        except FileNotFoundError as e:
+            self._reply(404, str(e).encode(), "text/plain")
+            return
+        except Exception as e:
+            logging.error(f"Scoring request failed: {e}")
+            self._reply(400, str(e).encode(), "text/plain")
+            return
+        buffer = io.BytesIO()
+        np.save(buffer, confidence, allow_pickle=False)
+        self._reply(200, buffer.getvalue(), "application/octet-stream")
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+def request_confidence(features, machine_dir, server_config):
+    """
+    Score a feature matrix on a running scoring server.
+
+    Args:
+        features (FeatureMatrix): Model input built by build_feature_matrix.
+        machine_dir (str): Model folder; the server scores with the models of this folder.
+        server_config (dict): 'scoring_server' section of the parameter file.
+
+    Returns:
+        np.ndarray or None: Confidence scores, or None if the server could not be used.
+    """
+    url = f"http://{server_config.get('host', '127.0.0.1')}:{server_config.get('port', 8765)}/score"
+    request = urllib.request.Request(
+        url, data=_pack_features(features),
+        headers={"Content-Type": "application/octet-stream", "X-Model-Dir": os.path.abspath(machine_dir)}
+    )
+    try:
+        with urllib.request.urlopen(request, timeout=server_config.get("timeout", 60)) as response:
+            confidence = np.load(io.BytesIO(response.read()), allow_pickle=False)
+    except (urllib.error.URLError, OSError, ValueError) as e:
+        logging.info(f"Scoring server unavailable ({e}), scoring in process")
+        return None
+    if len(confidence) != len(features.values):
+        logging.warning("Scoring server returned a wrong number of scores, scoring in process")
+        return None
+    return confidence
+
+
+def feature_scorer(machine_dir, server_config=None):
+    """
+    Return a function predicting confidence scores for one feature matrix after another.
+
+    Every call is sent to the scoring server while it is enabled and reachable.
+    Otherwise the models are loaded in process on the first call and kept for
+    the following ones, so scoring in batches loads them only once.
+    """
+    use_server = bool(server_config and server_config.get("enabled"))
+    models = []
+
+    def score(features):
+        nonlocal use_server
+        if use_server and len(features.values):
+            confidence = request_confidence(features, machine_dir, server_config)
+            if confidence is not None:
+                return confidence
+            use_server = False
+        if not models:
+            models.append(load_adduct_models(machine_dir, bool(server_config and server_config.get("forest_engine"))))
+        model_all, model_dict = models[0]
+        return predict_confidence(features, model_all, model_dict)
+
+    return score
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep the Msemblator scoring models loaded and serve scoring requests.")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to bind (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on (default: 8765)")
+    parser.add_argument("--forest-engine", action="store_true",
+                        help="Evaluate the forests from exported node arrays instead of sklearn (slower, "
+                             "but independent of the installed sklearn version)")
+    parser.add_argument("--model-dir", action="append", default=[],
+                        help="Additional model folder to serve, besides "
+                             f"{' and '.join(DEFAULT_REGISTRIES)} (can be given several times)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    current_dir = os.path.abspath(os.path.dirname(__file__))
+    server = ThreadingHTTPServer((args.host, args.port), ScoringRequestHandler)
+    server.pool = ModelPool(current_dir, extra_dirs=args.model_dir, use_engine=args.forest_engine)
+    logging.info(f"Scoring server listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
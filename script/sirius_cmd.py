@@ -1,7 +1,8 @@
-import subprocess
 import os
 import wexpect
 import logging
+from tool_supervisor import run_supervised
+from sirius_sharding import shard_log_name, unfinished_compound_retry
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -36,7 +37,7 @@ def sirius_login(sirius_directory, username, password):
         child.close()
 
 
-def run_sirius(sirius_outputdir, sirius_inputdir, sirius_path, config):
+def run_sirius(sirius_outputdir, sirius_inputdir, sirius_path, config, cores=None, total=None):
     """
     Runs the Sirius structure prediction tool with updated parameters.
 
@@ -44,7 +45,12 @@ def run_sirius(sirius_outputdir, sirius_inputdir, sirius_path, config):
         sirius_outputdir (str): Directory to save the output results.
         sirius_inputdir (str): Path to the input MS data file.
         sirius_path (str): Path to the Sirius executable.
-        structure_search_db (str): Path to the structure search database.
+        config (dict): Parameter file settings.
+        cores (int, optional): Number of CPU cores SIRIUS may use (SIRIUS default if None).
+        total (int, optional): Number of compounds in the input, for progress reporting.
+
+    Returns:
+        int or None: SIRIUS exit code, None if it timed out or could not run.
     """
     ms1 = config['formula_prediction']['sirius']['MS1']
     ms2 = config['formula_prediction']['sirius']['MS2_ppm']
@@ -59,6 +65,7 @@ def run_sirius(sirius_outputdir, sirius_inputdir, sirius_path, config):
 
     command = [
         sirius_path,  # Path to the executable
+        *(["--cores", str(cores)] if cores else []),  # Thread limit when SIRIUS runs sharded
         "-i", sirius_inputdir,  # Input file path
         "-o", sirius_outputdir,  # Output directory
         "--ignore-formula",
@@ -94,10 +101,11 @@ def run_sirius(sirius_outputdir, sirius_inputdir, sirius_path, config):
     ]
 
     try:
-        with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1) as proc:
-            for line in proc.stdout:
-                print(line, end="")
-            proc.wait()
+        return run_supervised(
+            command, shard_log_name("sirius_formula", sirius_outputdir), config.get('supervisor'), total=total,
+            retry_command=unfinished_compound_retry(command, sirius_outputdir, "formula_candidates.tsv")
+        )
 
     except Exception as e:
         print(f"An error occurred during SIRIUS execution: {e}")
+        return None
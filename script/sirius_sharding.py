@@ -0,0 +1,209 @@
+import os
+import glob
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from scheduler import SpectrumCost, default_cost, lpt_bins
+
+# Shard output folders are named shard_00, shard_01, ... inside the SIRIUS output folder
+SHARD_PREFIX = "shard_"
+
+
+def split_ms_blocks(ms_content):
+    """
+    Split the content of a SIRIUS .ms file (see msp_to_ms.convert_msp_to_ms) into compound blocks.
+    """
+    return [block for block in ms_content.split("\n\n") if block.strip()]
+
+
+def ms_block_cost(block):
+    """
+    Cost description (precursor m/z, MS2 peak count, adduct) of one compound block.
+    """
+    parentmass = 0.0
+    adduct = ""
+    peaks = 0
+    in_ms2 = False
+    for line in block.splitlines():
+        if line.startswith(">parentmass"):
+            try:
+                parentmass = float(line.split(maxsplit=1)[1])
+            except (IndexError, ValueError):
+                parentmass = 0.0
+        elif line.startswith(">ionization"):
+            adduct = line[len(">ionization"):].strip()
+        elif line.startswith(">ms2"):
+            in_ms2 = True
+        elif line.startswith(">"):
+            in_ms2 = False
+        elif in_ms2 and line.strip():
+            peaks += 1
+    return SpectrumCost(parentmass, peaks, adduct)
+
+
+def shard_settings(tool_config):
+    """
+    Number of SIRIUS shards and the --cores value of each SIRIUS process.
+
+    Args:
+        tool_config (dict): sirius section of the parameter file. 'shards'
+            defaults to 1; 'cores' of 0 splits the CPU cores over the shards.
+
+    Returns:
+        tuple: (shards, cores); cores is None to keep the SIRIUS default.
+    """
+    shards = max(1, int(tool_config.get('shards', 1)))
+    cores = int(tool_config.get('cores', 0))
+    if cores <= 0:
+        cores = None if shards == 1 else max(1, (os.cpu_count() or 1) // shards)
+    return shards, cores
+
+
+def run_sharded_sirius(run_shard, ms_content, input_dir, output_dir, shards=1, cores=None, cost_model=None):
+    """
+    Run SIRIUS on balanced shards of an .ms file, one SIRIUS process per shard.
+
+    With a single shard the .ms content is written to input_dir/converted_ms.ms
+    and SIRIUS writes to output_dir as before. Otherwise shard i is written to
+    input_dir/shard_<i>.ms and its results go to output_dir/shard_<i>; use
+    sirius_result_files to read the per-compound results of every layout.
+
+    Shards are balanced on the runtime expected by cost_model (longest first,
+    and longest first within each shard), and the measured runtime of every
+    shard that exits with code 0 is recorded back into it.
+
+    Args:
+        run_shard (callable): run_shard(shard_output_dir, shard_input_path, cores, total)
+            runs one SIRIUS process on total compounds and returns its exit code
+            (None if it was killed), e.g. a lambda calling run_sirius.
+        ms_content (str): Content of the .ms file.
+        input_dir (str): Folder for the .ms input files.
+        output_dir (str): SIRIUS output folder.
+        shards (int): Number of SIRIUS processes.
+        cores (int or None): --cores value of each SIRIUS process.
+        cost_model (scheduler.CostModel, optional): Runtime model of this SIRIUS step.
+    """
+    blocks = split_ms_blocks(ms_content)
+    block_costs = [ms_block_cost(block) for block in blocks]
+
+    def timed_run(shard_output_dir, input_path, shard_costs):
+        start = time.time()
+        returncode = run_shard(shard_output_dir, input_path, cores, len(shard_costs))
+        # Killed or failed runs would teach the model timeouts instead of runtimes
+        if cost_model is not None and returncode == 0:
+            cost_model.record(shard_costs, time.time() - start)
+
+    if shards <= 1 or len(blocks) <= 1:
+        input_path = os.path.join(input_dir, "converted_ms.ms")
+        with open(input_path, 'w', encoding='utf-8') as file:
+            file.write(ms_content)
+        timed_run(output_dir, input_path, block_costs)
+    else:
+        expected = cost_model.predict(block_costs) if cost_model is not None else default_cost(block_costs)
+        _run_shards(timed_run, blocks, block_costs, expected, input_dir, output_dir, shards)
+
+    if cost_model is not None:
+        cost_model.save()
+
+
+def _run_shards(timed_run, blocks, block_costs, expected, input_dir, output_dir, shards):
+    jobs = []
+    for shard, indices in enumerate(lpt_bins(expected, shards)):
+        indices = sorted(indices, key=lambda i: expected[i], reverse=True)
+        shard_blocks = [blocks[i] for i in indices]
+        input_path = os.path.join(input_dir, f"{SHARD_PREFIX}{shard:02d}.ms")
+        with open(input_path, 'w', encoding='utf-8') as file:
+            file.write("\n\n".join(shard_blocks))
+        shard_output_dir = os.path.join(output_dir, f"{SHARD_PREFIX}{shard:02d}")
+        os.makedirs(shard_output_dir, exist_ok=True)
+        jobs.append((shard_output_dir, input_path, [block_costs[i] for i in indices]))
+        logging.info(f"SIRIUS shard {shard}: {len(shard_blocks)} compounds, expected cost {sum(expected[i] for i in indices):.1f}")
+
+    with ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+        futures = [executor.submit(timed_run, *job) for job in jobs]
+        for future in futures:
+            future.result()
+
+
+def ms_block_compound(block):
+    """Compound name of an .ms compound block, from its '>compound' line."""
+    for line in block.splitlines():
+        if line.startswith(">compound"):
+            return line[len(">compound"):].strip()
+    return ""
+
+
+def finished_compounds(output_dir, filename):
+    """
+    Names of the compounds with a result file in a SIRIUS output folder.
+
+    Compound folders are named '<index>_<input file name>_<compound>'.
+    """
+    return {
+        os.path.basename(os.path.dirname(path)).rsplit("_", 1)[-1]
+        for path in glob.glob(os.path.join(output_dir, "*", filename))
+    }
+
+
+def unfinished_compound_retry(command, output_dir, filename):
+    """
+    retry_command for tool_supervisor.run_supervised of a SIRIUS run.
+
+    After a timeout, the compounds of the last '-i' input that have no filename
+    result in output_dir are written to '<input>_retry<n>.ms'. The first of
+    them in input order is the oldest one SIRIUS was still working on, so it
+    is taken as the compound SIRIUS got stuck on and left out. Finished
+    compounds stay in the output folder and are not computed again.
+
+    Args:
+        command (list): SIRIUS command line of the first attempt.
+        output_dir (str): SIRIUS output folder of the run.
+        filename (str): Per-compound result file, e.g. 'formula_candidates.tsv'.
+
+    Returns:
+        callable: retry_command(started) returning the command of the next
+            attempt, None if no compound is left.
+    """
+    input_index = command.index("-i") + 1
+    input_path = command[input_index]
+    base, ext = os.path.splitext(input_path)
+    state = {"input": input_path, "attempt": 0}
+
+    def retry_command(started):
+        with open(state["input"], encoding='utf-8') as file:
+            blocks = split_ms_blocks(file.read())
+        finished = finished_compounds(output_dir, filename)
+        unfinished = [block for block in blocks if ms_block_compound(block) not in finished]
+        if not unfinished:
+            return None
+        logging.warning(
+            f"SIRIUS timed out on {input_path}: {len(blocks) - len(unfinished)} of {len(blocks)} compounds done, "
+            f"skipping compound {ms_block_compound(unfinished[0])}"
+        )
+        if len(unfinished) == 1:
+            return None
+        state["attempt"] += 1
+        state["input"] = f"{base}_retry{state['attempt']}{ext}"
+        with open(state["input"], 'w', encoding='utf-8') as file:
+            file.write("\n\n".join(unfinished[1:]))
+        return command[:input_index] + [state["input"]] + command[input_index + 1:]
+
+    return retry_command
+
+
+def shard_log_name(tool, output_dir):
+    """Log name of a SIRIUS run, e.g. 'sirius_formula' or 'sirius_formula_shard_01' for a shard."""
+    folder = os.path.basename(os.path.normpath(output_dir))
+    return f"{tool}_{folder}" if folder.startswith(SHARD_PREFIX) else tool
+
+
+def sirius_result_files(sirius_folder, filename):
+    """
+    Per-compound SIRIUS result files of a single run or of sharded runs.
+
+    Compound folders are either directly inside sirius_folder or inside its
+    shard_<i> folders; the compound folder name carries the spectrum ID.
+    """
+    paths = glob.glob(os.path.join(sirius_folder, "*", filename))
+    paths += glob.glob(os.path.join(sirius_folder, f"{SHARD_PREFIX}*", "*", filename))
+    return sorted(paths)
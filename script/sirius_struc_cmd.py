@@ -1,7 +1,8 @@
 import os
-import subprocess
 import wexpect
 import sys
+from tool_supervisor import run_supervised
+from sirius_sharding import shard_log_name, unfinished_compound_retry
 
 def sirius_login(sirius_directory, username, password):
     """
@@ -38,7 +39,7 @@ def sirius_login(sirius_directory, username, password):
     finally:
         child.close()
 
-def run_sirius_struc(sirius_outputdir, sirius_inputdir, sirius_path, structure_search_db, config):
+def run_sirius_struc(sirius_outputdir, sirius_inputdir, sirius_path, structure_search_db, config, cores=None, total=None):
     """
     Runs the Sirius structure prediction tool with the specified parameters.
 
@@ -47,15 +48,19 @@ def run_sirius_struc(sirius_outputdir, sirius_inputdir, sirius_path, structure_s
         sirius_inputdir (str): Path to the input MS data file.
         sirius_path (str): Path to the Sirius executable.
         structure_search_db (str): Path to the structure search database.
+        config (dict): Parameter file settings.
+        cores (int, optional): Number of CPU cores SIRIUS may use (SIRIUS default if None).
+        total (int, optional): Number of compounds in the input, for progress reporting.
 
     Returns:
-        None
+        int or None: SIRIUS exit code, None if it timed out or could not run.
     """
     ms2 = config['structure_prediction']['sirius']['MS2_ppm']
     
     # Construct the command for running Sirius with the necessary parameters
     command = [
         sirius_path,
+        *(["--cores", str(cores)] if cores else []),
         "-i", sirius_inputdir,
         "-o", sirius_outputdir,
         "config",
@@ -96,10 +101,11 @@ def run_sirius_struc(sirius_outputdir, sirius_inputdir, sirius_path, structure_s
     ]
 
     try:
-        with subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1) as proc:
-            for line in proc.stdout:
-                print(line, end="")
-            proc.wait()
+        return run_supervised(
+            command, shard_log_name("sirius_structure", sirius_outputdir), config.get('supervisor'), total=total,
+            retry_command=unfinished_compound_retry(command, sirius_outputdir, "structure_candidates.tsv")
+        )
 
     except Exception as e:
         print(f"An error occurred during SIRIUS execution: {e}")
+        return None
@@ -1,9 +1,9 @@
 import os
-import glob
 import pandas as pd
-import joblib
 from convert_struc_data_type import normalize_rank_score, smiles_list_to_inchikeys
-from struc_score_normalization import ClippingTransformer
+from struc_score_normalization import load_score_normalizer
+from sirius_sharding import sirius_result_files
+from summary_utility import read_top_n_rows, pivot_top_candidates, assign_spectrum_id
 
 def process_sirius_output(sirius_folder, machine_dir, name_adduct_df, 
                           summary_inchikey_df, summary_smiles_df, 
@@ -14,7 +14,7 @@ def process_sirius_output(sirius_folder, machine_dir, name_adduct_df,
     Parameters:
         sirius_folder (str): Directory containing SIRIUS output files.
         machine_dir (str): Directory containing score normalization pipelines.
-        name_adduct_df (pd.DataFrame): DataFrame mapping filenames to adducts.
+        name_adduct_df (pd.DataFrame): DataFrame mapping spectrum IDs to adducts.
         summary_inchikey_df (pd.DataFrame): Existing InChIKey summary DataFrame.
         summary_smiles_df (pd.DataFrame): Existing SMILES summary DataFrame.
         class_summary_df (pd.DataFrame): Existing classification summary DataFrame.
@@ -25,7 +25,7 @@ def process_sirius_output(sirius_folder, machine_dir, name_adduct_df,
     """
 
     # Retrieve SIRIUS output files
-    sirius_paths = glob.glob(f"{sirius_folder}/*/structure_candidates.tsv")
+    sirius_paths = sirius_result_files(sirius_folder, "structure_candidates.tsv")
 
     if not sirius_paths:
         print(f"No SIRIUS files found in {sirius_folder}")
@@ -34,8 +34,8 @@ def process_sirius_output(sirius_folder, machine_dir, name_adduct_df,
     data_frames = []
     for file in sirius_paths:
         try:
-            df = pd.read_csv(file, sep='\t')
-            df['filename'] = os.path.basename(os.path.dirname(file)).split('_')[-1]
+            df = read_top_n_rows(file, top_n, sep='\t')
+            df = assign_spectrum_id(df, [os.path.basename(os.path.dirname(file))] * len(df))
             data_frames.append(df)
         except Exception as e:
             print(f"Error reading {file}: {e}")
@@ -47,7 +47,7 @@ def process_sirius_output(sirius_folder, machine_dir, name_adduct_df,
     combined_data = pd.concat(data_frames, ignore_index=True)
 
     # Assign rank
-    combined_data["rank"] = combined_data.groupby("filename").cumcount() + 1
+    combined_data["rank"] = combined_data.groupby("spectrum_id").cumcount() + 1
 
     # Determine score column
     score_column = "CSI:FingerIDScore" if "CSI:FingerIDScore" in combined_data.columns else "score"
@@ -72,53 +72,47 @@ def process_sirius_output(sirius_folder, machine_dir, name_adduct_df,
     sirius_score_pipeline_path = os.path.join(machine_dir, "pipeline_CSI_FingerIDScore.pkl")
     sirius_SD_pipeline_path = os.path.join(machine_dir, "pipeline_sirius_score_diff.pkl")
 
-    score_pipeline = joblib.load(sirius_score_pipeline_path)
-    SD_pipeline = joblib.load(sirius_SD_pipeline_path)
+    score_normalizer = load_score_normalizer(sirius_score_pipeline_path)
+    SD_normalizer = load_score_normalizer(sirius_SD_pipeline_path)
 
     # Select top 3 ranked candidates
-    filtered_df = combined_data.groupby('filename').head(top_n).copy()
+    filtered_df = combined_data.groupby('spectrum_id').head(top_n).copy()
 
     # Normalize scores
-    filtered_df["normalization_Zscore"] = score_pipeline.transform(filtered_df[[score_column]])
-    filtered_df["normalization_z_score_diff"] = SD_pipeline.transform(filtered_df[["score_diff"]])
+    filtered_df["normalization_Zscore"] = score_normalizer(filtered_df[score_column])
+    filtered_df["normalization_z_score_diff"] = SD_normalizer(filtered_df["score_diff"])
 
     # Prepare score calculation DataFrame
-    sirius_score_calc_df = filtered_df[["filename", "adduct", "rank", "smiles", "normalization_Zscore", "normalization_z_score_diff"]].copy()
+    sirius_score_calc_df = filtered_df[["spectrum_id", "adduct", "rank", "smiles", "normalization_Zscore", "normalization_z_score_diff"]].copy()
     sirius_score_calc_df = sirius_score_calc_df.rename(columns={"smiles": "SMILES"})
     sirius_score_calc_df["tool_name"] = "sirius"
-    sirius_score_calc_df["Used_tools"] = sirius_score_calc_df["rank"].apply(lambda r: f"SIRIUS_Rank:{r}")
 
     # Map adducts from `name_adduct_df`
-    sirius_score_calc_df['adduct'] = sirius_score_calc_df['filename'].map(name_adduct_df.set_index('filename')['adduct'])
+    sirius_score_calc_df['adduct'] = sirius_score_calc_df['spectrum_id'].map(name_adduct_df.set_index('spectrum_id')['adduct'])
 
     # Apply rank normalization function
     normalize_rank_score(sirius_score_calc_df)
 
-    # Convert SMILES to InChIKey
-    filtered_df["InChIKey"] = smiles_list_to_inchikeys(filtered_df["smiles"])
+    # Convert SMILES to InChIKey (only for the candidates shown in the summary)
     filtered_df['rank'] = filtered_df['rank'].astype(int)
-    top5_smiles_df = filtered_df[filtered_df['rank'] <= 5]
-    filtered_df = filtered_df.astype(str).fillna('')
+    top5_smiles_df = filtered_df[filtered_df['rank'] <= 5].copy()
+    top5_smiles_df["InChIKey"] = smiles_list_to_inchikeys(top5_smiles_df["smiles"])
 
-    # Pivot InChIKey and SMILES data
-    inchikey_pivot = filtered_df.pivot(index=["filename"], columns=["rank"], values=["InChIKey"])
-    smiles_pivot = top5_smiles_df.pivot(index=["filename"], columns=["rank"], values=["smiles"])
-
-    inchikey_pivot.columns = [f'sirius_structure_{col[1]}' for col in inchikey_pivot.columns.values]
-    smiles_pivot.columns = [f'sirius_structure_{col[1]}' for col in smiles_pivot.columns.values]
+    # Pivot InChIKey and SMILES data in a single reshape
+    wide_tables = pivot_top_candidates(top5_smiles_df, ["InChIKey", "smiles"], "sirius_structure")
 
     # Merge InChIKey data
-    sirius_inchikey_df = summary_inchikey_df.merge(inchikey_pivot.reset_index(), on=["filename"], how="outer")
+    sirius_inchikey_df = summary_inchikey_df.join(wide_tables["InChIKey"], on="spectrum_id")
 
     # Merge SMILES data
-    sirius_smiles_df = summary_smiles_df.merge(smiles_pivot.reset_index(), on=["filename"], how="outer")
+    sirius_smiles_df = summary_smiles_df.join(wide_tables["smiles"], on="spectrum_id")
 
     # Extract classification data (only rank 1)
-    sirius_class_data = filtered_df[filtered_df['rank'] == '1'][['filename', 'InChIKey', 'smiles']]
+    sirius_class_data = top5_smiles_df.loc[top5_smiles_df['rank'] == 1, ['spectrum_id', 'InChIKey', 'smiles']].fillna('').astype({'InChIKey': str, 'smiles': str})
     sirius_class_data = sirius_class_data[(sirius_class_data['InChIKey'].str.strip() != '') & 
                                           (sirius_class_data['smiles'].str.strip() != '')]
     sirius_class_data['tool_name'] = "SIRIUS"
-    sirius_class_data.columns = ['filename', 'InChIKey', 'SMILES', 'tool_name']
+    sirius_class_data.columns = ['spectrum_id', 'InChIKey', 'SMILES', 'tool_name']
 
     # Append new classification data
     class_summary_df = pd.concat([class_summary_df, sirius_class_data], ignore_index=True)
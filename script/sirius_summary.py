@@ -1,13 +1,13 @@
 import os
-import glob
 import pandas as pd
-import joblib
-from converting_data_type import ClippingTransformer
+from struc_score_normalization import load_score_normalizer
 from convert_struc_data_type import normalize_rank_score
+from sirius_sharding import sirius_result_files
+from summary_utility import read_top_n_rows, pivot_top_candidates, assign_spectrum_id
 
 def process_sirius_summary(sirius_folder, machine_dir, name_adduct_df, summary_df, score_df, top_n = 5):
     # Read Sirius output files
-    sirius_paths = glob.glob(f"{sirius_folder}/*/formula_candidates.tsv")
+    sirius_paths = sirius_result_files(sirius_folder, "formula_candidates.tsv")
     if not sirius_paths:
         print(f"No Sirius files found in {sirius_folder}")
         return summary_df, score_df
@@ -15,8 +15,8 @@ def process_sirius_summary(sirius_folder, machine_dir, name_adduct_df, summary_d
     data_frames = []
     for file in sirius_paths:
         try:
-            df = pd.read_csv(file, sep='\t')
-            df['filename'] = os.path.basename(os.path.dirname(file)).split('_')[-1]
+            df = read_top_n_rows(file, top_n, sep='\t')
+            df = assign_spectrum_id(df, [os.path.basename(os.path.dirname(file))] * len(df))
             data_frames.append(df)
         except Exception as e:
             print(f"Error reading {file}: {e}")
@@ -25,7 +25,7 @@ def process_sirius_summary(sirius_folder, machine_dir, name_adduct_df, summary_d
         return summary_df, score_df
     
     conbine_data = pd.concat(data_frames, ignore_index=True)
-    conbine_data["rank"] = conbine_data.groupby("filename").cumcount() + 1
+    conbine_data["rank"] = conbine_data.groupby("spectrum_id").cumcount() + 1
     score_column = "SiriusScore" if "SiriusScore" in conbine_data.columns else "score"
     conbine_data["score_diff"] = 0 
     
@@ -45,34 +45,25 @@ def process_sirius_summary(sirius_folder, machine_dir, name_adduct_df, summary_d
     sirius_score_pipeline_path = os.path.join(machine_dir, "pipline_sirius_score.pkl")
     sirius_SD_pipeline_path = os.path.join(machine_dir, "pipline_sirius_score_diff.pkl")
     
-    score_pipeline = joblib.load(sirius_score_pipeline_path)
-    SD_pipeline = joblib.load(sirius_SD_pipeline_path)
+    score_normalizer = load_score_normalizer(sirius_score_pipeline_path)
+    SD_normalizer = load_score_normalizer(sirius_SD_pipeline_path)
     
-    filtered_df = conbine_data.groupby('filename').head(top_n).copy()
-    filtered_df["Score_NZ"] = score_pipeline.transform(filtered_df[[score_column]])
-    filtered_df["Score_NZ_diff"] = SD_pipeline.transform(filtered_df[["score_diff"]])
+    filtered_df = conbine_data.groupby('spectrum_id').head(top_n).copy()
+    filtered_df["Score_NZ"] = score_normalizer(filtered_df[score_column])
+    filtered_df["Score_NZ_diff"] = SD_normalizer(filtered_df["score_diff"])
     filtered_df.rename(columns={"molecularFormula": "formula"}, inplace=True)
     
-    sirius_score_calc_df = filtered_df[["filename", "adduct", "rank", "formula", "Score_NZ", "Score_NZ_diff"]]
+    sirius_score_calc_df = filtered_df[["spectrum_id", "adduct", "rank", "formula", "Score_NZ", "Score_NZ_diff"]]
     sirius_score_calc_df["tool_name"] = "sirius"
-    sirius_score_calc_df['Used_tools'] = sirius_score_calc_df["rank"].apply(lambda r: f"SIRIUS_Rank:{r}")
     
-    sirius_score_calc_df['adduct'] = sirius_score_calc_df['filename'].map(name_adduct_df.set_index('filename')['adduct'])
+    sirius_score_calc_df['adduct'] = sirius_score_calc_df['spectrum_id'].map(name_adduct_df.set_index('spectrum_id')['adduct'])
     
     normalize_rank_score(sirius_score_calc_df)  # Assuming normalize_rank is defined elsewhere
     
+    # Spread the top 5 formulas into sirius_formula_1..5 columns
     filtered_df['rank'] = filtered_df['rank'].astype(int)
-    top5_df = filtered_df[filtered_df['rank'] <= 5]
-    filtered_df = filtered_df.astype(str).fillna('')
-    formula_pivot = top5_df[["filename", "adduct", "rank", "formula"]].pivot(
-        index=["filename"], 
-        columns=["rank"], 
-        values=["formula"]
-    )
-    
-    formula_pivot.columns = [f'sirius_formula_{col[1]}' for col in formula_pivot.columns.values]
-    pivot = formula_pivot.reset_index()
-    sirius_formula_df = summary_df.merge(pivot, on=["filename"], how="outer")
+    formula_pivot = pivot_top_candidates(filtered_df, ["formula"], "sirius_formula")["formula"]
+    sirius_formula_df = summary_df.join(formula_pivot, on="spectrum_id")
     
     score_df = pd.concat([score_df, sirius_score_calc_df], ignore_index=True)
     
@@ -0,0 +1,207 @@
+import logging
+import numpy as np
+import pandas as pd
+from msp_format_change import parse_msp_blocks
+from result_writer import reserve_output_path
+
+# Defaults of the 'deduplication' section of the parameter file
+DEFAULT_SETTINGS = {
+    "enabled": False,
+    "mz_tolerance": 0.005,
+    "rt_window": 0.1,
+    "min_cosine": 0.95,
+    "bin_width": 0.05,
+}
+
+# Expanded peak entries compared per NumPy batch in binned_cosine
+_BATCH_ENTRIES = 1_000_000
+
+
+def dedup_settings(section=None):
+    """Merge the 'deduplication' section of the parameter file over DEFAULT_SETTINGS."""
+    settings = dict(DEFAULT_SETTINGS)
+    settings.update({key: value for key, value in (section or {}).items() if value is not None})
+    return settings
+
+
+def _float_field(block, key):
+    try:
+        return float(block.get(key, ""))
+    except ValueError:
+        return np.nan
+
+
+def binned_spectra(peak_lists, bin_width):
+    """
+    Sparse binned spectra for cosine comparison.
+
+    Intensities falling into the same m/z bin are summed, square-root scaled
+    and normalised to unit length per spectrum.
+
+    Args:
+        peak_lists (list): (m/z, intensity) pairs of every spectrum.
+        bin_width (float): Bin width in Da.
+
+    Returns:
+        tuple: Sorted keys (spectrum * n_bins + bin), their weights, the first
+            key index and the key count of every spectrum, and n_bins.
+    """
+    counts = np.array([len(peaks) for peaks in peak_lists], dtype=np.int64)
+    peaks = np.array([peak for peaks in peak_lists for peak in peaks], dtype=np.float64).reshape(-1, 2)
+    bins = np.maximum(np.floor(peaks[:, 0] / bin_width), 0).astype(np.int64)
+    n_bins = int(bins.max()) + 1 if len(bins) else 1
+
+    keys, inverse = np.unique(np.repeat(np.arange(len(peak_lists)), counts) * n_bins + bins, return_inverse=True)
+    weights = np.sqrt(np.bincount(inverse, weights=np.clip(peaks[:, 1], 0, None), minlength=len(keys)))
+    owner = keys // n_bins
+    norms = np.sqrt(np.bincount(owner, weights=weights ** 2, minlength=len(peak_lists)))
+    weights = weights / np.where(norms[owner] > 0, norms[owner], 1.0)
+
+    counts = np.bincount(owner, minlength=len(peak_lists))
+    starts = np.cumsum(counts) - counts
+    return keys, weights, starts, counts, n_bins
+
+
+def binned_cosine(binned, left, right):
+    """
+    Cosine similarity of the spectrum pairs (left[i], right[i]).
+
+    Every bin of the left spectrum is looked up among the keys of the right
+    spectrum with one searchsorted call per batch of pairs.
+    """
+    keys, weights, starts, counts, n_bins = binned
+    scores = np.zeros(len(left))
+    if len(left) == 0 or len(keys) == 0:
+        return scores
+
+    entries = np.cumsum(counts[left])
+    begin = 0
+    while begin < len(left):
+        done = entries[begin - 1] if begin else 0
+        end = max(int(np.searchsorted(entries, done + _BATCH_ENTRIES, side="right")), begin + 1)
+        batch_left, batch_right = left[begin:end], right[begin:end]
+        batch_counts = counts[batch_left]
+
+        pair = np.repeat(np.arange(end - begin), batch_counts)
+        entry = np.repeat(starts[batch_left] - (np.cumsum(batch_counts) - batch_counts), batch_counts) + np.arange(len(pair))
+        lookup = batch_right[pair] * n_bins + keys[entry] % n_bins
+        position = np.minimum(np.searchsorted(keys, lookup), len(keys) - 1)
+        hit = keys[position] == lookup
+        scores[begin:end] = np.bincount(
+            pair[hit], weights=weights[entry[hit]] * weights[position[hit]], minlength=end - begin
+        )
+        begin = end
+    return scores
+
+
+def candidate_pairs(precursor_mz, retention_time, adducts, mz_tolerance, rt_window):
+    """
+    Spectrum pairs with the same adduct, precursor m/z within mz_tolerance and RT within rt_window.
+
+    Spectra without a precursor m/z are never paired. Spectra without a
+    retention time are only paired with each other.
+
+    Returns:
+        tuple: Index arrays (left, right) with left < right.
+    """
+    codes = pd.factorize(pd.Series(adducts, dtype=object))[0]
+    lefts, rights = [], []
+    for code in np.unique(codes):
+        members = np.flatnonzero((codes == code) & ~np.isnan(precursor_mz))
+        members = members[np.argsort(precursor_mz[members], kind="stable")]
+        mz = precursor_mz[members]
+        # Sorted positions after i up to the end of its tolerance window
+        n_partners = np.searchsorted(mz, mz + mz_tolerance, side="right") - np.arange(len(mz)) - 1
+        first = np.repeat(np.arange(len(mz)), n_partners)
+        offset = np.arange(len(first)) - np.repeat(np.cumsum(n_partners) - n_partners, n_partners)
+        lefts.append(members[first])
+        rights.append(members[first + 1 + offset])
+
+    left = np.concatenate(lefts) if lefts else np.empty(0, dtype=np.int64)
+    right = np.concatenate(rights) if rights else np.empty(0, dtype=np.int64)
+    left, right = np.minimum(left, right), np.maximum(left, right)
+
+    rt_left, rt_right = retention_time[left], retention_time[right]
+    both_missing = np.isnan(rt_left) & np.isnan(rt_right)
+    with np.errstate(invalid="ignore"):
+        keep = both_missing | (np.abs(rt_left - rt_right) <= rt_window)
+    return left[keep], right[keep]
+
+
+def cluster_representatives(n_spectra, left, right):
+    """
+    Representative spectrum index of every spectrum.
+
+    Spectra are visited in input order; a spectrum that is not yet assigned
+    represents itself and every unassigned spectrum it is paired with. Every
+    duplicate is therefore similar to its representative itself, not only
+    through a chain of other duplicates.
+    """
+    representative = np.full(n_spectra, -1, dtype=np.int64)
+    source = np.concatenate([left, right])
+    target = np.concatenate([right, left])
+    order = np.argsort(source, kind="stable")
+    source, target = source[order], target[order]
+    bounds = np.searchsorted(source, np.arange(n_spectra + 1))
+    for i in range(n_spectra):
+        if representative[i] >= 0:
+            continue
+        representative[i] = i
+        neighbours = target[bounds[i]:bounds[i + 1]]
+        representative[neighbours[representative[neighbours] < 0]] = i
+    return representative
+
+
+def deduplicate_spectra(msp_data, name_df, settings=None):
+    """
+    Keep one representative of every group of repeated spectra.
+
+    Spectra are duplicates of a representative when they have the same
+    adduct, a precursor m/z within mz_tolerance, a retention time within
+    rt_window and a binned cosine similarity of at least min_cosine.
+
+    Args:
+        msp_data (str): MSP text from convert_name_to_peakid.
+        name_df (pd.DataFrame): spectrum_id to Original_NAME mapping.
+        settings (dict, optional): 'deduplication' section of the parameter file.
+
+    Returns:
+        tuple: MSP text with the representatives only, and name_df with a
+            'representative_id' column. Results of a representative are
+            written for every spectrum it represents (apply_original_names).
+    """
+    settings = dedup_settings(settings)
+    blocks = parse_msp_blocks(msp_data)
+    spectrum_ids = np.array([int(block["name"]) for block in blocks], dtype=np.int64)
+    precursor_mz = np.array([_float_field(block, "precursormz") for block in blocks])
+    retention_time = np.array([_float_field(block, "retentiontime") for block in blocks])
+    adducts = [block.get("precursortype", "") for block in blocks]
+
+    left, right = candidate_pairs(precursor_mz, retention_time, adducts, settings["mz_tolerance"], settings["rt_window"])
+    if len(left):
+        binned = binned_spectra([block["peaks"] for block in blocks], settings["bin_width"])
+        similar = binned_cosine(binned, left, right) >= settings["min_cosine"]
+        left, right = left[similar], right[similar]
+    representative = cluster_representatives(len(blocks), left, right)
+
+    kept = np.flatnonzero(representative == np.arange(len(blocks)))
+    representative_ids = pd.Series(spectrum_ids[representative], index=spectrum_ids)
+    name_df = name_df.copy()
+    name_df["representative_id"] = (
+        name_df["spectrum_id"].map(representative_ids).fillna(name_df["spectrum_id"]).astype(name_df["spectrum_id"].dtype)
+    )
+    logging.info(f"Deduplication kept {len(kept)} of {len(blocks)} spectra")
+    print(f"Deduplication: {len(blocks)} spectra, {len(kept)} annotated after removing repeated spectra")
+    return "\n\n".join(blocks[i]["text"] for i in kept), name_df
+
+
+def write_duplicate_table(name_df, output_dir):
+    """Write the spectrum name -> representative spectrum name table of a deduplicated run."""
+    original_names = name_df.set_index("spectrum_id")["Original_NAME"]
+    table = pd.DataFrame({
+        "filename": name_df["Original_NAME"],
+        "representative": name_df["representative_id"].map(original_names),
+    })
+    path = reserve_output_path(output_dir, "duplicate_spectra", ".csv")
+    table.to_csv(path, index=False)
+    return path
@@ -9,12 +9,16 @@ import yaml
 from metfrag_file_processing import creat_metfrag_file
 from metfrag_struc_cmd import run_metfrag_command
 from splitting_msp import read_msp
-from msfinder_struc_cmd import run_msfinder, process_folder
+from msfinder_struc_cmd import run_msfinder, process_folder, prune_unmatched_spectra
+from msfinder_parallel import write_msp_parts, run_msfinder_parts, filter_msp_parts
+from parameter_renderer import render_parameter_file
 from msp_to_ms import convert_msp_file_to_ms
 from sirius_struc_cmd import sirius_login, run_sirius_struc
-from creating_struc_summary import struc_summary
-from struc_utility import clear_folder, clear_folder_except, save_file, generate_unique_filename
-from struc_score_normalization import ClippingTransformer
+from sirius_sharding import run_sharded_sirius, shard_settings
+from scheduler import CostModel
+from creating_struc_summary import collect_structure_candidates, write_structure_results
+from summary_utility import save_candidate_cache
+from struc_utility import clear_folder, clear_folder_except
 
 # Clear required folders
 def structure_elucidation(input_msp, summary_output_dir, username, password, name_df):
@@ -32,11 +36,11 @@ def structure_elucidation(input_msp, summary_output_dir, username, password, nam
     msfinder_formula_method_path = os.path.join(current_dir, "msfinder", "MsfinderConsoleApp_Param_formula.txt")
     msfinder_structure_method_path = os.path.join(current_dir, "msfinder", "MsfinderConsoleApp-Param2_structure.txt")
     msp_folder = os.path.join(current_dir, "msfinder", "msp")
+    msfinder_pruned_folder = os.path.join(current_dir, "msfinder", "msp_pruned")
     metfrag_paramater_dir = os.path.join(current_dir, "metfrag")
     ms_dir = os.path.join(current_dir, "sirius", "ms")
     sirius_directory = os.path.join(current_dir, "sirius")
     sirius_outputdir = os.path.join(sirius_directory, "output")
-    sirius_inputdir = os.path.join(ms_dir, "converted_ms.ms")
     sirius_path = os.path.join(sirius_directory, "sirius.exe")
     structure_search_db = os.path.join(sirius_directory, "database")
     machine_dir = os.path.join(current_dir, "structure_scoring_model")
@@ -50,7 +54,7 @@ def structure_elucidation(input_msp, summary_output_dir, username, password, nam
     # Clear required folders.
     metfrag_exclude_items = ["example_paramater.txt", "library_psv_v2.txt", "MetFragCommandLine-2.5.0.jar"]
     clear_folder_except(metfrag_paramater_dir, metfrag_exclude_items)
-    for folder in [msp_folder, ms_dir, msfinder_folder, sirius_outputdir]:
+    for folder in [msp_folder, msfinder_pruned_folder, ms_dir, msfinder_folder, sirius_outputdir]:
         clear_folder(folder)
 
     # Ensure necessary folders exist.
@@ -64,9 +68,15 @@ def structure_elucidation(input_msp, summary_output_dir, username, password, nam
     print("SIRIUS processing start")
     try:
         ms_file = convert_msp_file_to_ms(input_msp)
-        save_file(sirius_inputdir, ms_file)
         sirius_login(sirius_directory, username, password)
-        run_sirius_struc(sirius_outputdir, sirius_inputdir, sirius_path, structure_search_db, config)
+        shards, cores = shard_settings(config['structure_prediction']['sirius'])
+        run_sharded_sirius(
+            lambda output_dir, input_path, shard_cores, total: run_sirius_struc(
+                output_dir, input_path, sirius_path, structure_search_db, config, cores=shard_cores, total=total
+            ),
+            ms_file, ms_dir, sirius_outputdir, shards=shards, cores=cores,
+            cost_model=CostModel("sirius_structure")
+        )
     except Exception as e:
         logging.error(f"SIRIUS processing failed: {e}")
     sirius_end_time = time.time()
@@ -76,25 +86,23 @@ def structure_elucidation(input_msp, summary_output_dir, username, password, nam
     # MetFrag Processing
     metfrag_start_time = time.time()
     print("MetFrag processing start")
-    with open(os.path.join(metfrag_paramater_dir, "example_paramater.txt"), 'r') as file:
-        lines = file.readlines()
-    with open(os.path.join(metfrag_paramater_dir, "example_paramater.txt"), 'w') as file:
-        for line in lines:
-            if line.startswith('FragmentPeakMatchAbsoluteMassDeviation'):
-                line = f'FragmentPeakMatchAbsoluteMassDeviation = {config["structure_prediction"]["metfrag"]["MS2_Da"]}\n'
-            elif line.startswith('FragmentPeakMatchRelativeMassDeviation'):
-                line = f'FragmentPeakMatchRelativeMassDeviation = {config["structure_prediction"]["metfrag"]["MS2_ppm"]}\n'
-            file.write(line)
-    
+    metfrag_parameter_file = render_parameter_file(
+        os.path.join(metfrag_paramater_dir, "example_paramater.txt"),
+        {
+            'FragmentPeakMatchAbsoluteMassDeviation': f'FragmentPeakMatchAbsoluteMassDeviation = {config["structure_prediction"]["metfrag"]["MS2_Da"]}\n',
+            'FragmentPeakMatchRelativeMassDeviation': f'FragmentPeakMatchRelativeMassDeviation = {config["structure_prediction"]["metfrag"]["MS2_ppm"]}\n',
+        }
+    )
 
     try:
         creat_metfrag_file(
             input_msp, 
-            os.path.join(metfrag_paramater_dir, "example_paramater.txt"),
+            metfrag_parameter_file,
             metfrag_paramater_dir, 
-            os.path.join(metfrag_paramater_dir, "library_psv_v2.txt")
+            os.path.join(metfrag_paramater_dir, "library_psv_v2.txt"),
+            config.get('file_writer', {}).get('workers', 1)
         )
-        run_metfrag_command(metfrag_paramater_dir)
+        run_metfrag_command(metfrag_paramater_dir, config.get('supervisor'))
     except Exception as e:
         logging.error(f"MetFrag processing failed: {e}")
     print("MetFrag processing complete")
@@ -106,12 +114,31 @@ def structure_elucidation(input_msp, summary_output_dir, username, password, nam
     print("MS-FINDER processing start")
     try:
         split_data = read_msp(input_msp)
-        for filename, content in split_data.items():
-            save_file(os.path.join(msp_folder, f"{filename}.msp"), content)
-        run_msfinder(msfinder_directory, msp_folder, msfinder_folder, msfinder_formula_method_path, library_path, config) # Run formula prediction
-        process_folder(msp_folder) # Process the MSP files to extract formulas and prepare MS-FINDER input
+        formula_cost_model = CostModel("msfinder_struc_formula")
+        structure_cost_model = CostModel("msfinder_structure")
+        msp_parts = write_msp_parts(
+            split_data, msp_folder, config['structure_prediction']['msfinder'].get('processes', 1), structure_cost_model,
+            config.get('file_writer', {}).get('workers', 1)
+        )
+
+        def run_msfinder_step(method_path, cost_model, log_name, parts):
+            run_msfinder_parts(
+                lambda input_folder, output_folder, total: run_msfinder(
+                    msfinder_directory, input_folder, output_folder, method_path, library_path, config,
+                    log_name=log_name, total=total
+                ),
+                parts, msfinder_folder, cost_model
+            )
+
+        run_msfinder_step(msfinder_formula_method_path, formula_cost_model, "msfinder_struc_formula", msp_parts) # Run formula prediction
+        pruned = set()
+        for part in msp_parts:
+            matches = process_folder(part.folder) # Process the MSP files to extract formulas and prepare MS-FINDER input
+            if config['structure_prediction']['msfinder'].get('prune_unmatched', True):
+                pruned |= prune_unmatched_spectra(part.folder, matches, msfinder_pruned_folder)
+        msp_parts = filter_msp_parts(msp_parts, pruned)
         clear_folder(msfinder_folder) # Clear formula prediction results to prepare for structure prediction
-        run_msfinder(msfinder_directory, msp_folder, msfinder_folder, msfinder_structure_method_path, library_path, config) # Run structure prediction 
+        run_msfinder_step(msfinder_structure_method_path, structure_cost_model, "msfinder_structure", msp_parts) # Run structure prediction
     except Exception as e:
         logging.error(f"MSFinder processing failed: {e}")
     print("MS-FINDER processing complete")
@@ -122,21 +149,15 @@ def structure_elucidation(input_msp, summary_output_dir, username, password, nam
     summary_start_time = time.time()
     print("Generating output files...")
     try:
-        result_score_df, summary_smiles_df = struc_summary(
-            input_msp, msfinder_folder, machine_dir, sirius_outputdir, metfrag_paramater_dir, top_n=100, summary_n=config['structure_prediction']['msemblator_output_records']
+        # Keep the tool candidates so the run can be re-scored with rescore.py
+        candidates = collect_structure_candidates(
+            input_msp, msfinder_folder, machine_dir, sirius_outputdir, metfrag_paramater_dir, top_n=100
+        )
+        save_candidate_cache(summary_output_dir, "structure", candidates, name_df, top_n=100)
+        # Score and write the output files batch by batch, restoring the original spectrum names
+        result_score_file, summary_smiles_file = write_structure_results(
+            candidates, name_df, summary_output_dir, machine_dir, config
         )
-        result_score_df = pd.merge(name_df, result_score_df, left_on = "Updated_NAME", right_on = "filename")
-        result_score_df.drop(columns=["Updated_NAME", "filename"], inplace=True)
-        result_score_df.rename(columns={"Original_NAME":"filename"},inplace=True)
-        
-        summary_smiles_df = pd.merge(name_df, summary_smiles_df, left_on = "Updated_NAME", right_on = "filename")
-        summary_smiles_df.drop(columns=["Updated_NAME", "filename"], inplace=True)
-        summary_smiles_df.rename(columns={"Original_NAME":"filename","Canonical_SMILES":"Top_score_Canonical_SMILES"},inplace=True)
-
-        result_score_file = generate_unique_filename(summary_output_dir, "structure_score.csv")
-        summary_smiles_file = generate_unique_filename(summary_output_dir, "structure_summary.csv")
-        result_score_df.to_csv(os.path.join(summary_output_dir, result_score_file), index=False)
-        summary_smiles_df.to_csv(os.path.join(summary_output_dir, summary_smiles_file), index=False)
         logging.info(f"Summary saved as: {result_score_file} and {summary_smiles_file}")
     except Exception as e:
         logging.error(f"Summary generation failed: {e}")
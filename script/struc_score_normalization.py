@@ -1,7 +1,12 @@
+import sys
+import logging
+import joblib
+import numpy as np
+import pandas as pd
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import StandardScaler, MinMaxScaler
 from sklearn.base import TransformerMixin, BaseEstimator
-import numpy as np
+
 class ClippingTransformer(BaseEstimator, TransformerMixin):
     def __init__(self, q_low=None, q_high=None):
         self.q_low = q_low
@@ -15,4 +20,80 @@ class ClippingTransformer(BaseEstimator, TransformerMixin):
             raise ValueError("q_low and q_high must be specified manually before using transform().")
         
         clipped = np.clip(X.to_numpy().flatten(), self.q_low, self.q_high)
-        return clipped.reshape(-1, 1)
\ No newline at end of file
+        return clipped.reshape(-1, 1)
+
+
+def _compile_steps(pipeline):
+    """
+    Translate the fitted steps of a one-column normalization pipeline into
+    (kind, a, b) tuples, or return None if a step has no closed form here.
+    """
+    steps = pipeline.steps if isinstance(pipeline, Pipeline) else [(None, pipeline)]
+    compiled = []
+    for _, step in steps:
+        if step is None or step == "passthrough":
+            continue
+        if isinstance(step, ClippingTransformer) or type(step).__name__ == "ClippingTransformer":
+            if step.q_low is None or step.q_high is None:
+                return None
+            compiled.append(("clip", float(step.q_low), float(step.q_high)))
+        elif isinstance(step, StandardScaler):
+            mean = float(step.mean_[0]) if step.with_mean else 0.0
+            scale = float(step.scale_[0]) if step.with_std else 1.0
+            compiled.append(("standard", mean, scale))
+        elif isinstance(step, MinMaxScaler):
+            compiled.append(("minmax", float(step.scale_[0]), float(step.min_[0])))
+            if step.clip:
+                compiled.append(("clip", *map(float, step.feature_range)))
+        else:
+            return None
+    return compiled
+
+
+def _apply_steps(compiled, values):
+    x = np.asarray(values, dtype=np.float64).ravel()
+    for kind, a, b in compiled:
+        if kind == "clip":
+            x = np.clip(x, a, b)
+        elif kind == "standard":
+            x = (x - a) / b
+        else:
+            x = x * a + b
+    return x
+
+
+def _sklearn_transform(pipeline, values):
+    steps = pipeline.steps if isinstance(pipeline, Pipeline) else [(None, pipeline)]
+    columns = getattr(steps[0][1], "feature_names_in_", ["value"])
+    frame = pd.DataFrame({columns[0]: np.asarray(values, dtype=np.float64).ravel()})
+    return np.asarray(pipeline.transform(frame), dtype=np.float64).ravel()
+
+
+def load_score_normalizer(pipeline_path):
+    """
+    Load a pickled score normalization pipeline as a plain NumPy function.
+
+    The fitted clipping bounds and scaler parameters are read out of the
+    pipeline once and applied as clip / (x - mean) / scale / x * scale + min
+    on a 1-D array. Pipelines with a step that has no closed form here are
+    applied with sklearn. Parity with sklearn is covered by
+    tests/test_struc_score_normalization.py.
+
+    Args:
+        pipeline_path (str): Path to the .pkl pipeline.
+
+    Returns:
+        callable: Maps an array-like of raw scores to a 1-D float64 array.
+    """
+    # The pipelines were pickled with ClippingTransformer defined in __main__
+    main_module = sys.modules.get("__main__")
+    if main_module is not None and not hasattr(main_module, "ClippingTransformer"):
+        main_module.ClippingTransformer = ClippingTransformer
+
+    pipeline = joblib.load(pipeline_path)
+    compiled = _compile_steps(pipeline)
+    if compiled is not None:
+        return lambda values: _apply_steps(compiled, values)
+
+    logging.warning(f"Normalizer {pipeline_path} has a step without a compiled form, using the sklearn pipeline")
+    return lambda values: _sklearn_transform(pipeline, values)
@@ -0,0 +1,277 @@
+import os
+import numpy as np
+import pandas as pd
+
+SPECTRUM_ID_DTYPE = "int32"
+
+# Folder inside the summary output directory holding the candidate tables of a run
+CANDIDATE_CACHE_DIR = "msemblator_cache"
+
+# Trailing integer of a tool output name, optionally followed by a file extension
+_SPECTRUM_ID_PATTERN = r"(?<![\d.])(\d+)(?:\.[A-Za-z]\w*)?$"
+
+
+def parse_spectrum_id(names):
+    """
+    Recover the integer spectrum ID from tool-specific file or compound names.
+
+    convert_name_to_peakid renames every spectrum to a sequential number and
+    each tool echoes it at the end of its output names ("12", "12.msp",
+    "12.xls", "0_converted_ms_12"). Names without a trailing ID give <NA>.
+
+    Args:
+        names (iterable): File names, folder names or identifiers.
+
+    Returns:
+        pd.Series: Nullable Int32 spectrum IDs.
+    """
+    names = pd.Series(names).astype(str)
+    ids = names.str.extract(_SPECTRUM_ID_PATTERN, expand=False)
+    return pd.to_numeric(ids, errors="coerce").astype("Int32")
+
+
+def assign_spectrum_id(df, names):
+    """
+    Attach the parsed spectrum ID as an int32 'spectrum_id' column.
+
+    Rows whose name carries no ID cannot be matched to an input spectrum and are dropped.
+    """
+    df["spectrum_id"] = parse_spectrum_id(names).to_numpy()
+    df = df[df["spectrum_id"].notna()].copy()
+    df["spectrum_id"] = df["spectrum_id"].astype(SPECTRUM_ID_DTYPE)
+    return df
+
+
+def build_name_adduct_df(compound_ionization_data):
+    """
+    Create the (spectrum_id, adduct) table of the input MSP.
+
+    Args:
+        compound_ionization_data (list): (NAME, PRECURSORTYPE) tuples from
+            extract_compound_and_ionization.
+
+    Returns:
+        pd.DataFrame: One row per spectrum with an int32 spectrum_id.
+    """
+    name_adduct_df = pd.DataFrame(compound_ionization_data, columns=["name", "adduct"])
+    name_adduct_df = assign_spectrum_id(name_adduct_df, name_adduct_df["name"])
+    return name_adduct_df[["spectrum_id", "adduct"]].reset_index(drop=True)
+
+
+def apply_original_names(df, name_df):
+    """
+    Replace the integer spectrum ID by the original spectrum name for output.
+
+    The name is inserted as the first column, 'filename', matching the
+    layout of the published result files. When name_df has a
+    'representative_id' column (deduplicated input), the rows of a
+    representative are repeated for every spectrum it represents.
+    """
+    if "representative_id" in name_df.columns:
+        members = name_df[["representative_id", "Original_NAME"]].rename(
+            columns={"representative_id": "spectrum_id", "Original_NAME": "filename"}
+        )
+        return members.merge(df, on="spectrum_id", how="inner").drop(columns="spectrum_id")
+    original_names = name_df.set_index("spectrum_id")["Original_NAME"]
+    named_df = df[df["spectrum_id"].isin(original_names.index)].copy()
+    named_df.insert(0, "filename", named_df["spectrum_id"].map(original_names))
+    return named_df.drop(columns="spectrum_id")
+
+
+def read_top_n_rows(file_path, top_n, reader=pd.read_csv, **kwargs):
+    """
+    Read only the leading candidates of a per-compound result table.
+
+    Tool outputs are already sorted best-first, so parsing stops after
+    top_n + 1 rows. The extra row is kept so the score difference of the
+    last retained candidate can still be computed from its successor.
+
+    Args:
+        file_path (str): Path to the per-compound table.
+        top_n (int): Number of candidates to keep.
+        reader (callable): pandas reader supporting `nrows` (read_csv, read_excel, ...).
+
+    Returns:
+        pd.DataFrame: At most top_n + 1 leading rows.
+    """
+    return reader(file_path, nrows=top_n + 1, **kwargs)
+
+
+def read_grouped_top_n(file_path, group_column, top_n, rank_column=None,
+                       chunksize=50000, reader=pd.read_table, **kwargs):
+    """
+    Stream a multi-compound result table and keep the top candidates per compound.
+
+    Rows are consumed in chunks so memory scales with top_n rather than with
+    the raw size of the tool output. When `rank_column` is given, rows are
+    selected by that explicit rank; otherwise file order within each group
+    is taken as the rank order.
+
+    Args:
+        file_path (str): Path to the combined table.
+        group_column (str): Column identifying the compound of each row.
+        top_n (int): Number of candidates to keep per compound (one extra row
+            is kept for score difference calculation).
+        rank_column (str, optional): Column holding an explicit 1-based rank.
+        chunksize (int): Number of rows parsed per chunk.
+        reader (callable): pandas reader supporting `chunksize`.
+
+    Returns:
+        pd.DataFrame: Retained rows in file order.
+    """
+    kept = []
+    seen_counts = pd.Series(dtype="int64")
+    dtype = kwargs.pop("dtype", {})
+    dtype = {**dtype, group_column: str}
+
+    for chunk in reader(file_path, chunksize=chunksize, dtype=dtype, **kwargs):
+        if rank_column is not None:
+            kept.append(chunk[chunk[rank_column] <= top_n + 1])
+            continue
+
+        # Position of each row within its group, continuing from earlier chunks
+        offset = chunk[group_column].map(seen_counts).fillna(0).astype("int64")
+        position = chunk.groupby(group_column, sort=False).cumcount() + offset
+        kept.append(chunk[position <= top_n])
+
+        chunk_counts = chunk[group_column].value_counts()
+        seen_counts = seen_counts.add(chunk_counts, fill_value=0).astype("int64")
+
+    if not kept:
+        return pd.DataFrame()
+    return pd.concat(kept, ignore_index=True)
+
+
+def pivot_top_candidates(candidates_df, value_columns, prefix, key_column="spectrum_id", max_rank=5):
+    """
+    Build wide `<prefix>_1..max_rank` tables from a sorted long candidate table.
+
+    All requested value columns are reshaped in one pass: each value column is
+    encoded as a categorical once and its codes are scattered into a
+    (compound x rank) array, so no string copies of the long table are made.
+
+    Args:
+        candidates_df (pd.DataFrame): Long table with key_column, 'rank' and value columns.
+        value_columns (list): Columns to spread across ranks (e.g. ['InChIKey', 'SMILES']).
+        prefix (str): Column prefix, e.g. 'sirius_structure'.
+        key_column (str): Compound identifier column.
+        max_rank (int): Highest rank to keep.
+
+    Returns:
+        dict: value column -> DataFrame indexed by key_column with categorical rank columns.
+    """
+    top = candidates_df.loc[candidates_df["rank"] <= max_rank, [key_column, "rank", *value_columns]]
+    top = top.drop_duplicates(subset=[key_column, "rank"])
+
+    keys = pd.Categorical(top[key_column])
+    key_index = pd.Index(keys.categories, name=key_column)
+    ranks = top["rank"].to_numpy(dtype=np.int64)
+    n_ranks = int(ranks.max()) if len(ranks) else 0
+
+    wide_tables = {}
+    for value_column in value_columns:
+        values = pd.Categorical(top[value_column])
+        codes = np.full((len(key_index), n_ranks), -1, dtype=values.codes.dtype)
+        codes[keys.codes, ranks - 1] = values.codes
+        wide_tables[value_column] = pd.DataFrame(
+            {f"{prefix}_{r + 1}": pd.Categorical.from_codes(codes[:, r], dtype=values.dtype) for r in range(n_ranks)},
+            index=key_index,
+        )
+    return wide_tables
+
+
+def merge_wide_tables(base_df, tables, key_column="spectrum_id"):
+    """
+    Combine per-tool wide tables into one summary by aligning them on the compound key.
+
+    The base table is indexed once and every other table is reindexed onto it
+    and concatenated column-wise, so adding a tool costs one aligned concat
+    instead of another hash join. Columns already present (e.g. 'adduct') are
+    taken from the first table that provides them.
+
+    Args:
+        base_df (pd.DataFrame): Table defining the output rows and their order.
+        tables (list): Further tables keyed by key_column.
+        key_column (str): Compound identifier column.
+
+    Returns:
+        pd.DataFrame: Base rows with the columns of all tables.
+    """
+    base = base_df.drop_duplicates(subset=key_column).set_index(key_column)
+    aligned = [base]
+    seen_columns = set(base.columns)
+
+    for table in tables:
+        table = table.drop_duplicates(subset=key_column).set_index(key_column)
+        new_columns = [col for col in table.columns if col not in seen_columns]
+        seen_columns.update(new_columns)
+        aligned.append(table[new_columns].reindex(base.index))
+
+    return pd.concat(aligned, axis=1).reset_index()
+
+
+def spectrum_batches(tables, batch_spectra):
+    """
+    Split tables keyed by spectrum_id into batches covering the same spectra.
+
+    The spectrum IDs found in any table are cut into consecutive groups of
+    batch_spectra IDs, and the rows of every table are sorted into those
+    groups once. Each batch is only sliced out when it is requested, so only
+    one batch of rows is copied at a time.
+
+    Args:
+        tables (list): DataFrames with a spectrum_id column.
+        batch_spectra (int): Spectra per batch; 0 or less gives a single batch.
+
+    Yields:
+        list: The rows of every table for one group of spectra. Tables without
+        spectra, or fewer spectra than batch_spectra, are yielded whole.
+    """
+    ids = np.unique(np.concatenate([table["spectrum_id"].to_numpy(dtype=np.int64) for table in tables]))
+    if batch_spectra <= 0 or len(ids) <= batch_spectra:
+        yield list(tables)
+        return
+
+    # First spectrum ID of every batch after the first one
+    bounds = ids[batch_spectra::batch_spectra]
+    slices = []
+    for table in tables:
+        batch = np.searchsorted(bounds, table["spectrum_id"].to_numpy(dtype=np.int64), side="right")
+        order = np.argsort(batch, kind="stable")
+        slices.append((order, np.searchsorted(batch[order], np.arange(len(bounds) + 2))))
+    for b in range(len(bounds) + 1):
+        yield [table.iloc[order[edges[b]:edges[b + 1]]] for table, (order, edges) in zip(tables, slices)]
+
+
+def candidate_cache_path(output_dir, pipeline):
+    """Path of the cached candidate tables of a pipeline ('formula' or 'structure')."""
+    return os.path.join(output_dir, CANDIDATE_CACHE_DIR, f"{pipeline}_candidates.pkl")
+
+
+def save_candidate_cache(output_dir, pipeline, candidates, name_df, top_n):
+    """
+    Store the collected tool candidates of a run so they can be re-scored later.
+
+    Args:
+        output_dir (str): Summary output directory of the run.
+        pipeline (str): 'formula' or 'structure'.
+        candidates (dict): Tables returned by collect_formula_candidates /
+            collect_structure_candidates.
+        name_df (pd.DataFrame): spectrum_id to Original_NAME mapping.
+        top_n (int): Number of candidates per tool that were collected.
+
+    Returns:
+        str: Path of the cache file.
+    """
+    cache_path = candidate_cache_path(output_dir, pipeline)
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    pd.to_pickle({"candidates": candidates, "name_df": name_df, "top_n": top_n}, cache_path)
+    return cache_path
+
+
+def load_candidate_cache(output_dir, pipeline):
+    """Return the cache written by save_candidate_cache, or None if the run has none."""
+    cache_path = candidate_cache_path(output_dir, pipeline)
+    if not os.path.exists(cache_path):
+        return None
+    return pd.read_pickle(cache_path)
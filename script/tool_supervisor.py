@@ -0,0 +1,223 @@
+import os
+import re
+import time
+import signal
+import queue
+import logging
+import threading
+import subprocess
+from logging.handlers import RotatingFileHandler
+
+# Defaults of the 'supervisor' section of the parameter file
+DEFAULT_SETTINGS = {
+    "log_dir": "logs",
+    "log_max_mb": 10,
+    "log_backups": 3,
+    "echo": True,
+    "wall_timeout": 0,
+    "idle_timeout": 1800,
+    "retries": 1,
+    "progress_interval": 30,
+    "progress_patterns": {},
+}
+
+_loggers_lock = threading.Lock()
+
+
+def supervisor_settings(section=None):
+    """Merge the 'supervisor' section of the parameter file over DEFAULT_SETTINGS."""
+    settings = dict(DEFAULT_SETTINGS)
+    settings.update({key: value for key, value in (section or {}).items() if value is not None})
+    return settings
+
+
+def tool_logger(tool, settings):
+    """
+    Logger writing the output of one tool to <log_dir>/<tool>.log, rotated by size.
+
+    A relative log_dir is taken relative to this script's folder.
+    """
+    logger = logging.getLogger(f"msemblator.tools.{tool}")
+    with _loggers_lock:
+        if not logger.handlers:
+            log_dir = settings["log_dir"]
+            if not os.path.isabs(log_dir):
+                log_dir = os.path.join(os.path.abspath(os.path.dirname(__file__)), log_dir)
+            os.makedirs(log_dir, exist_ok=True)
+            handler = RotatingFileHandler(
+                os.path.join(log_dir, f"{tool}.log"),
+                maxBytes=int(settings["log_max_mb"] * 1024 * 1024),
+                backupCount=settings["log_backups"],
+                encoding="utf-8",
+            )
+            handler.setFormatter(logging.Formatter('%(asctime)s - %(message)s'))
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+            logger.propagate = False
+    return logger
+
+
+class ProgressCounter:
+    """
+    Spectra done / total of one tool run, with rate and ETA.
+
+    A progress pattern with two groups sets done and total from the match
+    (e.g. '(\\d+)/(\\d+)'); a pattern with one group sets done; a pattern
+    without groups counts one spectrum per matching line.
+    """
+
+    def __init__(self, tool, total=None, pattern=None, interval=30):
+        self.tool = tool
+        self.total = total
+        self.pattern = re.compile(pattern) if pattern else None
+        self.interval = interval
+        self.done = 0
+        self.start = time.time()
+        self._last_report = self.start
+
+    def update(self, line):
+        if self.pattern is None:
+            return
+        match = self.pattern.search(line)
+        if not match:
+            return
+        groups = [group for group in match.groups() if group is not None]
+        if len(groups) >= 2:
+            self.done, self.total = int(groups[0]), int(groups[1])
+        elif len(groups) == 1:
+            self.done = int(groups[0])
+        else:
+            self.done += 1
+
+    def summary(self):
+        elapsed = time.time() - self.start
+        rate = self.done / elapsed if elapsed > 0 else 0.0
+        text = f"[{self.tool}] {self.done}/{self.total if self.total else '?'} spectra, {rate:.2f}/s"
+        if self.total and rate > 0:
+            text += f", ETA {max(self.total - self.done, 0) / rate / 60:.1f} min"
+        return text + f", {elapsed / 60:.1f} min elapsed"
+
+    def report(self, force=False):
+        # Without a progress pattern there is nothing to count
+        if self.pattern is None:
+            return
+        now = time.time()
+        if force or now - self._last_report >= self.interval:
+            self._last_report = now
+            print(self.summary())
+
+
+def _kill_tree(proc):
+    # Tool executables start child processes (e.g. SIRIUS starts Java), so kill the whole tree
+    if os.name == "nt":
+        subprocess.run(["taskkill", "/F", "/T", "/PID", str(proc.pid)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return
+    # On other systems the tool runs in its own session, whose process group is killed
+    try:
+        os.killpg(proc.pid, signal.SIGKILL)
+    except OSError:
+        proc.kill()
+
+
+def _pump(stream, lines):
+    for line in stream:
+        lines.put(line)
+    lines.put(None)
+
+
+def _run_once(command, cwd, logger, progress, settings):
+    """Run the command once. Returns the exit code, or None if it was killed for a timeout."""
+    proc = subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, bufsize=1,
+        cwd=cwd, encoding="utf-8", errors="replace", start_new_session=os.name != "nt"
+    )
+    lines = queue.Queue()
+    reader = threading.Thread(target=_pump, args=(proc.stdout, lines), daemon=True)
+    reader.start()
+
+    start = last_output = time.time()
+    wall_timeout = settings["wall_timeout"]
+    idle_timeout = settings["idle_timeout"]
+    try:
+        while True:
+            try:
+                line = lines.get(timeout=1.0)
+            except queue.Empty:
+                line = ""
+            if line is None:
+                break
+            now = time.time()
+            if line:
+                last_output = now
+                logger.info(line.rstrip("\n"))
+                if settings["echo"]:
+                    print(line, end="")
+                progress.update(line)
+            progress.report()
+            if wall_timeout and now - start > wall_timeout:
+                logger.error(f"Killed after the wall-clock timeout of {wall_timeout} s")
+                _kill_tree(proc)
+                return None
+            if idle_timeout and now - last_output > idle_timeout:
+                logger.error(f"Killed after {idle_timeout} s without output")
+                _kill_tree(proc)
+                return None
+        return proc.wait()
+    finally:
+        if proc.poll() is None:
+            _kill_tree(proc)
+        proc.wait()
+        reader.join(timeout=5)
+        proc.stdout.close()
+
+
+def run_supervised(command, tool, settings=None, total=None, cwd=None, retry_command=None):
+    """
+    Run an external tool, streaming its output to a rotating log and tracking progress.
+
+    The process is killed when it exceeds the wall-clock timeout or prints
+    nothing for idle_timeout seconds, and is then started again up to
+    'retries' times. Without retry_command the same command is started again;
+    with it, the command of the next attempt is retry_command(started), where
+    started is the start time of the killed attempt, so the retry can leave
+    out the spectra that are done and the one the tool got stuck on.
+
+    Args:
+        command (list): Command line of the tool.
+        tool (str): Name of the log file and progress label, e.g. 'sirius_shard_00'.
+        settings (dict, optional): 'supervisor' section of the parameter file.
+        total (int, optional): Number of spectra processed by this run.
+        cwd (str, optional): Working directory of the process.
+        retry_command (callable, optional): Command of the next attempt after a timeout,
+            None if nothing is left to run.
+
+    Returns:
+        int or None: Exit code of the tool, None if it could not start or an
+            attempt timed out (a retried run may still have written results).
+    """
+    settings = supervisor_settings(settings)
+    logger = tool_logger(tool, settings)
+    patterns = settings["progress_patterns"] or {}
+    pattern = next((patterns[key] for key in patterns if tool.startswith(key)), None)
+
+    for attempt in range(settings["retries"] + 1):
+        if attempt and retry_command is not None:
+            command = retry_command(started)
+            if command is None:
+                logger.info("Nothing left to retry")
+                return None
+        started = time.time()
+        logger.info(f"Starting (attempt {attempt + 1}): {' '.join(map(str, command))}")
+        progress = ProgressCounter(tool, total, pattern, settings["progress_interval"])
+        try:
+            returncode = _run_once(command, cwd, logger, progress, settings)
+        except OSError as e:
+            logger.error(f"Could not start {tool}: {e}")
+            print(f"An error occurred during {tool} execution: {e}")
+            return None
+        if returncode is not None:
+            logger.info(f"Finished with exit code {returncode}")
+            progress.report(force=True)
+            return returncode if attempt == 0 else None
+        print(f"{tool} timed out (attempt {attempt + 1} of {settings['retries'] + 1})")
+    return None
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The pipeline modules live flat in script/ and import each other by name
+SCRIPT_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "script")
+if SCRIPT_DIR not in sys.path:
+    sys.path.insert(0, SCRIPT_DIR)
@@ -0,0 +1,62 @@
+import os
+import joblib
+import numpy as np
+import pytest
+from sklearn.ensemble import RandomForestClassifier, ExtraTreesClassifier
+from forest_engine import ForestEngine, export_forest, file_sha256, load_forest_model
+
+
+def fitted_forest(estimator, n_rows=400, n_features=6):
+    rng = np.random.default_rng(0)
+    X = rng.normal(size=(n_rows, n_features))
+    y = (X[:, 0] + 0.5 * X[:, 1] * X[:, 2] + rng.normal(scale=0.5, size=n_rows) > 0).astype(int)
+    return estimator.fit(X, y)
+
+
+def threshold_rows(engine, n_features):
+    """Rows whose values lie exactly on the split thresholds (as float32) and on their float32 neighbours."""
+    split_nodes = engine.left != -1
+    rows = []
+    for feature, threshold in zip(engine.feature[split_nodes], engine.threshold[split_nodes]):
+        value = np.float32(threshold)
+        for x in (value, np.nextafter(value, np.float32(-np.inf)), np.nextafter(value, np.float32(np.inf))):
+            row = np.zeros(n_features, dtype=np.float32)
+            row[feature] = x
+            rows.append(row)
+    return np.array(rows)
+
+
+@pytest.mark.parametrize("estimator", [
+    RandomForestClassifier(n_estimators=25, max_depth=8, random_state=0),
+    RandomForestClassifier(n_estimators=10, min_samples_leaf=3, random_state=1),
+    ExtraTreesClassifier(n_estimators=15, random_state=2),
+], ids=["rf", "rf_min_leaf", "extra_trees"])
+def test_exported_forest_matches_sklearn(estimator):
+    model = fitted_forest(estimator)
+    engine = export_forest(model)
+    assert engine is not None
+
+    rng = np.random.default_rng(1)
+    X = np.vstack([rng.normal(size=(1000, 6)).astype(np.float32), threshold_rows(engine, 6)])
+    np.testing.assert_allclose(engine.predict_proba(X), model.predict_proba(X), rtol=1e-9, atol=1e-12)
+
+
+def test_forest_cache_is_keyed_on_pickle_contents(tmp_path):
+    pkl_path = str(tmp_path / "random_forest_final_all.pkl")
+    npz_path = str(tmp_path / "random_forest_final_all.npz")
+    joblib.dump(fitted_forest(RandomForestClassifier(n_estimators=5, random_state=0)), pkl_path)
+
+    engine = load_forest_model(pkl_path, use_engine=True)
+    assert isinstance(engine, ForestEngine)
+    with np.load(npz_path) as data:
+        assert str(data["source_sha256"]) == file_sha256(pkl_path)
+
+    # A newer pickle with the same contents keeps the cache
+    cache_mtime = os.path.getmtime(npz_path)
+    os.utime(pkl_path, (cache_mtime + 100, cache_mtime + 100))
+    load_forest_model(pkl_path, use_engine=True)
+    assert os.path.getmtime(npz_path) == cache_mtime
+
+    # Different contents are exported again
+    joblib.dump(fitted_forest(RandomForestClassifier(n_estimators=7, random_state=3)), pkl_path)
+    assert len(load_forest_model(pkl_path, use_engine=True).roots) == 7
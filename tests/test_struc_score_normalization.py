@@ -0,0 +1,55 @@
+import glob
+import os
+import joblib
+import numpy as np
+import pandas as pd
+import pytest
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import StandardScaler, MinMaxScaler
+from conftest import SCRIPT_DIR
+from struc_score_normalization import (
+    ClippingTransformer, _compile_steps, _apply_steps, _sklearn_transform, load_score_normalizer
+)
+
+# Normalization pipelines shipped with the scoring models
+SHIPPED_PIPELINES = sorted(
+    glob.glob(os.path.join(SCRIPT_DIR, "formula_scoring_model", "pipline_*.pkl"))
+    + glob.glob(os.path.join(SCRIPT_DIR, "structure_scoring_model", "pipeline_*.pkl"))
+)
+
+
+def probe_values(compiled):
+    """Values below, inside and above the clipping range, including the bounds themselves."""
+    bounds = [value for kind, a, b in compiled if kind == "clip" for value in (a, b)] or [0.0, 1.0]
+    span = max(bounds) - min(bounds) or 1.0
+    return np.concatenate([np.linspace(min(bounds) - span, max(bounds) + span, 257), bounds, [0.0, 1.0, -1.0]])
+
+
+def assert_parity(pipeline):
+    compiled = _compile_steps(pipeline)
+    assert compiled is not None
+    probe = probe_values(compiled)
+    np.testing.assert_allclose(_apply_steps(compiled, probe), _sklearn_transform(pipeline, probe), rtol=1e-9, atol=1e-12)
+
+
+@pytest.mark.parametrize("pipeline_path", SHIPPED_PIPELINES, ids=os.path.basename)
+def test_shipped_pipeline_matches_sklearn(pipeline_path):
+    load_score_normalizer(pipeline_path)  # registers ClippingTransformer for unpickling
+    assert_parity(joblib.load(pipeline_path))
+
+
+@pytest.mark.parametrize("scaler", [StandardScaler(), MinMaxScaler(), MinMaxScaler(feature_range=(-1, 1), clip=True)])
+def test_fitted_pipeline_matches_sklearn(scaler):
+    scores = pd.DataFrame({"score": np.random.default_rng(0).normal(5.0, 3.0, size=500)})
+    pipeline = Pipeline([("clip", ClippingTransformer(q_low=0.5, q_high=9.0)), ("scale", scaler)]).fit(scores)
+    assert_parity(pipeline)
+
+
+def test_load_score_normalizer_uses_compiled_steps(tmp_path):
+    scores = pd.DataFrame({"score": np.linspace(-2.0, 12.0, 50)})
+    pipeline = Pipeline([("clip", ClippingTransformer(q_low=0.0, q_high=10.0)), ("scale", StandardScaler())]).fit(scores)
+    path = tmp_path / "pipeline_test_score.pkl"
+    joblib.dump(pipeline, path)
+
+    normalizer = load_score_normalizer(str(path))
+    np.testing.assert_allclose(normalizer(scores["score"]), pipeline.transform(scores).ravel(), rtol=1e-9)